@@ -0,0 +1,198 @@
+"""
+Read-only JSON appointment lists for kiosks and apps that poll.
+
+Each list carries an ETag naming its version. A client that sends the ETag
+back in If-None-Match gets 304 while nothing has changed. With ?wait=N the
+request is held for up to N seconds (at most API_MAX_WAIT) until the list
+changes. Pollers of one list wait on that list's condition variable and
+share one version check per API_POLL_INTERVAL, and one read of the list
+when it changes. A booking made by this process wakes them at once; changes
+made by other processes are seen at the next version check.
+
+A waiting poll holds the request thread that received it, so at most
+API_MAX_WAITERS polls per process wait at once. Beyond that a poll is
+answered straight away, with a Retry-After of one poll interval, leaving
+the rest of the server's threads free for pages. The default of 4 is half
+of serve.py's default 8 threads per worker; to hold more pollers, raise
+API_MAX_WAITERS together with --threads.
+
+Holding thousands of long-polls in one process would need an async server
+in front of an ASGI app, which this WSGI app does not have, so that is out
+of scope here: clients beyond the cap fall back to polling every
+Retry-After seconds, with the same ETags. A list's state is kept only while
+someone is polling it.
+"""
+import math
+import threading
+import time
+
+from flask import Response, current_app, jsonify, request
+
+# Cheap per-list version: appointments are only ever added or moved out
+VERSIONS = {
+    "patient": "SELECT count(*) AS n, max(id) AS last FROM appointment WHERE user_id = ?",
+    "doctor": "SELECT count(*) AS n, max(id) AS last FROM appointment WHERE doctor_id = ?",
+}
+
+
+class Watch:
+    """One list's pollers, its last known version and the rows last read for it, kept while anyone polls it."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.tag = None
+        self.checked = float("-inf")
+        self.checking = False
+        self.changes = 0
+        self.rows = None
+        self.reading = False
+        self.fetchers = 0
+
+
+class Polls:
+    """One app's watched lists and how many of its polls are waiting."""
+
+    def __init__(self):
+        self.watches = {}
+        self.waiting = 0
+
+
+class AppointmentFeed:
+    """Serves appointment lists with ETags and long-polling; each app keeps its own lists and waiters."""
+
+    def __init__(self, app=None, db=None):
+        self.db = db
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """Register defaults for the API settings in app.config."""
+        app.config.setdefault("API_POLL_INTERVAL", 1.0)
+        app.config.setdefault("API_MAX_WAIT", 30)
+        app.config.setdefault("API_MAX_WAITERS", 4)
+        app.extensions["appointment_feed"] = self
+        app.extensions["appointment_polls"] = Polls()
+        self.db = db
+
+    @property
+    def polls(self):
+        return current_app.extensions["appointment_polls"]
+
+    def watch(self, key):
+        """Join the pollers of a list, returning its Watch; leave() when done."""
+        polls = self.polls
+        with self.lock:
+            watch = polls.watches.get(key)
+            if watch is None:
+                watch = polls.watches[key] = Watch()
+            watch.fetchers += 1
+            return watch
+
+    def leave(self, key, watch):
+        """Stop polling a list, forgetting it once nobody else is."""
+        polls = self.polls
+        with self.lock:
+            watch.fetchers -= 1
+            if not watch.fetchers and polls.watches.get(key) is watch:
+                del polls.watches[key]
+
+    def version(self, watch, key):
+        """Return a list's ETag, querying at most once per poll interval however many clients ask. Caller holds watch.condition."""
+        while watch.checking:
+            watch.condition.wait()
+        if time.monotonic() - watch.checked < current_app.config["API_POLL_INTERVAL"]:
+            return watch.tag
+        watch.checking = True
+        changes = watch.changes
+        watch.condition.release()
+        try:
+            row = self.db.execute(VERSIONS[key[0]], key[1])[0]
+        finally:
+            watch.condition.acquire()
+            watch.checking = False
+            watch.condition.notify_all()
+        watch.tag = f'"{row["n"]}-{row["last"] or 0}"'
+        # A change made while the query ran may not be in its answer
+        watch.checked = time.monotonic() if watch.changes == changes else float("-inf")
+        return watch.tag
+
+    def read(self, watch, tag, rows):
+        """Return the rows of a list at tag, loaded once for every poller asking at the same time. Caller holds watch.condition."""
+        while watch.reading:
+            watch.condition.wait()
+        if watch.rows is None or watch.rows[0] != tag:
+            watch.reading = True
+            watch.condition.release()
+            try:
+                data = rows()
+            finally:
+                watch.condition.acquire()
+                watch.reading = False
+                watch.condition.notify_all()
+            watch.rows = (tag, data)
+        return watch.rows[1]
+
+    def fetch(self, key, rows, known, wait):
+        """Return (ETag, rows), with rows None if the list still matches a known ETag after waiting."""
+        watch = self.watch(key)
+        deadline = time.monotonic() + wait
+        try:
+            with watch.condition:
+                tag = self.version(watch, key)
+                while tag in known:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return tag, None
+                    watch.condition.wait(min(current_app.config["API_POLL_INTERVAL"], remaining))
+                    tag = self.version(watch, key)
+                # Pollers woken by the same change share one read of the list
+                return tag, self.read(watch, tag, rows)
+        finally:
+            self.leave(key, watch)
+
+    def respond(self, kind, owner, rows):
+        """Answer a poll for one patient's or doctor's list; rows is called to load it when it has changed."""
+        try:
+            wait = min(max(float(request.args.get("wait", 0)), 0), current_app.config["API_MAX_WAIT"])
+        except ValueError:
+            wait = 0
+        known = {f'"{tag}"' for tag in request.if_none_match.as_set()}
+        held = wait > 0 and self.hold()
+        try:
+            tag, data = self.fetch((kind, owner), rows, known, wait if held else 0)
+        finally:
+            if held:
+                with self.lock:
+                    self.polls.waiting -= 1
+        response = Response(status=304) if data is None else jsonify(appointments=data)
+        response.headers["ETag"] = tag
+        if wait > 0 and not held:
+            response.headers["Retry-After"] = str(math.ceil(current_app.config["API_POLL_INTERVAL"]))
+        return response
+
+    def hold(self):
+        """Take a place among the waiting polls, returning False if API_MAX_WAITERS are already waiting."""
+        polls = self.polls
+        with self.lock:
+            if polls.waiting >= current_app.config["API_MAX_WAITERS"]:
+                return False
+            polls.waiting += 1
+            return True
+
+    def changed(self, kind, owner):
+        """Mark a list this process has written to as changed, waking its pollers."""
+        polls = self.polls
+        with self.lock:
+            watch = polls.watches.get((kind, owner))
+        if watch is None:
+            return
+        with watch.condition:
+            watch.changes += 1
+            watch.checked = float("-inf")
+            watch.condition.notify_all()
+
+    def clear(self):
+        polls = self.polls
+        with self.lock:
+            polls.watches = {}
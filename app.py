@@ -1,45 +1,194 @@
+import datetime
+import math
 import os
-from helpers import apology,login_required
-from cs50 import SQL
-from flask import Flask, flash, redirect, render_template, request, session
-from flask_session import Session
-from tempfile import mkdtemp
-from werkzeug.security import check_password_hash, generate_password_hash
-from datetime import datetime
-
-
-# Configure application
-app = Flask(__name__)
-
-# Ensure templates are auto-reloaded
-app.config["TEMPLATES_AUTO_RELOAD"] = True
-
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
-
-# Configure CS50 Library to use SQLite database
-db = SQL("sqlite:///patients.db")
-
-@app.after_request
-def after_request(response):
-    """Ensure responses aren't cached"""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
+import sqlite3
+from helpers import apology,doctor_problem,forget_principal,patient_problem,principal,requires,sign_in
+from queries import APPOINTMENTS, DOCTORS, PATIENT_APPOINTMENTS, PATIENTS, appointments_with_patients, calendar, calendar_span, keyset_page, keyset_rows, search, with_history
+from database import Database
+from slots import SlotIndex
+from cache import DoctorDirectory, ProfileCache, RenderCache
+from hashing import Overloaded, PasswordHasher
+from ratelimit import LoginLimiter, TooManyAttempts
+from replica import ReportSnapshot
+from metrics import Metrics
+from httpcache import HttpCache, public
+from api import AppointmentFeed
+from bookings import BookingQueue, bookings_committed
+from stats import dashboard
+from bulk import COLUMNS, export_rows, import_rows, read_rows
+from migrations import pending
+import click
+from flask.cli import with_appcontext
+from markupsafe import Markup
+from flask import Flask, Response, current_app, flash, make_response, redirect, render_template, request, session, stream_template, stream_with_context
+from sessions import Session
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+
+# Extensions live at module level so views can use them; create_app() binds them to an app
+render_cache = RenderCache()
+server_sessions = Session()
+db = Database()
+slot_index = SlotIndex()
+doctor_directory = DoctorDirectory()
+profile_cache = ProfileCache()
+hasher = PasswordHasher()
+login_limiter = LoginLimiter()
+metrics = Metrics()
+feed = AppointmentFeed()
+booking_queue = BookingQueue()
+http_cache = HttpCache()
+report_snapshot = ReportSnapshot()
+
+# Views and CLI commands, added to the app by create_app()
+routes = []
+commands = []
+
+def route(rule, **options):
+    """Like app.route, but recorded here until create_app() adds the view."""
+    def decorator(f):
+        routes.append((rule, f, options))
+        return f
+    return decorator
+
+def command(f):
+    """Record a CLI command for create_app() to add to app.cli."""
+    commands.append(f)
+    return f
+
+def create_app(config=None):
+    """Build the app; settings in config override the defaults below before any extension reads them."""
+    app = Flask(__name__)
+
+    # Auto-reload templates only with FLASK_DEBUG=1; otherwise compile them all at startup and cache static pages and fragments
+    app.config["TEMPLATES_AUTO_RELOAD"] = os.environ.get("FLASK_DEBUG") == "1"
+
+    # Configure session to use an SQLite table (instead of signed cookies); set SESSION_SQLITE_PATH to use another file
+    app.config["SESSION_PERMANENT"] = False
+    app.config["SESSION_TYPE"] = "sqlite"
+    app.config["SESSION_SQLITE_PATH"] = os.environ.get("SESSION_SQLITE_PATH", "sessions.db")
+
+    # Rows per page on the admin listings, and most results shown by /search
+    app.config["LISTING_PAGE_SIZE"] = 100
+    app.config["SEARCH_LIMIT"] = 50
+
+    # Configure SQLite database; set DATABASE (or the DATABASE environment variable) to use another file
+    app.config["DATABASE"] = os.environ.get("DATABASE", "patients.db")
+
+    # Bookings are made in fixed-length slots, at most one per doctor per slot
+    app.config["SLOT_MINUTES"] = 15
+
+    # Cache the doctor roster until /add or an import changes it; every process using DATABASE shares invalidations
+    # through DOCTOR_VERSION_FILE, which defaults to a file next to it
+    app.config["DOCTOR_VERSION_FILE"] = os.environ.get("DOCTOR_VERSION_FILE")
+
+    # Opt-in instrumentation served on /metrics, which needs METRICS_TOKEN as a bearer token when set (see metrics.py);
+    # set METRICS_PROFILE_DIR and send an X-Profile header as an admin, or with METRICS_PROFILE_SECRET as its value,
+    # to dump a cProfile of one request
+    app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED") == "1"
+    app.config["METRICS_PROFILE_DIR"] = os.environ.get("METRICS_PROFILE_DIR")
+    app.config["METRICS_PROFILE_SECRET"] = os.environ.get("METRICS_PROFILE_SECRET")
+    app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
+    # Password hashing processes per app process; serve.py divides the CPUs between its workers unless this is set
+    if os.environ.get("HASH_WORKERS"):
+        app.config["HASH_WORKERS"] = int(os.environ["HASH_WORKERS"])
+
+    # Journal bookings and commit them in batches from one writer thread per app in each process (see bookings.py)
+    app.config["BOOKING_QUEUE"] = os.environ.get("BOOKING_QUEUE") == "1"
+    app.config["BOOKING_JOURNAL"] = os.environ.get("BOOKING_JOURNAL", "bookings.journal")
+
+    # Login attempt limits are kept per process; set LOGIN_LIMIT_DB to an SQLite file to share them between worker processes
+    app.config["LOGIN_LIMIT"] = os.environ.get("LOGIN_LIMIT") != "0"
+    app.config["LOGIN_LIMIT_DB"] = os.environ.get("LOGIN_LIMIT_DB")
+    # Behind PROXY_HOPS trusted reverse proxies, take the client's address and scheme from their X-Forwarded headers
+    app.config["PROXY_HOPS"] = int(os.environ.get("PROXY_HOPS", 0))
+
+    # Set REPORT_SNAPSHOT to a file path to serve the admin listings from a copy refreshed every REPORT_SNAPSHOT_MAX_AGE seconds
+    app.config["REPORT_SNAPSHOT"] = os.environ.get("REPORT_SNAPSHOT")
+
+    app.config.update(config or {})
+    if not app.config["DOCTOR_VERSION_FILE"]:
+        app.config["DOCTOR_VERSION_FILE"] = app.config["DATABASE"] + "-doctors"
+
+    # Views assume the latest schema, so refuse to start on a database that has not been migrated
+    behind = pending(app.config["DATABASE"])
+    if behind:
+        raise RuntimeError(f"{app.config['DATABASE']} needs migrating ({', '.join(behind)}): "
+                           f"run python migrations.py {app.config['DATABASE']}")
+
+    if app.config["PROXY_HOPS"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_HOPS"], x_proto=app.config["PROXY_HOPS"])
+
+    # Before any extension's hooks, so those that look at the principal see this request's
+    app.before_request(forget_principal)
+    render_cache.init_app(app)
+    server_sessions.init_app(app)
+    db.init_app(app)
+    slot_index.init_app(app)
+    doctor_directory.init_app(app)
+    # Names for dashboard greetings, cached from login on; set PROFILE_CACHE_TTL and PROFILE_CACHE_SIZE to tune
+    profile_cache.init_app(app)
+    # Hash passwords in a bounded process pool; stored hashes are upgraded on login when PASSWORD_HASH_METHOD changes
+    hasher.init_app(app)
+    # Turn away login attempts beyond a per-address and per-account allowance before they reach the database or the hasher
+    login_limiter.init_app(app)
+    metrics.init_app(app)
+    # JSON appointment lists for pollers under /api, with ETags and ?wait=N long-polling; each waiting poll holds a
+    # request thread, so at most API_MAX_WAITERS wait per process and the rest are told to Retry-After (see api.py)
+    feed.init_app(app, db)
+    booking_queue.init_app(app, db)
+    # Cache static files and anonymous pages; everything else, including every page with patient details, is no-store
+    http_cache.init_app(app)
+    report_snapshot.init_app(app)
+
+    for rule, view, options in routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.register_error_handler(Overloaded, overloaded)
+    app.register_error_handler(TooManyAttempts, too_many_attempts)
+    for cli_command in commands:
+        app.cli.add_command(cli_command)
+    return app
+
+def overloaded(e):
+    """Shed load when the password hashing queue is full"""
+    response = make_response(apology("Too many logins right now, please try again shortly", 503))
+    response.headers["Retry-After"] = str(current_app.config["HASH_RETRY_AFTER"])
     return response
 
-@app.route("/")
+def too_many_attempts(e):
+    """Turn away a login attempt beyond its address's or account's allowance"""
+    response = make_response(apology("Too many login attempts, please try again later", 429))
+    response.headers["Retry-After"] = str(math.ceil(e.retry_after))
+    return response
+
+def verify_password(table, row, password):
+    """Check a login's password, rehashing it if the configured hash cost has changed."""
+    if not hasher.check(row["hash"], password):
+        return False
+    try:
+        upgraded = hasher.rehash(row["hash"], password)
+    except Overloaded:
+        # The password was right; the old hash still works until a quieter login upgrades it
+        return True
+    if upgraded is not None:
+        db.execute(f"UPDATE {table} SET hash=? WHERE id=?", upgraded, row["id"])
+    return True
+
+@route("/")
+@public
 def index():
     session.clear()
-    return render_template("index.html")
+    return render_cache.page("index.html")
 
-@app.route("/about")
+@route("/about")
+@public
 def about():
-    return render_template("about.html")
+    return render_cache.page("about.html")
 
-@app.route('/doctor',methods=["GET","POST"])
+@route('/doctor',methods=["GET","POST"])
+@public
+@login_limiter.limit("email")
 def doctor():
     session.clear()
     if request.method=="GET":
@@ -56,21 +205,25 @@ def doctor():
         rows = db.execute("SELECT * FROM doctors WHERE email = ?", request.form.get("email"))
 
         # Ensure doctor exists and password is correct
-        if len(rows) != 1 or not check_password_hash(rows[0]["hash"], request.form.get("password")):
+        if len(rows) != 1 or not verify_password("doctors", rows[0], request.form.get("password")):
             return apology("invalid username and/or password", 403)
 
         # Remember which user has logged in
-        session["user_id"] = rows[0]["id"]
+        sign_in("doctor", rows[0]["id"])
+        profile_cache.put("doctor", rows[0]["id"], rows[0])
         
         flash("Logged In!")
 
         return redirect("/ddashboard")
 
-@app.route('/patient')
+@route('/patient')
+@public
 def patient():
-    return render_template("patient.html")
+    return render_cache.page("patient.html")
 
-@app.route('/admin',methods=["GET","POST"])
+@route('/admin',methods=["GET","POST"])
+@public
+@login_limiter.limit("username")
 def admin():
     session.clear()
     if request.method=="GET":
@@ -87,17 +240,18 @@ def admin():
         rows = db.execute("SELECT * FROM admin WHERE username = ?", request.form.get("username"))
 
         # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(rows[0]["hash"], request.form.get("password")):
+        if len(rows) != 1 or not verify_password("admin", rows[0], request.form.get("password")):
             return apology("invalid username and/or password", 403)
 
         # Remember which user has logged in
-        session["user_id"] = rows[0]["id"]
+        sign_in("admin", rows[0]["id"])
 
         flash("Logged In!")
 
         return redirect("/adashboard")
 
-@app.route('/pregister',methods=["GET","POST"])
+@route('/pregister',methods=["GET","POST"])
+@public
 def pregister():
     if request.method=="GET":
         return render_template("pregister.html")
@@ -109,26 +263,24 @@ def pregister():
         password = request.form.get("password")
         confirmation = request.form.get("confirmation")
         gender = request.form.get("gender")
-        if not fname or not lname:
-            return apology("Please enter your first and last name")
-        if not email or not contact:
-            return apology("Please enter your email id and your contact info")
-        if not password or not confirmation:
-            return apology("Please enter a password and confirm it")
+        problem = patient_problem(fname, lname, email, contact, password, confirmation)
+        if problem:
+            return apology(problem)
         if not gender:
             gender = "N/A"
-        if password != confirmation:
-            return apology("Your passwords do not match")
-        hashed = generate_password_hash(confirmation)
+        hashed = hasher.generate(confirmation)
         try:
             newUser = db.execute("INSERT INTO users(fname,lname,mail,contact,password,hash,gender) VALUES(?,?,?,?,?,?,?)",fname,lname,email,contact,confirmation,hashed,gender)
         except:
             return apology("This user already exists")
-        session["user_id"] = newUser
+        sign_in("patient", newUser)
+        profile_cache.put("patient", newUser, {"fname": fname, "lname": lname})
         flash("Registered!")
         return redirect("/pdashboard")
 
-@app.route("/plogin",methods=["GET","POST"])
+@route("/plogin",methods=["GET","POST"])
+@public
+@login_limiter.limit("email")
 def plogin():
     session.clear()
     if request.method=="GET":
@@ -145,35 +297,34 @@ def plogin():
         rows = db.execute("SELECT * FROM users WHERE mail = ?", request.form.get("email"))
 
         # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(rows[0]["hash"], request.form.get("password")):
+        if len(rows) != 1 or not verify_password("users", rows[0], request.form.get("password")):
             return apology("invalid username and/or password", 403)
 
         # Remember which user has logged in
-        session["user_id"] = rows[0]["id"]
+        sign_in("patient", rows[0]["id"])
+        profile_cache.put("patient", rows[0]["id"], rows[0])
 
         flash("Logged In!")
 
         return redirect("/pdashboard")
 
-@app.route("/pdashboard")
-@login_required
+@route("/pdashboard")
+@requires("patient")
 def pdashboard():
-    userID = session["user_id"]
-    name = db.execute("SELECT fname,lname FROM users WHERE id=?",userID)
-    user = name[0]["fname"]+" "+name[0]["lname"]
+    user = profile_cache.name(db, "patient", principal().id)
     return render_template("pdashboard.html",user=user)
 
-@app.route("/pbook",methods=["GET","POST"])
-@login_required
+def doctor_options():
+    """The rendered <option>s for every doctor, re-rendered only when the roster changes."""
+    return render_cache.get("doctor_options.html", doctor_directory.token(),
+                            lambda: Markup(render_template("doctor_options.html", doctors=doctor_directory.all(db))))
+
+@route("/pbook",methods=["GET","POST"])
+@requires("patient")
 def pbook():
-    user_id = session["user_id"]
-    names = db.execute("SELECT fname,lname FROM doctors")
-    fullNames = []
-    for i in names:
-        full = i["fname"] + " " + i["lname"]
-        fullNames.append(full)
+    user_id = principal().id
     if request.method=="GET":
-        return render_template("pbook.html",fullNames=fullNames)
+        return render_template("pbook.html",doctor_options=doctor_options())
     else:
         doctor = request.form.get("doctor")
         date = request.form.get("date")
@@ -184,100 +335,163 @@ def pbook():
             return apology("Please choose a date!")
         if not time:
             return apology("Please choose a time!")
+        # Slots and the unique index key on the date string, so store one spelling of each day
         try:
-            db.execute("INSERT INTO appointment(user_id,doctor,date,time) VALUES(?,?,?,?)",user_id,doctor,date,time)
+            date = datetime.date.fromisoformat(date.strip()).isoformat()
+        except ValueError:
+            return apology("Please choose a date!")
+        slot = slot_index.slot(time)
+        if slot is None:
+            return apology("Please choose a time between 06:00 and 18:00!")
+        time = slot_index.time(slot)
+        # The form posts the doctor's id; older clients post "fname lname", which is only usable when unambiguous
+        chosen = doctor_directory.find(db, doctor)
+        if chosen is None:
+            return apology("Please choose a doctor!")
+        doctorID = chosen["id"]
+        doctorName = chosen["fname"] + " " + chosen["lname"]
+        if not slot_index.reserve(db, doctorID, date, slot):
+            return slot_taken(doctorID, date, slot)
+        if booking_queue.enabled:
+            booking_queue.submit(user_id,doctorID,doctorName,date,time)
+            flash("Booked! Pending confirmation")
+            return redirect("/pdashboard")
+        try:
+            db.execute("INSERT INTO appointment(user_id,doctor_id,doctor,date,time) VALUES(?,?,?,?,?)",user_id,doctorID,doctorName,date,time)
+        except sqlite3.IntegrityError:
+            # Booked by another process since this one loaded the day
+            slot_index.taken(doctorID, date, slot)
+            return slot_taken(doctorID, date, slot)
         except:
+            slot_index.release(doctorID, date, slot)
             return apology("Oops! An error occurred!")
+        feed.changed("patient", user_id)
+        feed.changed("doctor", doctorID)
         flash("Booked!")
         return redirect("/pdashboard")
 
-@app.route("/pview")
-@login_required
+@bookings_committed.connect
+def bookings_changed(sender, bookings):
+    """Let pollers see queued bookings as soon as they are committed."""
+    for booking in bookings:
+        feed.changed("patient", booking["user_id"])
+        feed.changed("doctor", booking["doctor_id"])
+
+def slot_taken(doctorID, date, slot):
+    """Reject a booking for a taken slot, suggesting the next free ones."""
+    free = slot_index.next_free(db, doctorID, date, slot)
+    if not free:
+        return apology("No free times left after that on this day", 409)
+    return apology("That time is taken! Try " + ", ".join(free), 409)
+
+@route("/pview")
+@requires("patient")
 def pview():
-    userID = session["user_id"]
-    row = db.execute("SELECT doctor,date,time FROM appointment WHERE user_id=?",userID)
-    return render_template("pview.html",row=row)
-
-@app.route("/logout")
+    userID = principal().id
+    history = bool(request.args.get("history"))
+    row = db.execute(with_history(PATIENT_APPOINTMENTS) if history else PATIENT_APPOINTMENTS,userID)
+    pending = rejected = []
+    if booking_queue.enabled:
+        pending = booking_queue.pending_for(userID)
+        rejected = booking_queue.take_rejected(userID)
+    return render_template("pview.html",row=row,pending=pending,rejected=rejected,history=history)
+
+@route("/api/appointments")
+@requires("patient")
+def api_pview():
+    userID = principal().id
+    return feed.respond("patient", userID, lambda: db.execute(PATIENT_APPOINTMENTS, userID))
+
+@route("/logout")
 def logout():
     session.clear()
     flash("Logged Out!")
     return redirect("/")
 
-@app.route("/ddashboard")
-@login_required
+@route("/ddashboard")
+@requires("doctor")
 def ddashboard():
-    userID = session["user_id"]
-    name = db.execute("SELECT fname,lname FROM doctors WHERE id=?",userID)
-    user = name[0]["fname"]+" "+name[0]["lname"]
+    user = profile_cache.name(db, "doctor", principal().id)
     return render_template("ddashboard.html",user=user)
 
-@app.route("/dview")
-@login_required
+@route("/dview")
+@requires("doctor")
 def dview():
-    doctorID = session["user_id"]
-    names = db.execute("SELECT fname,lname FROM doctors WHERE id=?",doctorID)
-    doctorName = names[0]["fname"] + " " + names[0]["lname"]
-    appointments = db.execute("SELECT user_id,date,time FROM appointment WHERE doctor=?",doctorName)
-    data = []
-    if len(appointments)>0:
-        for i in appointments:
-            pdata = {}
-            pid = i["user_id"]
-            patient = db.execute("SELECT fname,lname,contact,mail FROM users WHERE id=?",pid)
-            if len(patient)>0:
-                pdata["fname"] = patient[0]["fname"]
-                pdata["lname"] = patient[0]["lname"]
-                pdata["contact"] = patient[0]["contact"]
-                pdata["mail"] = patient[0]["mail"]
-                pdata["date"] = i["date"]
-                pdata["time"] = i["time"]
-                data.append(pdata)
-    return render_template("dview.html",data=data)
-
-@app.route("/adashboard")
-@login_required
+    doctorID = principal().id
+    history = bool(request.args.get("history"))
+    data = appointments_with_patients(db, doctor_id=doctorID, history=history)
+    return render_template("dview.html",data=data,history=history)
+
+@route("/dcalendar")
+@requires("doctor")
+def dcalendar():
+    view = request.args.get("view", "week")
+    if view not in ("day", "week", "month"):
+        return apology("Please choose a day, week or month")
+    try:
+        day = datetime.date.fromisoformat(request.args.get("date") or datetime.date.today().isoformat())
+    except ValueError:
+        return apology("Please choose a date!")
+    try:
+        first, after, previous = calendar_span(view, day)
+    except OverflowError:
+        return apology("Please choose a date between the years 0001 and 9999!")
+    # A month shows how full each day is; its appointments are a click away in the day view
+    days = calendar(db, principal().id, first, after, appointments=view != "month")
+    return render_template("dcalendar.html",view=view,day=day,days=days,slots=slot_index.count,previous=previous,next=after)
+
+@route("/api/doctor/appointments")
+@requires("doctor")
+def api_dview():
+    doctorID = principal().id
+    return feed.respond("doctor", doctorID, lambda: list(appointments_with_patients(db, doctor_id=doctorID)))
+
+@route("/adashboard")
+@requires("admin")
 def adashboard():
-    return render_template("adashboard.html")
-
-@app.route("/dlist")
-@login_required
+    return render_template("adashboard.html",stats=dashboard(db))
+
+@route("/search")
+@requires("admin")
+def find():
+    kind = request.args.get("kind", "patients")
+    if kind not in ("patients", "doctors"):
+        return apology("Please choose patients or doctors")
+    q = request.args.get("q", "")
+    data = search(db, kind, q, current_app.config["SEARCH_LIMIT"])
+    return render_template("search.html",kind=kind,q=q,data=data)
+
+def listing(template, query, key="id", **context):
+    """Render one keyset page of a listing, or stream all of it when ?all=1 is given, from the report snapshot if enabled."""
+    source = report_snapshot.reader(db)
+    if source is report_snapshot:
+        context["as_of"] = report_snapshot.taken()
+    if request.args.get("all"):
+        return stream_template(template, data=keyset_rows(source, query, key=key), **context)
+    page = keyset_page(source, query, key=key,
+                       after=request.args.get("after", type=int),
+                       before=request.args.get("before", type=int),
+                       size=current_app.config["LISTING_PAGE_SIZE"])
+    return render_template(template, data=page.rows, page=page, **context)
+
+@route("/dlist")
+@requires("admin")
 def dlist():
-    data = db.execute("SELECT fname,lname,password,email FROM doctors")
-    if len(data)==0:
-        data = []
-    return render_template("dlist.html",data=data)
+    return listing("dlist.html", DOCTORS)
 
-@app.route("/plist")
-@login_required
+@route("/plist")
+@requires("admin")
 def plist():
-    data = db.execute("SELECT fname,lname,mail,contact,password FROM users")
-    if len(data)==0:
-        data = []
-    return render_template("plist.html",data=data)
+    return listing("plist.html", PATIENTS)
 
-@app.route("/vapp")
-@login_required
+@route("/vapp")
+@requires("admin")
 def vapp():
-    appointments = db.execute("SELECT user_id,doctor,date,time FROM appointment")
-    data = []
-    for i in appointments:
-        user_id = i["user_id"]
-        patients = db.execute("SELECT fname,lname,mail,contact FROM users WHERE id=?",user_id)
-        if len(patients)>0:
-            info = {}
-            info["fname"] = patients[0]["fname"]
-            info["lname"] = patients[0]["lname"]
-            info["mail"] = patients[0]["mail"]
-            info["contact"] = patients[0]["contact"]
-            info["doctor"] = i["doctor"]
-            info["date"] = i["date"]
-            info["time"] = i["time"]
-            data.append(info)
-    return render_template("vapp.html",data=data)
-
-@app.route("/add",methods=["GET","POST"])
-@login_required
+    history = bool(request.args.get("history"))
+    return listing("vapp.html", with_history(APPOINTMENTS) if history else APPOINTMENTS, key="a.id", history=history)
+
+@route("/add",methods=["GET","POST"])
+@requires("admin")
 def dadd():
     if request.method=="GET":
         return render_template("add.html")
@@ -287,19 +501,87 @@ def dadd():
         email = request.form.get("email")
         password = request.form.get("password")
         confirmation = request.form.get("confirmation")
-        if not fname or not lname:
-            return apology("Please enter your first and last name")
-        if not email:
-            return apology("Please enter your email id")
-        if not password or not confirmation:
-            return apology("Please enter a password and confirm it")
-        if password != confirmation:
-            return apology("Your passwords do not match")
-        hashed = generate_password_hash(confirmation)
+        problem = doctor_problem(fname, lname, email, password, confirmation)
+        if problem:
+            return apology(problem)
+        hashed = hasher.generate(confirmation)
         try:
             newUser = db.execute("INSERT INTO doctors(fname,lname,email,password,hash) VALUES(?,?,?,?,?)",fname,lname,email,confirmation,hashed)
         except:
             return apology("This email already exists")
+        doctor_directory.bump()
         flash("Registered!")
         return redirect("/adashboard")
 
+def run_import(kind, stream, fmt):
+    """Import a CSV or JSON Lines stream of one kind of record, refreshing the caches it affects."""
+    inserted, errors = import_rows(db, hasher, kind, read_rows(stream, fmt), slot_index)
+    if kind == "doctors":
+        doctor_directory.bump()
+    elif kind == "appointments":
+        slot_index.clear()
+        feed.clear()
+    return inserted, errors
+
+@route("/import",methods=["GET","POST"])
+@requires("admin")
+def bulk_import():
+    if request.method=="GET":
+        return render_template("import.html",kinds=COLUMNS)
+    else:
+        kind = request.form.get("kind")
+        upload = request.files.get("file")
+        if kind not in COLUMNS:
+            return apology("Please choose what to import")
+        if not upload or not upload.filename:
+            return apology("Please choose a file")
+        fmt = "csv" if upload.filename.lower().endswith(".csv") else "jsonl"
+        inserted, errors = run_import(kind, upload.stream, fmt)
+        return render_template("import.html",kinds=COLUMNS,kind=kind,inserted=inserted,errors=errors[:100],failed=len(errors))
+
+@route("/export/<kind>.<fmt>")
+@requires("admin")
+def bulk_export(kind, fmt):
+    if kind not in COLUMNS or fmt not in ("csv", "jsonl"):
+        return apology("Unknown export", 404)
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    response = Response(stream_with_context(export_rows(db, kind, fmt)), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={kind}.{fmt}"
+    return response
+
+@command
+@click.command("import-data")
+@with_appcontext
+@click.argument("kind", type=click.Choice(list(COLUMNS)))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_data(kind, path):
+    """Import patients, doctors or appointments from a .csv or .jsonl file."""
+    with open(path, "rb") as f:
+        inserted, errors = run_import(kind, f, "csv" if path.lower().endswith(".csv") else "jsonl")
+    for number, error in errors:
+        click.echo(f"line {number}: {error}", err=True)
+    click.echo(f"Imported {inserted} {kind}, {len(errors)} rows rejected")
+
+@command
+@click.command("snapshot")
+@with_appcontext
+def snapshot():
+    """Refresh the REPORT_SNAPSHOT copy that the admin listings read."""
+    if not report_snapshot.enabled:
+        raise click.UsageError("Set REPORT_SNAPSHOT to the snapshot's path first")
+    report_snapshot.refresh(wait=True, force=True)
+    click.echo(f"Snapshot taken at {report_snapshot.taken():%Y-%m-%d %H:%M:%S}")
+
+@command
+@click.command("export-data")
+@with_appcontext
+@click.argument("kind", type=click.Choice(list(COLUMNS)))
+@click.argument("path", type=click.Path(dir_okay=False))
+def export_data(kind, path):
+    """Export patients, doctors or appointments to a .csv or .jsonl file."""
+    with open(path, "w", newline="") as f:
+        for chunk in export_rows(db, kind, "csv" if path.lower().endswith(".csv") else "jsonl"):
+            f.write(chunk)
+
+# The app most callers want, e.g. `flask run`, serve.py and the tests
+app = create_app()
@@ -1,13 +1,31 @@
 import pytest
-from app import app, db
-from werkzeug.security import generate_password_hash
+from app import app, booking_queue, create_app, db, doctor_directory, feed, hasher, login_limiter, profile_cache, render_cache, report_snapshot, slot_index
+from archive import archive
+from hashing import Overloaded
+from migrations import migrate
+from werkzeug.security import check_password_hash, generate_password_hash
+import datetime
+import fcntl
+import http.client
+import io
 import os
+import signal
+import sqlite3
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 
 @pytest.fixture
 def client():
     # Create a temporary file to use as our database
     db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+    # Keep sessions and the doctor roster version beside it, away from the live ones
+    app.config['SESSION_SQLITE_PATH'] = app.config['DATABASE'] + '-sessions'
+    app.config['DOCTOR_VERSION_FILE'] = app.config['DATABASE'] + '-doctors'
+    app.session_interface.store.close()
+    app.session_interface.open_store(app.config['SESSION_SQLITE_PATH'])
     
     # Create the application with test config
     app.config['TESTING'] = True
@@ -48,15 +66,29 @@ def client():
                     doctor TEXT NOT NULL,
                     date TEXT NOT NULL,
                     time TEXT NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
+                    doctor_id INTEGER,
+                    FOREIGN KEY (user_id) REFERENCES users (id),
+                    FOREIGN KEY (doctor_id) REFERENCES doctors (id)
                 )
             """)
+            migrate(app.config['DATABASE'])
+            slot_index.clear()
+            render_cache.clear()
+            feed.clear()
+            profile_cache.clear()
+            login_limiter.clear()
+            doctor_directory.bump()
             
             yield client
     
     # Clean up
+    db.close()
+    app.session_interface.store.close()
     os.close(db_fd)
-    os.unlink(app.config['DATABASE'])
+    for path in (app.config['DATABASE'], app.config['SESSION_SQLITE_PATH'], app.config['DOCTOR_VERSION_FILE']):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
 
 def test_index_route(client):
     """Test the index route returns 200"""
@@ -182,4 +214,992 @@ def test_appointment_booking(client):
 def test_logout(client):
     """Test logout functionality"""
     response = client.get('/logout', follow_redirects=True)
-    assert response.status_code == 200 
\ No newline at end of file
+    assert response.status_code == 200 
+def test_appointment_listings(client):
+    """Test appointment listings show the patient's details"""
+    client.post('/pregister', data={
+        'firstName': 'John',
+        'lastName': 'Doe',
+        'email': 'john@example.com',
+        'contact': '1234567890',
+        'password': 'password123',
+        'confirmation': 'password123',
+        'gender': 'Male'
+    })
+    client.post('/plogin', data={
+        'email': 'john@example.com',
+        'password': 'password123'
+    })
+    hashed = generate_password_hash('password123')
+    doctor = db.execute("""
+        INSERT INTO doctors (fname, lname, email, password, hash)
+        VALUES (?, ?, ?, ?, ?)
+    """, 'Gregory', 'House', 'house@hospital.com', 'password123', hashed)
+    client.post('/pbook', data={
+        'doctor': str(doctor),
+        'date': '2024-03-20',
+        'time': '10:00'
+    })
+
+    with client.session_transaction() as sess:
+        sess['role'] = 'admin'
+    response = client.get('/vapp')
+    assert response.status_code == 200
+    assert b'john@example.com' in response.data
+    assert b'Gregory House' in response.data
+
+    with client.session_transaction() as sess:
+        sess['user_id'] = doctor
+        sess['role'] = 'doctor'
+    response = client.get('/dview')
+    assert response.status_code == 200
+    assert b'john@example.com' in response.data
+
+    # Each keyset batch of one doctor's listing seeks an index in id order instead of sorting the doctor's history
+    from queries import DOCTOR_APPOINTMENTS, with_history
+    for query in (DOCTOR_APPOINTMENTS, with_history(DOCTOR_APPOINTMENTS)):
+        plan = db.execute("EXPLAIN QUERY PLAN " + query.format(cond="a.id > ? ORDER BY a.id LIMIT ?"), doctor, 0, 500)
+        assert not any('TEMP B-TREE' in row['detail'] for row in plan)
+
+def test_listing_pagination(client):
+    """Test admin listings are paginated and can be streamed whole"""
+    client.post('/pregister', data={
+        'firstName': 'John',
+        'lastName': 'Doe',
+        'email': 'john@example.com',
+        'contact': '1234567890',
+        'password': 'password123',
+        'confirmation': 'password123',
+        'gender': 'Male'
+    })
+    client.post('/plogin', data={
+        'email': 'john@example.com',
+        'password': 'password123'
+    })
+
+    with client.session_transaction() as sess:
+        sess['role'] = 'admin'
+    app.config['LISTING_PAGE_SIZE'] = 1
+    try:
+        response = client.get('/plist')
+        assert response.status_code == 200
+        assert response.data.count(b'<tr>') == 2  # header row and one patient
+        assert b'Show All' in response.data
+
+        response = client.get('/plist?all=1')
+        assert response.status_code == 200
+        assert b'john@example.com' in response.data
+    finally:
+        app.config['LISTING_PAGE_SIZE'] = 100
+
+def test_double_booking_rejected(client):
+    """Test a taken slot cannot be booked again"""
+    client.post('/pregister', data={
+        'firstName': 'John',
+        'lastName': 'Doe',
+        'email': 'john@example.com',
+        'contact': '1234567890',
+        'password': 'password123',
+        'confirmation': 'password123',
+        'gender': 'Male'
+    })
+    hashed = generate_password_hash('password123')
+    doctor = db.execute("""
+        INSERT INTO doctors (fname, lname, email, password, hash)
+        VALUES (?, ?, ?, ?, ?)
+    """, 'Gregory', 'House', 'house@hospital.com', 'password123', hashed)
+
+    booking = {'doctor': str(doctor), 'date': '2024-03-20', 'time': '10:05'}
+    response = client.post('/pbook', data=booking)
+    assert response.status_code == 302
+
+    response = client.post('/pbook', data=booking)
+    assert response.status_code == 409
+    assert b'10%3A15' in response.data  # next free slot is offered
+
+    appointments = db.execute("SELECT time FROM appointment WHERE doctor_id = ?", doctor)
+    assert appointments == [{'time': '10:00'}]
+
+    # Other spellings of the same day are the same slot, and dates that aren't days are refused
+    for date in (' 2024-03-20', '20240320'):
+        response = client.post('/pbook', data=dict(booking, date=date))
+        assert response.status_code == 409
+    for date in ('2024-3-20', 'garbage'):
+        response = client.post('/pbook', data=dict(booking, date=date))
+        assert response.status_code == 400
+    assert client.post('/pbook', data=dict(booking, doctor='\u00b2')).status_code == 400
+    assert db.execute("SELECT date FROM appointment WHERE doctor_id = ?", doctor) == [{'date': '2024-03-20'}]
+
+def test_doctor_directory_invalidated_by_add(client):
+    """Test doctors added through /add appear on the booking form"""
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'patient'
+    response = client.get('/pbook')
+    assert b'Gregory House' not in response.data
+
+    with client.session_transaction() as sess:
+        sess['role'] = 'admin'
+    client.post('/add', data={
+        'fname': 'Gregory',
+        'lname': 'House',
+        'email': 'house@hospital.com',
+        'password': 'password123',
+        'confirmation': 'password123'
+    })
+    with client.session_transaction() as sess:
+        sess['role'] = 'patient'
+    response = client.get('/pbook')
+    assert b'Gregory House' in response.data
+
+def test_password_rehashed_on_login(client):
+    """Test stored hashes are upgraded when the hash method changes"""
+    client.post('/pregister', data={
+        'firstName': 'John',
+        'lastName': 'Doe',
+        'email': 'john@example.com',
+        'contact': '1234567890',
+        'password': 'password123',
+        'confirmation': 'password123',
+        'gender': 'Male'
+    })
+
+    method = app.config['PASSWORD_HASH_METHOD']
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    try:
+        # A full hashing queue keeps the old hash but does not turn away a right password
+        def overloaded(password):
+            raise Overloaded()
+        with pytest.MonkeyPatch.context() as patch:
+            patch.setattr(hasher, 'generate', overloaded)
+            response = client.post('/plogin', data={'email': 'john@example.com', 'password': 'password123'})
+            assert response.status_code == 302
+        stored = db.execute("SELECT hash FROM users WHERE mail = ?", 'john@example.com')
+        assert stored[0]['hash'].startswith(method + '$')
+
+        response = client.post('/plogin', data={
+            'email': 'john@example.com',
+            'password': 'password123'
+        })
+        assert response.status_code == 302
+    finally:
+        app.config['PASSWORD_HASH_METHOD'] = method
+
+    stored = db.execute("SELECT hash FROM users WHERE mail = ?", 'john@example.com')
+    assert stored[0]['hash'].startswith('pbkdf2:sha256:1000$')
+
+def test_login_shed_when_hashing_overloaded(client):
+    """Test logins get a 503 with Retry-After when the hashing queue is full"""
+    limit = app.config['HASH_QUEUE_LIMIT']
+    hasher.shutdown()
+    app.config['HASH_QUEUE_LIMIT'] = 0
+    try:
+        response = client.post('/pregister', data={
+            'firstName': 'John',
+            'lastName': 'Doe',
+            'email': 'john@example.com',
+            'contact': '1234567890',
+            'password': 'password123',
+            'confirmation': 'password123',
+            'gender': 'Male'
+        })
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '2'
+    finally:
+        hasher.shutdown()
+        app.config['HASH_QUEUE_LIMIT'] = limit
+
+def test_bulk_hashing_leaves_room_for_logins(client):
+    """Test an import queues at most HASH_IMPORT_SLOTS hashes at once, so logins are not stuck behind it"""
+    method = app.config['PASSWORD_HASH_METHOD']
+    hasher.shutdown()
+    app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+    app.config['HASH_IMPORT_SLOTS'] = 1
+    try:
+        queue = hasher.start()
+        submit, queued = queue.pool.submit, []
+        def record(*args):
+            queued.append(queue.import_slots._value)
+            return submit(*args)
+        queue.pool.submit = record
+        hashes = hasher.generate_many(['one', 'two', 'three'])
+        assert queued == [0, 0, 0]
+        assert [check_password_hash(pwhash, password)
+                for pwhash, password in zip(hashes, ['one', 'two', 'three'])] == [True, True, True]
+    finally:
+        hasher.shutdown()
+        app.config['PASSWORD_HASH_METHOD'] = method
+        app.config['HASH_IMPORT_SLOTS'] = max(1, app.config['HASH_WORKERS'])
+
+def test_session_store_writes_only_on_change(client):
+    """Test sessions are stored on login, left alone on reads and deleted on logout"""
+    store = app.session_interface.store
+    before = store.execute("SELECT COUNT(*) AS n FROM sessions")[0]['n']
+
+    client.get('/')
+    client.get('/patient')
+    assert store.execute("SELECT COUNT(*) AS n FROM sessions")[0]['n'] == before
+
+    client.post('/pregister', data={
+        'firstName': 'John',
+        'lastName': 'Doe',
+        'email': 'john@example.com',
+        'contact': '1234567890',
+        'password': 'password123',
+        'confirmation': 'password123',
+        'gender': 'Male'
+    })
+    client.get('/pdashboard')
+    sid = client.get_cookie('session').value
+    stored = store.execute("SELECT expires FROM sessions WHERE id = ?", 'session:' + sid)
+    assert len(stored) == 1
+
+    client.get('/pview')
+    assert store.execute("SELECT expires FROM sessions WHERE id = ?", 'session:' + sid) == stored
+
+    client.get('/logout')
+    client.get('/')
+    assert store.execute("SELECT expires FROM sessions WHERE id = ?", 'session:' + sid) == []
+
+def test_metrics_endpoint(client):
+    """Test /metrics reports per-route latency, query counts and render times when enabled"""
+    assert client.get('/metrics').status_code == 404
+
+    app.config['METRICS_ENABLED'] = True
+    try:
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['role'] = 'admin'
+        client.get('/vapp')
+        client.get('/logout')
+        client.get('/pview')
+
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        text = response.data.decode()
+        assert 'http_request_duration_seconds_count{route="vapp"} 1' in text
+        assert 'db_queries_per_request_bucket{route="vapp",le="1"} 1' in text
+        assert 'template_render_seconds_count{template="vapp.html"} 1' in text
+        assert 'login_required_total{route="pview",result="rejected"} 1' in text
+        assert 'apologies_total{route="pview",code="400"} 1' in text
+
+        # Only an admin, or a request knowing the profiling secret, gets a profile dumped
+        app.config['METRICS_PROFILE_DIR'] = tempfile.mkdtemp()
+        app.config['METRICS_PROFILE_SECRET'] = 'letmeprofile'
+        client.get('/patient', headers={'X-Profile': '1'})
+        assert client.get('/patient', headers={'X-Profile': '\u00e9'.encode().decode('latin-1')}).status_code == 200
+        assert os.listdir(app.config['METRICS_PROFILE_DIR']) == []
+        client.get('/patient', headers={'X-Profile': 'letmeprofile'})
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['role'] = 'admin'
+        client.get('/vapp', headers={'X-Profile': '1'})
+        assert sorted(name.split('-')[0] for name in os.listdir(app.config['METRICS_PROFILE_DIR'])) == ['patient', 'vapp']
+
+        # With a token set, /metrics is only for a scraper sending it
+        app.config['METRICS_TOKEN'] = 'scrape'
+        assert client.get('/metrics').status_code == 403
+        assert client.get('/metrics', headers={'Authorization': 'Bearer \u00e9'.encode().decode('latin-1')}).status_code == 403
+        assert client.get('/metrics', headers={'Authorization': 'Bearer scrape'}).status_code == 200
+    finally:
+        app.config['METRICS_ENABLED'] = False
+        app.config['METRICS_TOKEN'] = app.config['METRICS_PROFILE_SECRET'] = None
+        if app.config['METRICS_PROFILE_DIR']:
+            for name in os.listdir(app.config['METRICS_PROFILE_DIR']):
+                os.unlink(os.path.join(app.config['METRICS_PROFILE_DIR'], name))
+            os.rmdir(app.config['METRICS_PROFILE_DIR'])
+            app.config['METRICS_PROFILE_DIR'] = None
+
+def test_bulk_import_and_export(client):
+    """Test a CSV import inserts the good rows, reports the bad ones and round-trips through export"""
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'admin'
+    csv = (b"fname,lname,mail,contact,password,gender\n"
+           b"Ann,Lee,ann@example.com,1234567890,secret,F\n"
+           b"Bob,Ray,bob@example.com,,secret,M\n"
+           b"Cy,Ng,cy@example.com,0987654321,secret,N/A\n")
+    response = client.post('/import', data={
+        'kind': 'patients',
+        'file': (io.BytesIO(csv), 'patients.csv')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert b'Imported 2 patients, 1 rows rejected' in response.data
+    assert b'<td>3</td>' in response.data
+
+    with app.app_context():
+        rows = db.execute("SELECT mail, hash FROM users ORDER BY id")
+    assert [row['mail'] for row in rows] == ['ann@example.com', 'cy@example.com']
+    assert all(row['hash'] != 'secret' for row in rows)
+
+    response = client.get('/export/patients.csv')
+    assert response.status_code == 200
+    lines = response.data.decode().splitlines()
+    assert lines[0] == 'id,fname,lname,mail,contact,gender'
+    assert lines[1] == '1,Ann,Lee,ann@example.com,1234567890,F'
+    assert b'secret' not in client.get('/export/patients.jsonl').data
+    assert len(lines) == 3
+
+    # A row saved in another encoding, e.g. cp1252 from Excel, is reported without losing the rows around it
+    csv = (b"fname,lname,mail,contact,password,gender\n"
+           + "Zo\u00eb,Day,zoe@example.com,1234567890,secret,F\n".encode('cp1252')
+           + b"Dee,Fox,dee@example.com,1234567890,secret,F\n")
+    response = client.post('/import', data={
+        'kind': 'patients',
+        'file': (io.BytesIO(csv), 'patients.csv')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert b'Imported 1 patients, 1 rows rejected' in response.data
+    assert b'<td>2</td>' in response.data
+
+    response = client.post('/import', data={
+        'kind': 'appointments',
+        'file': (io.BytesIO("user_id,doctor_id,date,time\n\u00b2,1,2031-03-20,10:00\n".encode()), 'appointments.csv')
+    }, content_type='multipart/form-data')
+    assert b'Imported 0 appointments, 1 rows rejected' in response.data
+
+def test_static_pages_and_fragments_cached(client):
+    """Test static pages render once and the doctor list re-renders only after /add"""
+    from flask import template_rendered
+    rendered = []
+    def record(sender, template, context, **extra):
+        rendered.append(template.name)
+    template_rendered.connect(record, app)
+    try:
+        first = client.get('/patient').data
+        assert client.get('/patient').data == first
+        assert rendered.count('patient.html') == 1
+
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['role'] = 'patient'
+        client.get('/pbook')
+        client.get('/pbook')
+        assert rendered.count('doctor_options.html') == 1
+
+        with client.session_transaction() as sess:
+            sess['role'] = 'admin'
+        client.post('/add', data={
+            'fname': 'Gregory',
+            'lname': 'House',
+            'email': 'house@example.com',
+            'password': 'secret',
+            'confirmation': 'secret'
+        })
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['role'] = 'patient'
+        assert b'Gregory House' in client.get('/pbook').data
+        assert rendered.count('doctor_options.html') == 2
+    finally:
+        template_rendered.disconnect(record, app)
+
+def test_http_caching_policy(client):
+    """Test static files are immutable, public pages revalidate with 304 and patient pages are never stored"""
+    page = client.get('/')
+    assert page.headers['Cache-Control'] == 'no-cache'
+    assert page.headers['ETag'] and page.headers['Last-Modified']
+    assert client.get('/', headers={'If-None-Match': page.headers['ETag']}).status_code == 304
+
+    url = page.data.decode().split('<img src="')[1].split('"')[0]
+    assert '?v=' in url
+    assert 'immutable' in client.get(url).headers['Cache-Control']
+    assert client.get('/static/doctor.png').headers['Cache-Control'] == 'no-cache'
+
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'patient'
+    assert 'no-store' in client.get('/pview').headers['Cache-Control']
+    assert 'no-store' in client.post('/plogin', data={}).headers['Cache-Control']
+
+def test_appointment_api_etag_and_long_poll(client):
+    """Test the JSON appointment list answers 304 for a known ETag, waits with ?wait and sees new bookings"""
+    assert client.get('/api/appointments').status_code == 400
+
+    with app.app_context():
+        db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Api', 'User', 'api@example.com', '1234567890', 'x', 'x', 'F')")
+        db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Poll', 'Doc', 'poll@example.com', 'x', 'x')")
+    doctor_directory.bump()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'patient'
+
+    response = client.get('/api/appointments')
+    assert response.status_code == 200
+    assert response.get_json() == {'appointments': []}
+    etag = response.headers['ETag']
+
+    assert client.get('/api/appointments', headers={'If-None-Match': etag}).status_code == 304
+    response = client.get('/api/appointments?wait=0.2', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+    # With every waiting place taken, a poll is answered at once instead of holding its thread
+    app.config['API_MAX_WAITERS'] = 0
+    try:
+        response = client.get('/api/appointments?wait=5', headers={'If-None-Match': etag})
+        assert response.status_code == 304 and response.headers['Retry-After'] == '1'
+        assert response.headers['ETag'] == etag
+    finally:
+        app.config['API_MAX_WAITERS'] = 4
+
+    client.post('/pbook', data={'doctor': '1', 'date': '2024-01-01', 'time': '10:00'})
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'patient'
+    response = client.get('/api/appointments?wait=5', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.get_json()['appointments'][0]['doctor'] == 'Poll Doc'
+
+    # A booking made by this process wakes a waiting poll without waiting for the next version check
+    etag = response.headers['ETag']
+    app.config['API_POLL_INTERVAL'] = 30
+    try:
+        answers = []
+        poller = app.test_client()
+        with poller.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['role'] = 'patient'
+        waiting = threading.Thread(target=lambda: answers.append(
+            poller.get('/api/appointments?wait=5', headers={'If-None-Match': etag})))
+        started = time.monotonic()
+        waiting.start()
+        time.sleep(0.2)
+        assert list(feed.polls.watches) == [('patient', 1)]
+        client.post('/pbook', data={'doctor': '1', 'date': '2024-01-01', 'time': '11:00'})
+        waiting.join()
+        # Nobody is polling any more, so nothing is kept for the list
+        assert feed.polls.watches == {}
+        assert answers[0].status_code == 200 and time.monotonic() - started < 4
+        assert len(answers[0].get_json()['appointments']) == 2
+    finally:
+        app.config['API_POLL_INTERVAL'] = 1.0
+
+    with client.session_transaction() as sess:
+        sess['role'] = 'doctor'
+    response = client.get('/api/doctor/appointments')
+    assert response.get_json()['appointments'][0]['fname'] == 'Api'
+
+def test_search_patients_and_doctors(client):
+    """Test prefix search finds patients and doctors by name, email or contact, including rows added later"""
+    with app.app_context():
+        db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Annabel', 'Smith', 'annabel@example.com', '5551234', 'x', 'x', 'F')")
+        db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Bob', 'Annan', 'bob@example.com', '9990000', 'x', 'x', 'M')")
+        db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Meredith', 'Grey', 'grey@example.com', 'x', 'x')")
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'admin'
+
+    response = client.get('/search?kind=patients&q=ann')
+    assert b'annabel@example.com' in response.data and b'bob@example.com' in response.data
+    response = client.get('/search?kind=patients&q=ann+555')
+    assert b'annabel@example.com' in response.data and b'bob@example.com' not in response.data
+    assert b'grey@example.com' in client.get('/search?kind=doctors&q=grey%40ex').data
+    assert b'No patients match' in client.get('/search?kind=patients&q=%22%29+OR+*').data
+    # One-letter words have no prefix index to use, so they are left out of the query
+    response = client.get('/search?kind=patients&q=ann+b')
+    assert b'annabel@example.com' in response.data and b'bob@example.com' in response.data
+    assert b'No patients match' in client.get('/search?kind=patients&q=a').data
+
+def test_admin_dashboard_counts(client):
+    """Test registrations, doctor additions and bookings are counted on the admin dashboard as they happen"""
+    client.post('/pregister', data={
+        'firstName': 'Count',
+        'lastName': 'Me',
+        'email': 'count@example.com',
+        'contact': '1234567890',
+        'password': 'secret',
+        'confirmation': 'secret',
+        'gender': 'F'
+    })
+    with client.session_transaction() as sess:
+        sess['role'] = 'admin'
+    client.post('/add', data={
+        'fname': 'Cristina',
+        'lname': 'Yang',
+        'email': 'yang@example.com',
+        'password': 'secret',
+        'confirmation': 'secret'
+    })
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'patient'
+    today = datetime.date.today().isoformat()
+    client.post('/pbook', data={'doctor': '1', 'date': today, 'time': '09:00'})
+
+    with app.app_context():
+        totals = {row['name']: row['count'] for row in db.execute("SELECT name, count FROM totals")}
+        weeks = db.execute("SELECT kind, count FROM weekly_registrations ORDER BY kind")
+    assert totals == {'patients': 1, 'doctors': 1, 'appointments': 1}
+    assert [(row['kind'], row['count']) for row in weeks] == [('doctors', 1), ('patients', 1)]
+
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'admin'
+    response = client.get('/adashboard')
+    assert b'Cristina Yang' in response.data
+    assert b'<h3>1</h3>Appointments' in response.data
+
+def test_archived_appointments_shown_only_with_history(client):
+    """Test archived appointments leave the listings but come back with ?history=1 and stay counted"""
+    with app.app_context():
+        db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Old', 'Timer', 'old@example.com', '1234567890', 'x', 'x', 'M')")
+        db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Arch', 'Ive', 'archive@example.com', 'x', 'x')")
+        db.execute("INSERT INTO appointment (user_id, doctor_id, doctor, date, time) VALUES (1, 1, 'Arch Ive', '2020-01-06', '09:00')")
+        db.execute("INSERT INTO appointment (user_id, doctor_id, doctor, date, time) VALUES (1, 1, 'Arch Ive', '2030-01-07', '09:00')")
+    assert archive(app.config['DATABASE'], '2025-01-01', batch=1, pause=0) == 1
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+
+    for route, role in (('/pview', 'patient'), ('/dview', 'doctor'), ('/vapp', 'admin')):
+        with client.session_transaction() as sess:
+            sess['role'] = role
+        response = client.get(route)
+        assert b'2030-01-07' in response.data and b'2020-01-06' not in response.data
+        response = client.get(route + '?history=1')
+        assert b'2030-01-07' in response.data and b'2020-01-06' in response.data
+
+    with app.app_context():
+        assert db.execute("SELECT count FROM totals WHERE name = 'appointments'")[0]['count'] == 2
+
+    # An archived slot is still taken, though it has left appointment and its unique index
+    with client.session_transaction() as sess:
+        sess['role'] = 'patient'
+    slot_index.clear()
+    assert client.post('/pbook', data={'doctor': '1', 'date': '2020-01-06', 'time': '09:00'}).status_code == 409
+
+def test_prefork_server_serves_and_reloads(client):
+    """Test serve.py answers from a forked worker, keeps answering across a reload and stops cleanly"""
+    server = subprocess.Popen([sys.executable, 'serve.py', '--host', '127.0.0.1', '--port', '0', '--workers', '1', '--threads', '2'],
+                              env=dict(os.environ, DATABASE=app.config['DATABASE'],
+                                       SESSION_SQLITE_PATH=app.config['SESSION_SQLITE_PATH']), stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline().split(':')[1].split()[0])
+
+        def get(path):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', path)
+            return conn.getresponse().status
+
+        assert get('/patient') == 200
+        server.send_signal(signal.SIGHUP)
+        assert get('/patient') == 200
+        assert server.stdout.readline().startswith('Serving on')
+        assert get('/patient') == 200
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=30) == 0
+
+def test_busy_worker_leaves_connections_to_others(client):
+    """Test a serve.py worker with every thread busy does not accept another connection"""
+    import socket
+    import threading
+    import serve
+    entered, release = threading.Event(), threading.Event()
+
+    def slow(environ, start_response):
+        entered.set()
+        release.wait(10)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'done']
+    listener = socket.create_server(('127.0.0.1', 0))
+    server = serve.PooledWSGIServer(slow, listener.fileno(), 1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        first = socket.create_connection(listener.getsockname(), timeout=10)
+        first.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        assert entered.wait(10)
+        second = socket.create_connection(listener.getsockname(), timeout=10)
+        second.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        time.sleep(0.3)
+        # Still in the backlog, where a sibling worker could accept it
+        listener.settimeout(1)
+        accepted, _ = listener.accept()
+        accepted.close()
+        second.close()
+        release.set()
+        assert first.recv(1024).startswith(b'HTTP/1.0 200')
+        first.close()
+    finally:
+        release.set()
+        server.shutdown()
+        server.pool.shutdown(wait=True)
+        server.server_close()
+        listener.close()
+
+def test_prefork_workers_see_doctors_added_elsewhere(client, tmp_path):
+    """Test a doctor imported from the command line shows up on the booking form of every serve.py worker"""
+    with app.app_context():
+        db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Pre', 'Fork', 'prefork@example.com', '1234567890', 'x', ?, 'F')",
+                   generate_password_hash('pw', 'pbkdf2:sha256:1000'))
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, DATABASE=app.config['DATABASE'], PYTHONPATH=here)
+    server = subprocess.Popen([sys.executable, os.path.join(here, 'serve.py'), '--host', '127.0.0.1', '--port', '0', '--workers', '2', '--threads', '2'],
+                              cwd=tmp_path, env=env, stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(server.stdout.readline().split(':')[1].split()[0])
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        conn.request('POST', '/plogin', 'email=prefork%40example.com&password=pw', {'Content-Type': 'application/x-www-form-urlencoded'})
+        cookie = conn.getresponse().getheader('Set-Cookie').split(';')[0]
+
+        def booking_forms(count=10):
+            forms = []
+            for _ in range(count):
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                conn.request('GET', '/pbook', headers={'Cookie': cookie})
+                forms.append(conn.getresponse().read())
+            return forms
+
+        assert not any(b'Roster Added' in form for form in booking_forms())
+        (tmp_path / 'doctors.csv').write_text("fname,lname,email,password\nRoster,Added,roster@example.com,secret\n")
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'import-data', 'doctors', str(tmp_path / 'doctors.csv')],
+                       cwd=tmp_path, env=env, check=True, capture_output=True)
+        assert all(b'Roster Added' in form for form in booking_forms())
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=30) == 0
+        if os.path.exists(app.config['DATABASE'] + '-doctors'):
+            os.unlink(app.config['DATABASE'] + '-doctors')
+
+def test_prefork_workers_share_hashing_cpus(client, monkeypatch):
+    """Test serve.py splits the CPUs between its workers' hashing pools unless HASH_WORKERS is set"""
+    import serve
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    monkeypatch.delenv('HASH_WORKERS', raising=False)
+    config = {}
+    serve.share_cpus(config, 4)
+    assert config == {'HASH_WORKERS': 2, 'HASH_QUEUE_LIMIT': 8, 'HASH_IMPORT_SLOTS': 2}
+    serve.share_cpus(config, 16)
+    assert config['HASH_WORKERS'] == 1
+
+    monkeypatch.setenv('HASH_WORKERS', '3')
+    config = {}
+    serve.share_cpus(config, 4)
+    assert config == {}
+
+def scratch_env(tmp_path):
+    """Environment for a subprocess that builds the app on copies of the databases in tmp_path."""
+    subprocess.run(['cp', 'patients.db', str(tmp_path / 'patients.db')], check=True)
+    return dict(os.environ, DATABASE=str(tmp_path / 'patients.db'), SESSION_SQLITE_PATH=str(tmp_path / 'sessions.db'))
+
+def test_app_import_defers_heavy_modules(client, tmp_path):
+    """Test importing app leaves asyncio, multiprocessing and requests unloaded, and create_app() applies its config"""
+    script = ("import sys, app\n"
+              "print(sorted(name for name in ('asyncio', 'multiprocessing', 'requests') if name in sys.modules))\n"
+              "with app.create_app({'SLOT_MINUTES': 30}).app_context():\n"
+              "    print(app.slot_index.count)\n")
+    output = subprocess.run([sys.executable, '-c', script], env=scratch_env(tmp_path),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.split() == ['[]', '24']
+
+def test_create_app_twice(client, tmp_path):
+    """Test a second create_app() leaves the first app on its own settings and metrics and instruments each query once"""
+    script = ("import app\n"
+              "first = app.create_app({'METRICS_ENABLED': True})\n"
+              "second = app.create_app({'METRICS_ENABLED': True, 'HTTP_CACHE': False})\n"
+              "for built in (first, second):\n"
+              "    with built.test_client() as client:\n"
+              "        with client.session_transaction() as sess:\n"
+              "            sess['user_id'] = 1\n"
+              "            sess['role'] = 'admin'\n"
+              "        client.get('/plist')\n"
+              "        print(client.get('/').headers['Cache-Control'])\n"
+              "second.test_client().get('/patient')\n"
+              "print([line for line in first.test_client().get('/metrics').text.splitlines()\n"
+              "       if line.startswith(('db_queries_per_request_sum{route=\"plist\"}', 'http_requests_total{route=\"patient\"'))])\n")
+    output = subprocess.run([sys.executable, '-c', script], env=scratch_env(tmp_path),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.splitlines() == ['no-cache', 'no-cache, no-store, must-revalidate',
+                                   '[\'db_queries_per_request_sum{route="plist"} 1\']']
+
+def test_apps_keep_their_own_settings_and_state(client, tmp_path):
+    """Test two apps built with different settings each read their own and keep their own slots, roster and hash queue"""
+    env = scratch_env(tmp_path)
+    script = ("import app, os, sys\n"
+              "tmp = sys.argv[1]\n"
+              "apps = [app.create_app({'DATABASE': os.path.join(tmp, 'patients.db'),\n"
+              "                        'SESSION_SQLITE_PATH': os.path.join(tmp, f'sessions{n}.db'),\n"
+              "                        'DOCTOR_VERSION_FILE': os.path.join(tmp, f'doctors{n}'),\n"
+              "                        'SLOT_MINUTES': minutes, 'HASH_WORKERS': 0, 'HASH_QUEUE_LIMIT': n + 1})\n"
+              "        for n, minutes in enumerate((30, 60))]\n"
+              "for built in apps:\n"
+              "    with built.app_context():\n"
+              "        app.slot_index.reserve(app.db, 1, '2030-01-01', 0)\n"
+              "        app.doctor_directory.bump()\n"
+              "        print(app.slot_index.count, len(app.slot_index.days), app.hasher.start().slots._value,\n"
+              "              os.path.exists(os.path.join(tmp, 'doctors0')), os.path.exists(os.path.join(tmp, 'doctors1')))\n")
+    output = subprocess.run([sys.executable, '-c', script, str(tmp_path)], env=env,
+                            capture_output=True, text=True, check=True).stdout
+    assert output.splitlines() == ['24 1 1 True False', '12 1 2 True True']
+
+def test_queued_bookings_pending_until_committed(client):
+    """Test queued bookings show as pending, commit in one batch, report lost slots once and replay from a dead process's journal"""
+    journal_dir = tempfile.mkdtemp()
+    app.config.update(BOOKING_QUEUE=True, BOOKING_FLUSH_INTERVAL=60,
+                      BOOKING_JOURNAL=os.path.join(journal_dir, 'bookings.journal'))
+    try:
+        with app.app_context():
+            db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Queue', 'Patient', 'queue@example.com', '1234567890', 'x', 'x', 'F')")
+            db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Write', 'Behind', 'wb@example.com', 'x', 'x')")
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['role'] = 'patient'
+        for time in ('09:00', '09:15'):
+            response = client.post('/pbook', data={'doctor': '1', 'date': '2030-05-01', 'time': time})
+            assert response.status_code == 302
+
+        response = client.get('/pview')
+        assert response.data.count(b'(pending)') == 2
+        with app.app_context():
+            assert db.execute("SELECT COUNT(*) AS n FROM appointment")[0]['n'] == 0
+            # Another process takes one of the slots before the writer gets to it
+            db.execute("INSERT INTO appointment (user_id, doctor_id, doctor, date, time) VALUES (2, 1, 'Write Behind', '2030-05-01', '09:15')")
+
+        assert booking_queue.flush() == 2
+        response = client.get('/pview')
+        assert b'(pending)' not in response.data
+        assert b'09:00' in response.data and b'could not be made' in response.data
+        # Told once
+        assert b'could not be made' not in client.get('/pview').data
+
+        # A crashed process's journal, with a booking it had already committed, one that lost its slot and a torn last line
+        with open(os.path.join(journal_dir, 'bookings.journal.999999'), 'w') as f:
+            f.write('{"user_id": 1, "doctor_id": 1, "doctor": "Write Behind", "date": "2030-05-01", "time": "09:00"}\n')
+            f.write('{"user_id": 1, "doctor_id": 1, "doctor": "Write Behind", "date": "2030-05-02", "time": "09:00"}\n')
+            f.write('{"user_id": 1, "doctor_id": 1, "doctor": "Write Behind", "date": "2030-05-01", "time": "09:15"}\n')
+            f.write('{"user_id": 1, "doc')
+        # Left alone while another process holds it for replaying
+        with open(os.path.join(journal_dir, 'bookings.journal.999999')) as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            assert booking_queue.recover() == 0
+        assert booking_queue.recover() == 3
+        assert not os.path.exists(os.path.join(journal_dir, 'bookings.journal.999999'))
+        with app.app_context():
+            rows = db.execute("SELECT date, time FROM appointment WHERE user_id = 1 ORDER BY date")
+        assert rows == [{'date': '2030-05-01', 'time': '09:00'}, {'date': '2030-05-02', 'time': '09:00'}]
+        # The patient hears about the replayed booking that lost its slot, though this process never queued it
+        response = client.get('/pview')
+        assert response.data.count(b'could not be made') == 1 and b'at 09:15 could not be made' in response.data
+    finally:
+        booking_queue.close()
+        app.config['BOOKING_QUEUE'] = False
+
+def test_booking_queues_kept_per_app(client, tmp_path):
+    """Test a second app's queued bookings are pending only there and commit to its own database"""
+    with app.app_context():
+        db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Two', 'Apps', 'two@example.com', '1234567890', 'x', 'x', 'F')")
+        db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Own', 'Queue', 'own@example.com', 'x', 'x')")
+    other = str(tmp_path / 'other.db')
+    source, copy = sqlite3.connect(app.config['DATABASE']), sqlite3.connect(other)
+    source.backup(copy)
+    source.close()
+    copy.close()
+    second = create_app({'DATABASE': other, 'SESSION_SQLITE_PATH': str(tmp_path / 'sessions.db'),
+                         'DOCTOR_VERSION_FILE': str(tmp_path / 'doctors'), 'HASH_WORKERS': 0,
+                         'BOOKING_QUEUE': True, 'BOOKING_FLUSH_INTERVAL': 60,
+                         'BOOKING_JOURNAL': str(tmp_path / 'bookings.journal')})
+    try:
+        with second.test_client() as queued:
+            with queued.session_transaction() as sess:
+                sess['user_id'] = 1
+                sess['role'] = 'patient'
+            assert queued.post('/pbook', data={'doctor': '1', 'date': '2030-07-01', 'time': '09:00'}).status_code == 302
+        with second.app_context():
+            assert len(booking_queue.pending_for(1)) == 1
+        assert booking_queue.pending_for(1) == [] and booking_queue.flush() == 0
+        assert booking_queue.flush(second) == 1
+        with second.app_context():
+            assert db.execute("SELECT time FROM appointment") == [{'time': '09:00'}]
+        assert db.execute("SELECT time FROM appointment") == []
+    finally:
+        booking_queue.close(second)
+        second.extensions['database'].close()
+
+def test_journals_replayed_whatever_their_pid(client):
+    """Test journals no writer holds are replayed even when their pid is this process's or another live one's"""
+    journal_dir = tempfile.mkdtemp()
+    app.config.update(BOOKING_QUEUE=True, BOOKING_FLUSH_INTERVAL=60,
+                      BOOKING_JOURNAL=os.path.join(journal_dir, 'bookings.journal'))
+    try:
+        with app.app_context():
+            db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Pid', 'Reuse', 'pid@example.com', '1234567890', 'x', 'x', 'F')")
+            db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Crash', 'Test', 'crash@example.com', 'x', 'x')")
+        # Left by a crashed process whose pid this process now has, and by one whose pid a live process has
+        for name, time in ((f'bookings.journal.{os.getpid()}', '09:00'), (f'bookings.journal.{os.getppid()}-0123456789ab', '09:15')):
+            with open(os.path.join(journal_dir, name), 'w') as f:
+                f.write(f'{{"user_id": 1, "doctor_id": 1, "doctor": "Crash Test", "date": "2030-06-01", "time": "{time}"}}\n')
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['role'] = 'patient'
+        assert client.post('/pbook', data={'doctor': '1', 'date': '2030-06-01', 'time': '09:30'}).status_code == 302
+        assert booking_queue.flush() == 1
+        with app.app_context():
+            rows = db.execute("SELECT time FROM appointment WHERE user_id = 1 ORDER BY time")
+        assert [row['time'] for row in rows] == ['09:00', '09:15', '09:30']
+        # Only this process's own journal is left, and it stays locked while the writer runs
+        [journal] = os.listdir(journal_dir)
+        with open(os.path.join(journal_dir, journal)) as f:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        assert booking_queue.recover() == 0
+    finally:
+        booking_queue.close()
+        app.config['BOOKING_QUEUE'] = False
+    assert os.listdir(journal_dir) == []
+    os.rmdir(journal_dir)
+
+def test_dashboard_greeting_cached_from_login(client):
+    """Test dashboards greet the user with the name cached at login until it is forgotten"""
+    with app.app_context():
+        db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Meredith', 'Grey', 'grey@example.com', 'x', ?)", generate_password_hash('pw'))
+    client.post('/doctor', data={'email': 'grey@example.com', 'password': 'pw'})
+    with app.app_context():
+        db.execute("UPDATE doctors SET fname = 'Ellis' WHERE id = 1")
+    assert b'Meredith Grey' in client.get('/ddashboard').data
+
+    profile_cache.forget("doctor", 1)
+    assert b'Ellis Grey' in client.get('/ddashboard').data
+
+def test_routes_require_their_role(client, monkeypatch):
+    """Test each page admits only its role and turns others away before any route SQL"""
+    with app.app_context():
+        db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Role', 'Patient', 'role@example.com', '1234567890', 'x', 'x', 'F')")
+        db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Role', 'Doctor', 'roledoc@example.com', 'x', 'x')")
+    assert client.get('/pview').status_code == 400
+
+    allowed = {'patient': '/pview', 'doctor': '/dview', 'admin': '/vapp'}
+    for role in allowed:
+        with client.session_transaction() as sess:
+            sess['user_id'] = 1
+            sess['role'] = role
+        assert client.get(allowed[role]).status_code == 200
+        with monkeypatch.context() as patch:
+            patch.setattr(db, 'execute', lambda *args: pytest.fail('route SQL ran for a refused request'))
+            for other, route in allowed.items():
+                if other != role:
+                    assert client.get(route).status_code == 403
+
+def test_login_attempts_rate_limited(client, monkeypatch):
+    """Test login attempts beyond an account's allowance get a 429 before any SQL or hashing, per process or shared"""
+    with app.app_context():
+        db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash) VALUES (?, ?, ?, ?, ?, ?)",
+                   'Test', 'User', 'test@example.com', '1234567890', 'pw', generate_password_hash('pw'))
+    fd, shared = tempfile.mkstemp()
+    os.close(fd)
+    monkeypatch.setitem(app.config, 'LOGIN_LIMIT_ACCOUNT_BURST', 2)
+    try:
+        for path in (None, shared):
+            monkeypatch.setitem(app.config, 'LOGIN_LIMIT_DB', path)
+            login_limiter.clear()
+            for _ in range(2):
+                assert client.post('/plogin', data={'email': 'test@example.com', 'password': 'wrong'}).status_code == 403
+            execute = db.execute
+            monkeypatch.setattr(db, 'execute', lambda *args: pytest.fail('queried a rate-limited login'))
+            response = client.post('/plogin', data={'email': 'Test@example.com', 'password': 'pw'})
+            assert response.status_code == 429
+            assert int(response.headers['Retry-After']) >= 1
+            monkeypatch.setattr(db, 'execute', execute)
+            # Other accounts, and the same address on them, are unaffected
+            assert client.post('/plogin', data={'email': 'other@example.com', 'password': 'pw'}).status_code == 403
+    finally:
+        login_limiter.close(app)
+        os.unlink(shared)
+
+def test_login_limit_by_forwarded_address(client):
+    """Test PROXY_HOPS limits logins by the client address the proxy forwarded, not the proxy's own"""
+    proxied = create_app({'DATABASE': app.config['DATABASE'], 'PROXY_HOPS': 1, 'LOGIN_LIMIT_IP_BURST': 1})
+    with proxied.test_client() as proxied_client:
+        def attempt(forwarded, email):
+            return proxied_client.post('/plogin', data={'email': email, 'password': 'pw'},
+                                       headers={'X-Forwarded-For': forwarded}).status_code
+        assert attempt('203.0.113.1', 'one@example.com') == 403
+        assert attempt('203.0.113.1', 'two@example.com') == 429
+        assert attempt('203.0.113.2', 'three@example.com') == 403
+        # Only the address the trusted proxy added counts, whatever the client put before it
+        assert attempt('198.51.100.9, 203.0.113.1', 'four@example.com') == 429
+
+def test_doctor_calendar_by_day_week_and_month(client):
+    """Test the calendar shows one doctor's day or week in time order, archived ones included, and a month as counts"""
+    with app.app_context():
+        db.execute("INSERT INTO users (fname, lname, mail, contact, password, hash, gender) VALUES ('Cal', 'Endar', 'cal@example.com', '1234567890', 'x', 'x', 'F')")
+        db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Day', 'Book', 'day@example.com', 'x', 'x')")
+        db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Other', 'Doc', 'other@example.com', 'x', 'x')")
+        for doctor, date, time in ((1, '2024-06-05', '14:00'), (1, '2024-06-03', '9:00'), (1, '2024-06-10', '10:00'),
+                                   (2, '2024-06-04', '11:00'), (1, '2024-05-31', '08:00')):
+            db.execute("INSERT INTO appointment (user_id, doctor_id, doctor, date, time) VALUES (1, ?, 'x', ?, ?)", doctor, date, time)
+        assert db.execute("SELECT starts FROM appointment WHERE id = 2")[0]['starts'] == '2024-06-03 09:00'
+    archive(app.config['DATABASE'], '2024-06-04', pause=0)
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'doctor'
+
+    week = client.get('/dcalendar?view=week&date=2024-06-06').data
+    assert b'9:00' in week and b'14:00' in week and b'11:00' not in week
+    assert b'10:00' not in week and b'08:00' not in week
+    assert week.index(b'9:00') < week.index(b'14:00')
+    assert b'1 of 48 slots booked' in week
+
+    day = client.get('/dcalendar?view=day&date=2024-06-05').data
+    assert b'14:00' in day and b'9:00' not in day
+
+    month = client.get('/dcalendar?view=month&date=2024-06-20').data
+    assert b'2024-06-30' in month and b'2024-05-31' not in month and b'14:00' not in month
+    assert month.count(b'1 of 48 slots booked') == 3
+
+    assert client.get('/dcalendar?view=year').status_code == 400
+    assert client.get('/dcalendar?date=June').status_code == 400
+    # Spans reaching past the last or first representable day are refused, not a server error
+    assert client.get('/dcalendar?view=day&date=9999-12-31').status_code == 400
+    assert client.get('/dcalendar?view=month&date=0001-01-05').status_code == 400
+
+    # A booking whose date was posted with stray spaces is still placed on the calendar and counted under its day
+    with client.session_transaction() as sess:
+        sess['role'] = 'patient'
+    assert client.post('/pbook', data={'doctor': '1', 'date': ' 2024-06-06 ', 'time': '9:30'}).status_code == 302
+    with app.app_context():
+        assert db.execute("SELECT starts FROM appointment ORDER BY id DESC LIMIT 1")[0]['starts'] == '2024-06-06 09:30'
+        assert db.execute("SELECT count FROM daily_appointments WHERE date = '2024-06-06' AND doctor_id = 1")[0]['count'] == 1
+    with client.session_transaction() as sess:
+        sess['role'] = 'doctor'
+    assert b'09:30' in client.get('/dcalendar?view=day&date=2024-06-06').data
+
+def test_admin_listings_read_the_report_snapshot(client, monkeypatch):
+    """Test admin listings come from a dated snapshot copy once REPORT_SNAPSHOT is set, until it is refreshed"""
+    with app.app_context():
+        db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('Snap', 'Shot', 'snap@example.com', 'x', 'x')")
+    folder = tempfile.mkdtemp()
+    monkeypatch.setitem(app.config, 'REPORT_SNAPSHOT', os.path.join(folder, 'reports.db'))
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['role'] = 'admin'
+    try:
+        response = client.get('/dlist')
+        assert b'snap@example.com' in response.data and b'copy of the data taken at' in response.data
+        with app.app_context():
+            db.execute("INSERT INTO doctors (fname, lname, email, password, hash) VALUES ('New', 'Comer', 'new@example.com', 'x', 'x')")
+        assert b'new@example.com' not in client.get('/dlist').data
+
+        # The snapshot is still fresh, but `flask snapshot` copies anyway
+        result = app.test_cli_runner().invoke(args=['snapshot'])
+        assert result.exit_code == 0 and 'Snapshot taken at' in result.output
+        assert b'new@example.com' in client.get('/dlist').data
+        assert b'new@example.com' in client.get('/dlist?all=1').data
+    finally:
+        report_snapshot.close()
+        for name in os.listdir(folder):
+            os.unlink(os.path.join(folder, name))
+        os.rmdir(folder)
+    monkeypatch.setitem(app.config, 'REPORT_SNAPSHOT', None)
+    assert b'new@example.com' in client.get('/dlist').data and b'copy of the data' not in client.get('/dlist').data
+
+def test_app_refuses_unmigrated_database(client):
+    """Test create_app() names the migrations a database is missing instead of failing on the first request"""
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        sqlite3.connect(path).execute("CREATE TABLE appointment (id INTEGER PRIMARY KEY)").connection.close()
+        with pytest.raises(RuntimeError, match='appointment_starts'):
+            create_app({'DATABASE': path})
+    finally:
+        os.unlink(path)
@@ -0,0 +1,71 @@
+"""
+Move past appointments out of the hot appointment table.
+
+Appointments dated more than --days ago are copied into appointment_archive
+and deleted from appointment, --batch rows per transaction, sleeping --pause
+seconds between batches so the app's writers are never held up for long.
+Listings read only appointment unless asked for history, so their cost
+follows upcoming appointments rather than everything ever booked. Run it
+from cron, e.g. nightly; it is safe to run while the server is up and to
+interrupt at any point.
+
+Usage: python archive.py [patients.db] [--days 365] [--batch 500] [--pause 0.05]
+"""
+import argparse
+import datetime
+import sqlite3
+import time
+
+from migrations import BUSY_TIMEOUT
+
+# Appointments older than this many days are archived
+ARCHIVE_DAYS = 365
+
+# Rows moved per transaction
+BATCH_SIZE = 500
+
+# Columns copied into appointment_archive, in order
+COLUMNS = "id, user_id, doctor_id, doctor, date, time, starts"
+
+
+def cutoff(days=ARCHIVE_DAYS, today=None):
+    """Return the first date, as YYYY-MM-DD, that stays in the hot table."""
+    return ((today or datetime.date.today()) - datetime.timedelta(days=days)).isoformat()
+
+
+def archive(path, before, batch=BATCH_SIZE, pause=0.05):
+    """Move appointments dated before the given date into appointment_archive, returning how many moved."""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    moved = 0
+    try:
+        while True:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [row[0] for row in conn.execute(
+                    "SELECT id FROM appointment WHERE date < ? LIMIT ?", (before, batch))]
+                marks = ",".join("?" * len(ids))
+                if ids:
+                    conn.execute(f"INSERT INTO appointment_archive({COLUMNS}) "
+                                 f"SELECT {COLUMNS} FROM appointment WHERE id IN ({marks})", ids)
+                    conn.execute(f"DELETE FROM appointment WHERE id IN ({marks})", ids)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            moved += len(ids)
+            if len(ids) < batch:
+                return moved
+            time.sleep(pause)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive past appointments.")
+    parser.add_argument("database", nargs="?", default="patients.db")
+    parser.add_argument("--days", type=int, default=ARCHIVE_DAYS, help="keep appointments from this many days back")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="rows moved per transaction")
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds to sleep between batches")
+    args = parser.parse_args()
+    before = cutoff(args.days)
+    print(f"Archived {archive(args.database, before, args.batch, args.pause)} appointments before {before}")
@@ -0,0 +1,1222 @@
+"""
+Benchmarks against throwaway, synthetic copies of patients.db.
+
+    python benchmark.py listing [appointments ...]
+        Times the old per-appointment lookups against the joined query in
+        queries.py as the appointment count grows, and the joined query for
+        one doctor who has every appointment, as in dview.
+
+    python benchmark.py concurrency [--threads 1 2 4 8] [--seconds 3]
+        Runs a mixed read/write workload through database.Database from
+        several threads and reports throughput and lock errors.
+
+    python benchmark.py booking [--requests 400] [--threads 100]
+        Fires concurrent /pbook posts at a handful of slots and checks that
+        no slot ends up booked twice.
+
+    python benchmark.py login [--workers 0 1 2] [--threads 8] [--seconds 5]
+        Runs a login storm with password hashing inline (0) or in a pool of
+        N processes, reporting logins/s per core and the latency of a
+        cheap page served alongside it.
+
+    python benchmark.py routes [--scale 1000] [--requests 200] [--server]
+                               [--save-baseline FILE] [--baseline FILE] [--tolerance 0.25]
+        Seeds --scale patients and appointments, then drives every route
+        through the Flask test client (or a local threaded WSGI server with
+        --server), reporting p50/p99 latency and requests/s per route. With
+        --baseline it exits non-zero if any route's p50 regressed by more
+        than --tolerance against the saved results.
+
+    python benchmark.py templates [--requests 500]
+        Compares auto-reloaded templates (FLASK_DEBUG=1) with precompiled
+        templates and the render cache: app import time and first render in
+        a fresh process, then p50/p99 render latency of /, /patient and
+        /pbook.
+
+    python benchmark.py caching [--visits 5]
+        Browses the public pages like a browser with a cache, fetching
+        every /static/ file a page links to, and reports requests and bytes
+        per page load with no-store everywhere and with the per-route
+        caching policy in httpcache.py.
+
+    python benchmark.py polling [--pollers 50 200] [--seconds 5]
+        Holds N long-polling clients on one doctor's /api list through one
+        serve.py worker with its default 8 threads and the shipped
+        API_MAX_WAITERS, while appointments are added behind the app's back.
+        Reports how long pollers take to see a change, how many polls were
+        shed to Retry-After, and how many SQLite queries were needed per poll
+        answered.
+
+    python benchmark.py search [patients ...]
+        Times prefix lookups through the full-text index against LIKE
+        scans over the same columns as the patient count grows, along with
+        how long the index backfill takes.
+
+    python benchmark.py dashboard [appointments ...]
+        Times the admin dashboard's reads from the aggregate tables against
+        computing the same counts from appointment on demand.
+
+    python benchmark.py archive [appointments ...] [--keep-days 7]
+        Times /dview, /pview, /vapp and the doctor API before and after
+        archive.py moves all but the last --keep-days of appointments out
+        of the hot table, as total history grows.
+
+    python benchmark.py calendar [appointments ...]
+        Times one doctor's week in the calendar, read by range scans over
+        the starts index, and a month of per-day counts, against reading and
+        filtering the doctor's whole history, as appointments grow.
+
+    python benchmark.py reports [--appointments 200000] [--readers 2] [--seconds 10]
+        Books fresh slots from one process while --readers processes stream
+        the full /vapp report, first with no reports, then read from the
+        live database and then from a REPORT_SNAPSHOT copy refreshed every
+        second. Reports booking commit latency, reports read and how large
+        the live database's WAL grew.
+
+    python benchmark.py prefork [--workers 1 2 4] [--clients 8] [--seconds 5]
+        Starts serve.py against a scratch database with each worker count
+        and drives the read routes from --clients client processes,
+        reporting requests/s and how it scales with workers.
+
+    python benchmark.py spike [--requests 2000] [--clients 16] [--workers 4]
+        Starts serve.py with --workers workers and fires --requests bookings
+        for distinct slots from --clients client processes at once, first
+        with each booking inserted by its own request and then through the
+        write-behind queue in bookings.py. Reports bookings/s, request
+        latency and the time until every booking is committed.
+
+    python benchmark.py imports [--budget-ms 250] [--runs 5]
+        Imports app in fresh interpreters under -X importtime and lists the
+        slowest modules it imports directly. Exits non-zero if the best run
+        took longer than --budget-ms, so a new heavy import fails CI.
+
+    python benchmark.py stuffing [--attackers 8] [--addresses 4] [--rate 200] [--seconds 20] [--workers 2]
+        Starts serve.py and has --attackers client processes, sharing
+        --addresses source addresses, post about --rate wrong passwords a
+        second for real accounts while one user signs in to other accounts
+        about five times a second.
+        Runs with no login limit, with per-process buckets and with the
+        shared LOGIN_LIMIT_DB table, reporting the user's login latency and
+        how many attacks were hashed, limited (429) or shed (503).
+
+    python benchmark.py auth [--requests 20000]
+        Times a bare view against the same view behind @requires, for a
+        signed-in patient, a refused doctor and a signed-out visitor, all in
+        request contexts with no database, so the difference is the
+        decorator's per-request overhead.
+"""
+import argparse
+import http.client
+import io
+import json
+import multiprocessing
+import signal
+import datetime
+import itertools
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from contextlib import contextmanager
+
+from database import Database
+import migrations
+from migrations import migrate
+from queries import appointments_with_patients, search
+
+SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, fname TEXT NOT NULL, lname TEXT NOT NULL, mail TEXT NOT NULL UNIQUE, contact TEXT NOT NULL, password TEXT NOT NULL, hash TEXT NOT NULL, doctor TEXT, gender TEXT NOT NULL);
+CREATE TABLE doctors (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, fname TEXT NOT NULL, lname TEXT NOT NULL, password TEXT NOT NULL, hash TEXT NOT NULL, email TEXT NOT NULL UNIQUE);
+CREATE TABLE appointment (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, user_id INTEGER NOT NULL, doctor TEXT NOT NULL, date TEXT NOT NULL, time TEXT NOT NULL);
+CREATE TABLE admin (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, username TEXT NOT NULL, password TEXT NOT NULL, hash TEXT NOT NULL);
+"""
+
+
+def slot_at(k, start=datetime.date(2024, 1, 1)):
+    """Return the (date, time) of the k-th 15-minute slot between 06:00 and 18:00 from start."""
+    date = start + datetime.timedelta(days=k // 48)
+    minutes = 6 * 60 + k % 48 * 15
+    return date.isoformat(), f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def seed(path, appointments, users=None, doctors=20, password_hash="x"):
+    """
+    Create a patients.db-compatible database with synthetic rows.
+
+    Appointments are spread over consecutive 15-minute slots, round-robin
+    across doctors, so no slot is booked twice. Every account gets
+    password_hash; patients sign in as patient<i>@example.com.
+    """
+    users = users or max(1, appointments // 4)
+    rng = random.Random(0)
+
+    def appointment(k):
+        doctor = k % doctors
+        return (rng.randint(1, users), f"Doc{doctor} Tor{doctor}") + slot_at(k // doctors)
+
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.executemany(
+        "INSERT INTO users(fname,lname,mail,contact,password,hash,gender) VALUES(?,?,?,?,?,?,?)",
+        ((f"First{i}", f"Last{i}", f"patient{i}@example.com", f"555{i:07d}", "x", password_hash, "N/A") for i in range(users)))
+    conn.executemany(
+        "INSERT INTO doctors(fname,lname,email,password,hash) VALUES(?,?,?,?,?)",
+        ((f"Doc{i}", f"Tor{i}", f"doctor{i}@example.com", "x", password_hash) for i in range(doctors)))
+    conn.execute("INSERT INTO admin(username,password,hash) VALUES('admin','x',?)", (password_hash,))
+    conn.executemany(
+        "INSERT INTO appointment(user_id,doctor,date,time) VALUES(?,?,?,?)",
+        (appointment(k) for k in range(appointments)))
+    conn.commit()
+    conn.close()
+    migrate(path)
+
+
+def per_row_lookups(db):
+    """The listing as vapp() used to build it: one users query per appointment."""
+    data = []
+    for i in db.execute("SELECT user_id,doctor,date,time FROM appointment"):
+        patients = db.execute("SELECT fname,lname,mail,contact FROM users WHERE id=?", i["user_id"])
+        if len(patients) > 0:
+            data.append(dict(patients[0], doctor=i["doctor"], date=i["date"], time=i["time"]))
+    return data
+
+
+def timed(fn):
+    """Return (rows, seconds) for one call of fn."""
+    start = time.perf_counter()
+    rows = sum(1 for _ in fn())
+    return rows, time.perf_counter() - start
+
+
+@contextmanager
+def scratch_db(appointments, **kwargs):
+    """Yield the path of a seeded temporary database, removing it afterwards."""
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        seed(path, appointments, **kwargs)
+        yield path
+    finally:
+        for suffix in ("", "-wal", "-shm", "-doctors", "-sessions", "-sessions-wal", "-sessions-shm"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+
+def listing(sizes):
+    """Compare per-row lookups with the joined listing, and time one doctor's listing, at each appointment count."""
+    print(f"{'appointments':>12} {'n+1 ms':>10} {'join ms':>10} {'n+1 us/row':>11} {'join us/row':>12} "
+          f"{'doctor ms':>10} {'doctor us/row':>14}")
+    for size in sizes:
+        with scratch_db(size) as path:
+            db = Database(path=path)
+            rows, old = timed(lambda: per_row_lookups(db))
+            rows, new = timed(lambda: appointments_with_patients(db))
+            db.close()
+        with scratch_db(size, doctors=1) as path:
+            db = Database(path=path)
+            doctor_rows, doctor = timed(lambda: appointments_with_patients(db, doctor_id=1))
+            db.close()
+        print(f"{size:>12} {old * 1000:>10.1f} {new * 1000:>10.1f} "
+              f"{old / rows * 1e6:>11.1f} {new / rows * 1e6:>12.1f} "
+              f"{doctor * 1000:>10.1f} {doctor / doctor_rows * 1e6:>14.1f}")
+
+
+def worker(db, users, deadline, counts, slots):
+    """Mix pview()-style reads with pbook()-style inserts into fresh slots until the deadline."""
+    rng = random.Random(threading.get_ident())
+    ops = errors = 0
+    while time.perf_counter() < deadline:
+        try:
+            if rng.random() < 0.1:
+                db.execute("INSERT INTO appointment(user_id,doctor_id,doctor,date,time) VALUES(?,?,?,?,?)",
+                           rng.randint(1, users), 1, "Doc0 Tor0", *slot_at(next(slots), datetime.date(2030, 1, 1)))
+            else:
+                db.execute("SELECT doctor,date,time FROM appointment WHERE user_id=?", rng.randint(1, users))
+            ops += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    db.close()
+    counts.append((ops, errors))
+
+
+def concurrency(threads, seconds, appointments=50000):
+    """Report workload throughput for each thread count."""
+    print(f"{'threads':>7} {'ops/s':>10} {'locked':>7}")
+    with scratch_db(appointments) as path:
+        users = max(1, appointments // 4)
+        for n in threads:
+            db = Database(path=path, timeout=5)
+            counts = []
+            deadline = time.perf_counter() + seconds
+            slots = itertools.count(n * 10 ** 6)
+            pool = [threading.Thread(target=worker, args=(db, users, deadline, counts, slots)) for _ in range(n)]
+            for t in pool:
+                t.start()
+            for t in pool:
+                t.join()
+            print(f"{n:>7} {sum(c[0] for c in counts) / seconds:>10.0f} {sum(c[1] for c in counts):>7}")
+
+def bench_app(path):
+    """Point the app at a scratch database, with cookie sessions so runs leave no session files."""
+    from flask.sessions import SecureCookieSessionInterface
+    from app import app, slot_index
+    app.config["DATABASE"] = path
+    # Roster bumps and any session file go beside the scratch copy, never next to the live database
+    app.config["DOCTOR_VERSION_FILE"] = path + "-doctors"
+    app.config["SESSION_SQLITE_PATH"] = path + "-sessions"
+    app.secret_key = "benchmark"
+    app.session_interface = SecureCookieSessionInterface()
+    # Every benchmark client shares one address; the limiter is measured on its own by the stuffing benchmark
+    app.config["LOGIN_LIMIT"] = False
+    with app.app_context():
+        slot_index.clear()
+    return app
+
+
+def booking(requests, threads, doctors=5, slots=4):
+    """Race concurrent bookings for doctors * slots slots and count double bookings."""
+    with scratch_db(0, users=requests, doctors=doctors) as path:
+        app = bench_app(path)
+        times = [f"{9 + i // 4:02d}:{i % 4 * 15:02d}" for i in range(slots)]
+        jobs = [(i + 1, i % doctors + 1, times[i // doctors % slots]) for i in range(requests)]
+        statuses = []
+        lock = threading.Lock()
+
+        def book():
+            client = app.test_client()
+            while True:
+                with lock:
+                    if not jobs:
+                        return
+                    user_id, doctor, time_ = jobs.pop()
+                with client.session_transaction() as sess:
+                    sess["user_id"] = user_id
+                    sess["role"] = "patient"
+                response = client.post("/pbook", data={"doctor": doctor, "date": "2024-06-01", "time": time_})
+                statuses.append(response.status_code)
+
+        start = time.perf_counter()
+        pool = [threading.Thread(target=book) for _ in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        db = Database(path=path)
+        booked = db.execute("SELECT COUNT(*) AS n FROM appointment")[0]["n"]
+        doubles = db.execute("""
+            SELECT COUNT(*) AS n FROM (SELECT 1 FROM appointment GROUP BY doctor_id, date, time HAVING COUNT(*) > 1)
+        """)[0]["n"]
+        db.close()
+        print(f"{requests} requests from {threads} threads in {elapsed:.2f}s "
+              f"({requests / elapsed:.0f}/s): {statuses.count(302)} booked, "
+              f"{statuses.count(409)} rejected, {booked} rows for {doctors * slots} slots, "
+              f"{doubles} double bookings")
+        return doubles
+
+def login(workers, threads, seconds, users=200):
+    """Measure login throughput and the latency of /patient during the storm, per pool size."""
+    from werkzeug.security import generate_password_hash
+    print(f"{'workers':>7} {'logins/s':>9} {'per core':>9} {'/patient p50 ms':>16} {'shed':>5}")
+    with scratch_db(0, users=users) as path:
+        app = bench_app(path)
+        from app import hasher
+        db = Database(path=path)
+        db.execute("UPDATE users SET hash=?", generate_password_hash("password", app.config["PASSWORD_HASH_METHOD"]))
+        db.close()
+        for n in workers:
+            hasher.shutdown(app)
+            app.config["HASH_WORKERS"] = n
+            app.config["HASH_QUEUE_LIMIT"] = 4 * max(n, 1)
+            deadline = time.perf_counter() + seconds
+            statuses = []
+            latencies = []
+
+            def storm():
+                client = app.test_client()
+                rng = random.Random(threading.get_ident())
+                while time.perf_counter() < deadline:
+                    i = rng.randrange(users)
+                    response = client.post("/plogin", data={"email": f"patient{i}@example.com", "password": "password"})
+                    statuses.append(response.status_code)
+
+            def browse():
+                client = app.test_client()
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    client.get("/patient")
+                    latencies.append(time.perf_counter() - start)
+                    time.sleep(0.01)
+
+            pool = [threading.Thread(target=storm) for _ in range(threads)] + [threading.Thread(target=browse)]
+            for t in pool:
+                t.start()
+            for t in pool:
+                t.join()
+            rate = statuses.count(302) / seconds
+            latencies.sort()
+            p50 = latencies[len(latencies) // 2] * 1000 if latencies else float("nan")
+            print(f"{n:>7} {rate:>9.1f} {rate / (os.cpu_count() or 1):>9.1f} {p50:>16.1f} {statuses.count(503):>5}")
+        hasher.shutdown(app)
+
+# (name, method, path, signed in as, form for the i-th request); /about is left out as it has no template
+ROUTES = [
+    ("index", "GET", "/", None, None),
+    ("patient", "GET", "/patient", None, None),
+    ("doctor", "GET", "/doctor", None, None),
+    ("doctor_login", "POST", "/doctor", None, lambda i: {"email": "doctor0@example.com", "password": "password"}),
+    ("admin", "GET", "/admin", None, None),
+    ("admin_login", "POST", "/admin", None, lambda i: {"username": "admin", "password": "password"}),
+    ("pregister", "GET", "/pregister", None, None),
+    ("pregister_post", "POST", "/pregister", None, lambda i: {
+        "firstName": "New", "lastName": f"Patient{i}", "email": f"new{i}@example.com", "contact": "5550000000",
+        "password": "password", "confirmation": "password", "gender": "N/A"}),
+    ("plogin", "GET", "/plogin", None, None),
+    ("plogin_post", "POST", "/plogin", None, lambda i: {"email": f"patient{i % 100}@example.com", "password": "password"}),
+    ("logout", "GET", "/logout", None, None),
+    ("pdashboard", "GET", "/pdashboard", "patient", None),
+    ("pbook", "GET", "/pbook", "patient", None),
+    ("pbook_post", "POST", "/pbook", "patient", lambda i: dict(zip(("date", "time"), slot_at(i, datetime.date(2030, 1, 1))), doctor="1")),
+    ("pview", "GET", "/pview", "patient", None),
+    ("ddashboard", "GET", "/ddashboard", "doctor", None),
+    ("dview", "GET", "/dview", "doctor", None),
+    ("adashboard", "GET", "/adashboard", "admin", None),
+    ("dlist", "GET", "/dlist", "admin", None),
+    ("plist", "GET", "/plist", "admin", None),
+    ("plist_deep", "GET", "/plist?after={deep}", "admin", None),
+    ("vapp", "GET", "/vapp", "admin", None),
+    ("add", "GET", "/add", "admin", None),
+    ("add_post", "POST", "/add", "admin", lambda i: {
+        "fname": "New", "lname": f"Doctor{i}", "email": f"newdoctor{i}@example.com",
+        "password": "password", "confirmation": "password"}),
+    ("search", "GET", "/search?kind=patients&q=first{deep}", "admin", None),
+    ("search_doctors", "GET", "/search?kind=doctors&q=doc1", "admin", None),
+    ("dcalendar", "GET", "/dcalendar?view=week&date=2024-01-03", "doctor", None),
+    ("dcalendar_month", "GET", "/dcalendar?view=month&date=2024-01-03", "doctor", None),
+    ("api_pview", "GET", "/api/appointments", "patient", None),
+    ("api_dview", "GET", "/api/doctor/appointments", "doctor", None),
+    ("import", "GET", "/import", "admin", None),
+    ("import_post", "POST", "/import", "admin", lambda i: {"kind": "appointments", "file": (io.BytesIO(
+        ("user_id,doctor_id,date,time\n" + "".join(
+            "1,1,{},{}\n".format(*slot_at(i * 10 + k, datetime.date(2031, 1, 1))) for k in range(10))).encode()),
+        "appointments.csv")}),
+    ("export", "GET", "/export/appointments.csv", "admin", None),
+]
+
+# Routes that hash a password or stream a whole table get fewer requests
+HASHING = {"doctor_login", "admin_login", "pregister_post", "plogin_post", "add_post", "export"}
+
+
+class ServerClient:
+    """Minimal HTTP client against a local server, carrying one session cookie."""
+
+    def __init__(self, port, cookie):
+        self.conn = http.client.HTTPConnection("127.0.0.1", port)
+        self.cookie = cookie
+
+    def open(self, path, method="GET", data=None):
+        headers = {"Cookie": self.cookie} if self.cookie else {}
+        body = None
+        if data is not None and any(isinstance(value, tuple) for value in data.values()):
+            # Forms with a (file, filename) value are sent as multipart, like the test client does
+            boundary = uuid.uuid4().hex
+            parts = []
+            for name, value in data.items():
+                if isinstance(value, tuple):
+                    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                                 f'filename="{value[1]}"\r\n\r\n'.encode() + value[0].read() + b"\r\n")
+                else:
+                    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+            body = b"".join(parts) + f"--{boundary}--\r\n".encode()
+            headers["Content-Type"] = f"multipart/form-data; boundary={boundary}"
+        elif data is not None:
+            body = urllib.parse.urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        self.conn.request(method, path, body, headers)
+        response = self.conn.getresponse()
+        response.data = response.read()
+        response.status_code = response.status
+        return response
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def routes(scale, requests, server, baseline=None, save=None, tolerance=0.25):
+    """Time every route at the given scale, optionally checking against a baseline."""
+    from werkzeug.security import generate_password_hash
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    previous = {}
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)
+    results = {}
+    regressed = []
+    with scratch_db(scale, users=scale, doctors=max(5, scale // 1000),
+                    password_hash=generate_password_hash("password", "pbkdf2:sha256:600000")) as path:
+        app = bench_app(path)
+        cookies = {role: app.session_interface.get_signing_serializer(app).dumps({"user_id": 1, "role": role})
+                   for role in ("patient", "doctor", "admin")}
+        if server:
+            httpd = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            clients = {role: ServerClient(httpd.server_port, f"session={cookie}") for role, cookie in cookies.items()}
+            clients[None] = ServerClient(httpd.server_port, None)
+        else:
+            clients = {}
+            for role, cookie in list(cookies.items()) + [(None, None)]:
+                clients[role] = app.test_client()
+                if cookie:
+                    clients[role].set_cookie("session", cookie)
+
+        print(f"{'route':<15} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>9} {'errors':>6} {'vs baseline':>12}")
+        for name, method, url, role, form in ROUTES:
+            count = max(5, requests // 20) if name in HASHING else requests
+            url = url.format(deep=scale // 2)
+            latencies = []
+            errors = 0
+            for i in range(count):
+                start = time.perf_counter()
+                response = clients[role].open(url, method=method, data=form(i) if form else None)
+                # Streamed responses, e.g. exports, are only produced as they are read
+                response.data
+                latencies.append(time.perf_counter() - start)
+                errors += response.status_code >= 400
+            result = {"p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99),
+                      "rps": count / sum(latencies), "errors": errors}
+            results[name] = result
+            change = ""
+            if name in previous:
+                ratio = result["p50"] / previous[name]["p50"] - 1
+                change = f"{ratio:+.0%}"
+                if ratio > tolerance:
+                    regressed.append(name)
+                    change += " !"
+            print(f"{name:<15} {result['p50'] * 1000:>9.2f} {result['p99'] * 1000:>9.2f} "
+                  f"{result['rps']:>9.0f} {errors:>6} {change:>12}")
+        if server:
+            httpd.shutdown()
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressed:
+        print("Regressed: " + ", ".join(regressed))
+    return regressed
+
+
+# Run in a fresh interpreter: time importing the app, then its first /patient render
+STARTUP = """
+import json, time
+start = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+app.test_client().get("/patient")
+print(json.dumps({"import": imported - start, "first": time.perf_counter() - imported}))
+"""
+
+
+def templates(requests):
+    """Compare startup and render latency with templates auto-reloaded and with them precompiled and cached."""
+    modes = (("reload", True), ("cached", False))
+    print(f"{'mode':>8} {'import ms':>10} {'first render ms':>16}")
+    for mode, reload in modes:
+        env = dict(os.environ, FLASK_DEBUG="1" if reload else "0")
+        startup = json.loads(subprocess.run([sys.executable, "-c", STARTUP], env=env, check=True,
+                                            capture_output=True, text=True).stdout)
+        print(f"{mode:>8} {startup['import'] * 1000:>10.1f} {startup['first'] * 1000:>16.1f}")
+
+    with scratch_db(1000) as path:
+        app = bench_app(path)
+        cache = app.extensions["render_cache"]
+        client = app.test_client()
+        print(f"\n{'mode':>8} {'route':>10} {'p50 us':>8} {'p99 us':>8}")
+        for mode, reload in modes:
+            app.jinja_env.auto_reload = reload
+            app.config["RENDER_CACHE"] = not reload
+            with app.app_context():
+                cache.clear()
+            for route in ("/", "/patient", "/pbook"):
+                with client.session_transaction() as sess:
+                    sess["user_id"] = 1
+                    sess["role"] = "patient"
+                latencies = []
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    client.get(route)
+                    latencies.append(time.perf_counter() - start)
+                print(f"{mode:>8} {route:>10} {percentile(latencies, 0.5) * 1e6:>8.0f} "
+                      f"{percentile(latencies, 0.99) * 1e6:>8.0f}")
+
+
+class BrowserCache:
+    """Just enough of a browser cache to count what a page load costs: immutable reuse and ETag revalidation."""
+
+    def __init__(self, client):
+        self.client = client
+        self.entries = {}
+        self.requests = 0
+        self.bytes = 0
+
+    def get(self, url):
+        entry = self.entries.get(url)
+        if entry is not None and "immutable" in entry["cache"]:
+            return entry["body"]
+        headers = {"If-None-Match": entry["etag"]} if entry is not None and entry["etag"] else {}
+        response = self.client.get(url, headers=headers)
+        self.requests += 1
+        self.bytes += len(response.data)
+        if response.status_code == 304:
+            return entry["body"]
+        cache = response.headers.get("Cache-Control", "")
+        if "no-store" not in cache:
+            self.entries[url] = {"cache": cache, "etag": response.headers.get("ETag"), "body": response.data}
+        return response.data
+
+    def load(self, url):
+        """Fetch a page and every static file it links to."""
+        page = self.get(url).decode()
+        for asset in re.findall(r'(?:href|src)="((?:\.\.)?/static/[^"]+)"', page):
+            self.get(asset.replace("..", "", 1))
+
+
+def caching(visits):
+    """Compare requests and bytes per public page load with and without the caching policy."""
+    pages = ("/", "/patient", "/plogin", "/pregister", "/doctor", "/admin")
+    with scratch_db(100) as path:
+        app = bench_app(path)
+        print(f"{'policy':>9} {'requests/load':>14} {'KB/load':>8}")
+        for policy, enabled in (("no-store", False), ("per-route", True)):
+            app.config["HTTP_CACHE"] = enabled
+            browser = BrowserCache(app.test_client())
+            for _ in range(visits):
+                for page in pages:
+                    browser.load(page)
+            loads = visits * len(pages)
+            print(f"{policy:>9} {browser.requests / loads:>14.2f} {browser.bytes / loads / 1024:>8.1f}")
+
+
+def polling(pollers, seconds, wait=10, server_threads=8):
+    """Measure change-notification latency and database work for many concurrent long-pollers."""
+    import socket
+    from serve import PooledWSGIServer, RequestHandler
+
+    class QuietHandler(RequestHandler):
+        def log_request(self, *args):
+            pass
+
+    print(f"{'pollers':>8} {'answers':>8} {'shed':>6} {'notify p50 ms':>14} {'notify p99 ms':>14} {'queries/answer':>15}")
+    for n in pollers:
+        with scratch_db(0) as path:
+            # The shipped settings, on one serve.py worker with its default thread count
+            app = bench_app(path)
+            feed = app.extensions["appointment_feed"]
+            with app.app_context():
+                feed.clear()
+            queries = [0]
+            execute = feed.db.execute
+
+            def counted(*args, **kwargs):
+                queries[0] += 1
+                return execute(*args, **kwargs)
+            feed.db.execute = counted
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess["user_id"] = 1
+                    sess["role"] = "doctor"
+                cookie = client.get_cookie("session").value
+            listener = socket.create_server(("127.0.0.1", 0), backlog=2048)
+            httpd = PooledWSGIServer(app, listener.fileno(), server_threads)
+            httpd.RequestHandlerClass = QuietHandler
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            writes = {}
+            latencies = []
+            answers = [0]
+            shed = [0]
+            deadline = time.monotonic() + seconds
+
+            def poll():
+                conn = http.client.HTTPConnection("127.0.0.1", listener.getsockname()[1], timeout=wait + 5)
+                etag = None
+                while time.monotonic() < deadline:
+                    headers = {"Cookie": f"session={cookie}"}
+                    if etag:
+                        headers["If-None-Match"] = etag
+                    conn.request("GET", f"/api/doctor/appointments?wait={wait}", headers=headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                    answers[0] += 1
+                    etag = response.getheader("ETag")
+                    if response.status == 200 and body:
+                        count = len(json.loads(body)["appointments"])
+                        if count in writes:
+                            latencies.append(time.monotonic() - writes[count])
+                    # Turned away from waiting: come back when told to, like a well-behaved client
+                    if response.getheader("Retry-After"):
+                        shed[0] += 1
+                        time.sleep(int(response.getheader("Retry-After")))
+
+            threads = [threading.Thread(target=poll, daemon=True) for _ in range(n)]
+            for t in threads:
+                t.start()
+            db = Database(path=path)
+            k = 0
+            while time.monotonic() < deadline - 1:
+                time.sleep(0.5)
+                writes[k + 1] = time.monotonic()
+                db.execute("INSERT INTO appointment(user_id,doctor_id,doctor,date,time) VALUES(1,1,'',?,?)", *slot_at(k))
+                k += 1
+            for t in threads:
+                t.join(wait + 5)
+            httpd.shutdown()
+            httpd.pool.shutdown(wait=True)
+            httpd.server_close()
+            listener.close()
+            del feed.db.execute
+            db.close()
+            print(f"{n:>8} {answers[0]:>8} {shed[0]:>6} {percentile(latencies, 0.5) * 1000:>14.0f} "
+                  f"{percentile(latencies, 0.99) * 1000:>14.0f} {queries[0] / max(answers[0], 1):>15.2f}")
+
+
+def search_lookups(sizes, terms=("first98765", "last4242", "patient77777", "555099912")):
+    """Compare full-text prefix search with LIKE scans as the patient count grows."""
+    like = """
+        SELECT id, fname, lname, mail, contact FROM users
+        WHERE fname LIKE ? OR lname LIKE ? OR mail LIKE ? OR contact LIKE ? LIMIT 50
+    """
+    print(f"{'patients':>9} {'backfill s':>11} {'LIKE ms':>8} {'FTS ms':>7}")
+    for size in sizes:
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        try:
+            seed(path, 0, users=size)
+            conn = sqlite3.connect(path)
+            conn.execute("INSERT INTO users_search(users_search) VALUES ('delete-all')")
+            conn.commit()
+            conn.close()
+            start = time.perf_counter()
+            migrations.backfill(sqlite3.connect(path, isolation_level=None), """
+                INSERT INTO users_search(rowid, fname, lname, mail, contact)
+                SELECT id, fname, lname, mail, contact FROM users WHERE id > ? AND id <= ?
+            """, migrations.BATCH_SIZE, table="users")
+            built = time.perf_counter() - start
+            db = Database(path=path)
+            scans, lookups = [], []
+            for term in terms:
+                pattern = f"%{term}%"
+                scans.append(timed(lambda: db.execute(like, pattern, pattern, pattern, pattern))[1])
+                lookups.append(timed(lambda: search(db, "patients", term))[1])
+            db.close()
+            print(f"{size:>9} {built:>11.1f} {sum(scans) / len(terms) * 1000:>8.1f} "
+                  f"{sum(lookups) / len(terms) * 1000:>7.2f}")
+        finally:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+
+def on_demand_dashboard(db, today):
+    """The dashboard's appointment numbers computed straight from appointment, for comparison."""
+    first = (today - datetime.timedelta(days=7)).isoformat()
+    last = (today + datetime.timedelta(days=7)).isoformat()
+    return (db.execute("SELECT COUNT(*) AS n FROM appointment")
+            + db.execute("SELECT date, COUNT(*) AS n FROM appointment WHERE date BETWEEN ? AND ? GROUP BY date", first, last)
+            + db.execute("""
+                SELECT doctor_id, COUNT(*) AS n FROM appointment WHERE date = ?
+                GROUP BY doctor_id ORDER BY n DESC LIMIT 5
+            """, today.isoformat()))
+
+
+def dashboard_reads(sizes, repeat=20):
+    """Compare the aggregate-backed dashboard with on-demand counts as appointments grow."""
+    from stats import dashboard
+    print(f"{'appointments':>12} {'on demand ms':>13} {'aggregates ms':>14}")
+    for size in sizes:
+        with scratch_db(size) as path:
+            db = Database(path=path)
+            today = datetime.date(2024, 1, 1) + datetime.timedelta(days=size // 20 // 48 // 2)
+            old = min(timed(lambda: on_demand_dashboard(db, today))[1] for _ in range(repeat))
+            new = min(timed(lambda: [dashboard(db, today)])[1] for _ in range(repeat))
+            db.close()
+            print(f"{size:>12} {old * 1000:>13.2f} {new * 1000:>14.2f}")
+
+
+def archiving(sizes, keep_days=7, repeat=20, doctors=20):
+    """Compare hot-route latency over the whole history with latency once old appointments are archived."""
+    from archive import archive
+    routes = {"/dview": "doctor", "/pview": "patient", "/vapp": "admin", "/api/doctor/appointments": "doctor"}
+    print(f"{'appointments':>12} {'archived':>9} " + " ".join(f"{route:>26}" for route in routes))
+    for size in sizes:
+        with scratch_db(size, doctors=doctors) as path:
+            app = bench_app(path)
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess["user_id"] = 1
+
+            def latencies():
+                with app.app_context():
+                    app.extensions["appointment_feed"].clear()
+                results = []
+                for route, role in routes.items():
+                    with client.session_transaction() as sess:
+                        sess["role"] = role
+                    results.append(min(timed(lambda: [client.get(route)])[1] for _ in range(repeat)))
+                return results
+            before = latencies()
+            last = datetime.date.fromisoformat(slot_at(size // doctors)[0])
+            moved = archive(path, (last - datetime.timedelta(days=keep_days)).isoformat(), pause=0)
+            after = latencies()
+            print(f"{size:>12} {moved:>9} " + " ".join(f"{old * 1000:>12.2f} -> {new * 1000:>6.2f} ms"
+                                                       for old, new in zip(before, after)))
+
+
+def calendars(sizes, repeat=20, doctors=20):
+    """Compare a doctor's week read by range scans over starts with filtering their whole history, as it grows."""
+    from queries import calendar, calendar_span
+    print(f"{'appointments':>12} {'history':>8} {'filter ms':>10} {'week ms':>8} {'month ms':>9}")
+    for size in sizes:
+        with scratch_db(size, doctors=doctors) as path:
+            db = Database(path=path)
+            history = size // doctors
+            # A week in the middle of the doctor's history
+            day = datetime.date.fromisoformat(slot_at(history // 2)[0])
+            first, after, _ = calendar_span("week", day)
+
+            def filtered():
+                # Free-form date and time: every appointment has to be read and checked
+                span = first.isoformat(), after.isoformat()
+                return sorted((row for row in appointments_with_patients(db, doctor_id=1)
+                               if span[0] <= row["date"] < span[1]), key=lambda row: (row["date"], row["time"]))
+            old = min(timed(filtered)[1] for _ in range(repeat))
+            week = min(timed(lambda: calendar(db, 1, first, after))[1] for _ in range(repeat))
+            month = min(timed(lambda: calendar(db, 1, *calendar_span("month", day)[:2], appointments=False))[1]
+                        for _ in range(repeat))
+            db.close()
+            print(f"{size:>12} {history:>8} {old * 1000:>10.2f} {week * 1000:>8.2f} {month * 1000:>9.2f}")
+
+
+def write_load(path, deadline, results, doctors=20):
+    """One client process: book fresh slots like pbook() until the deadline, reporting commit latencies and the WAL's size."""
+    db = Database(path=path)
+    latencies = []
+    for k in itertools.count():
+        if time.monotonic() >= deadline:
+            break
+        date, time_ = slot_at(k // doctors, datetime.date(2040, 1, 1))
+        start = time.perf_counter()
+        db.execute("INSERT INTO appointment(user_id,doctor_id,doctor,date,time) VALUES(?,?,?,?,?)",
+                   1, k % doctors + 1, "Doc Tor", date, time_)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    # Checkpoints that readers held up leave the WAL larger than its usual 1000 pages or so
+    wal = os.path.getsize(path + "-wal") if os.path.exists(path + "-wal") else 0
+    db.close()
+    results.put((latencies, wal))
+
+
+def report_load(app, deadline, results):
+    """One client process: stream the full appointment report as an admin until the deadline, reporting how many were read."""
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["user_id"] = 1
+        sess["role"] = "admin"
+    done = 0
+    while time.monotonic() < deadline:
+        client.get("/vapp?all=1").get_data()
+        done += 1
+    results.put(done)
+
+
+def reports(appointments, readers, seconds, max_age=1):
+    """Compare booking commit latency while admins stream reports from the live database and from the snapshot."""
+    print(f"{appointments} appointments, {readers} report readers, snapshot refreshed every {max_age}s, {os.cpu_count()} CPUs")
+    print(f"{'reports from':>12} {'writes':>7} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7} {'reports':>8} {'WAL MB':>7}")
+    for mode in ("idle", "live", "snapshot"):
+        with scratch_db(appointments) as path:
+            app = bench_app(path)
+            app.config["REPORT_SNAPSHOT"] = path + ".snapshot" if mode == "snapshot" else None
+            app.config["REPORT_SNAPSHOT_MAX_AGE"] = max_age
+            deadline = time.monotonic() + seconds
+            writes, reads = multiprocessing.Queue(), multiprocessing.Queue()
+            procs = [multiprocessing.Process(target=write_load, args=(path, deadline, writes))]
+            if mode != "idle":
+                procs += [multiprocessing.Process(target=report_load, args=(app, deadline, reads)) for _ in range(readers)]
+            for proc in procs:
+                proc.start()
+            latencies, wal = writes.get()
+            done = sum(reads.get() for _ in procs[1:])
+            for proc in procs:
+                proc.join()
+            for leftover in (".snapshot", ".snapshot.lock"):
+                if os.path.exists(path + leftover):
+                    os.remove(path + leftover)
+            print(f"{mode if mode != 'idle' else 'no reports':>12} {len(latencies):>7} "
+                  f"{percentile(latencies, 0.5) * 1000:>7.2f} {percentile(latencies, 0.99) * 1000:>7.2f} "
+                  f"{max(latencies) * 1000:>7.1f} {done:>8} {wal / 1e6:>7.1f}")
+
+
+READ_ROUTES = ("/patient", "/pdashboard", "/pview", "/pbook", "/pview?history=1", "/api/appointments")
+
+
+def read_load(port, cookie, seconds, results):
+    """One client process: request the read routes in turn for a while and report how many were answered."""
+    done = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for route in READ_ROUTES:
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+            conn.request("GET", route, headers={"Cookie": cookie})
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            done += 1
+            errors += response.status != 200
+    results.put((done, errors))
+
+
+def prefork(workers, clients, seconds, appointments=10000):
+    """Measure read-route throughput of serve.py at each worker count."""
+    from werkzeug.security import generate_password_hash
+    method = "pbkdf2:sha256:1000"
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'requests/s':>11} {'errors':>7} {'scaling':>8}")
+    with scratch_db(appointments, password_hash=generate_password_hash("pw", method)) as path:
+        first = None
+        for n in workers:
+            env = dict(os.environ, DATABASE=path, SESSION_SQLITE_PATH=path + "-sessions")
+            server = subprocess.Popen([sys.executable, "serve.py", "--port", "0", "--workers", str(n)],
+                                      env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            try:
+                port = int(server.stdout.readline().split(":")[1].split()[0])
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+                conn.request("POST", "/plogin", "email=patient1%40example.com&password=pw",
+                             {"Content-Type": "application/x-www-form-urlencoded"})
+                response = conn.getresponse()
+                response.read()
+                cookie = response.getheader("Set-Cookie").split(";")[0]
+                results = multiprocessing.Queue()
+                procs = [multiprocessing.Process(target=read_load, args=(port, cookie, seconds, results))
+                         for _ in range(clients)]
+                for proc in procs:
+                    proc.start()
+                counts = [results.get() for _ in procs]
+                for proc in procs:
+                    proc.join()
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait()
+            rps = sum(done for done, _ in counts) / seconds
+            first = first or rps
+            print(f"{n:>8} {rps:>11.0f} {sum(e for _, e in counts):>7} {rps / first:>7.2f}x")
+
+
+def book_load(port, cookie, jobs, results):
+    """One client process: post each booking in turn and report the latencies and statuses."""
+    latencies, statuses = [], []
+    for doctor, date, time_ in jobs:
+        body = urllib.parse.urlencode({"doctor": doctor, "date": date, "time": time_})
+        start = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        conn.request("POST", "/pbook", body, {"Cookie": cookie, "Content-Type": "application/x-www-form-urlencoded"})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        latencies.append(time.perf_counter() - start)
+        statuses.append(response.status)
+    results.put((latencies, statuses))
+
+
+def spike(requests, clients, workers, doctors=20):
+    """Compare a burst of bookings inserted one per request with the same burst through the booking queue."""
+    from werkzeug.security import generate_password_hash
+    print(f"{workers} workers, {clients} clients, {os.cpu_count()} CPUs")
+    print(f"{'mode':>8} {'bookings/s':>11} {'p50 ms':>8} {'p99 ms':>8} {'committed s':>12} {'rows':>6} {'errors':>7}")
+    # Distinct slots: 48 a day per doctor, over as many days as needed
+    jobs = [(i % doctors + 1, (datetime.date(2030, 1, 1) + datetime.timedelta(days=i // (doctors * 48))).isoformat(),
+             f"{6 + i // doctors % 48 // 4:02d}:{i // doctors % 4 * 15:02d}") for i in range(requests)]
+    for queued in (False, True):
+        with scratch_db(0, doctors=doctors, password_hash=generate_password_hash("pw", "pbkdf2:sha256:1000")) as path:
+            env = dict(os.environ, DATABASE=path, SESSION_SQLITE_PATH=path + "-sessions",
+                       BOOKING_QUEUE="1" if queued else "0", BOOKING_JOURNAL=path + ".journal")
+            server = subprocess.Popen([sys.executable, "serve.py", "--port", "0", "--workers", str(workers)],
+                                      env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            try:
+                port = int(server.stdout.readline().split(":")[1].split()[0])
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+                conn.request("POST", "/plogin", "email=patient0%40example.com&password=pw",
+                             {"Content-Type": "application/x-www-form-urlencoded"})
+                response = conn.getresponse()
+                response.read()
+                cookie = response.getheader("Set-Cookie").split(";")[0]
+                results = multiprocessing.Queue()
+                procs = [multiprocessing.Process(target=book_load, args=(port, cookie, jobs[n::clients], results))
+                         for n in range(clients)]
+                start = time.perf_counter()
+                for proc in procs:
+                    proc.start()
+                answers = [results.get() for _ in procs]
+                answered = time.perf_counter() - start
+                for proc in procs:
+                    proc.join()
+                db = Database(path=path)
+                while (rows := db.execute("SELECT COUNT(*) AS n FROM appointment")[0]["n"]) < requests \
+                        and time.perf_counter() - start < answered + 30:
+                    time.sleep(0.01)
+                committed = time.perf_counter() - start
+                db.close()
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait()
+            latencies = [latency for answer, _ in answers for latency in answer]
+            errors = sum(status != 302 for _, statuses in answers for status in statuses)
+            print(f"{'queue' if queued else 'direct':>8} {requests / answered:>11.0f} "
+                  f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f} "
+                  f"{committed:>12.2f} {rows:>6} {errors:>7}")
+
+
+def login_load(port, name, addresses, emails, password, deadline, pause, results):
+    """One client process: post logins pause seconds apart until the deadline, cycling through source addresses.
+
+    Reports (seconds left before the deadline, latency, status) for each attempt.
+    """
+    answers = []
+    rng = random.Random(os.getpid())
+    for address in itertools.cycle(addresses):
+        if time.monotonic() >= deadline:
+            break
+        body = urllib.parse.urlencode({"email": rng.choice(emails), "password": password})
+        start = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", port, source_address=(address, 0))
+        conn.request("POST", "/plogin", body, {"Content-Type": "application/x-www-form-urlencoded"})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        answers.append((deadline - time.monotonic(), time.perf_counter() - start, response.status))
+        time.sleep(pause)
+    results.put((name, answers))
+
+
+def stuffing(attackers, addresses, rate, seconds, workers, users=400):
+    """Measure legitimate logins while attackers post wrong passwords, with no limit, per-process and shared buckets."""
+    from werkzeug.security import generate_password_hash
+    print(f"{workers} workers, {attackers} attackers from {addresses} addresses at {rate:.0f} attempts/s, {os.cpu_count()} CPUs")
+    print(f"{'limit':>8} {'p50 ms':>8} {'2nd half p50':>13} {'p99':>7} {'ok':>4} {'refused':>8} "
+          f"{'attacks/s':>10} {'hashed':>7} {'429':>6} {'503':>5}")
+    # Attackers try the first half of the accounts; users sign in to the other half, each from an address of their own
+    victims = [f"patient{i}@example.com" for i in range(users // 2)]
+    members = [f"patient{i}@example.com" for i in range(users // 2, users)]
+    with scratch_db(0, users=users, password_hash=generate_password_hash("pw", "pbkdf2:sha256:600000")) as path:
+        for mode in ("off", "process", "shared"):
+            env = dict(os.environ, DATABASE=path, SESSION_SQLITE_PATH=path + "-sessions", LOGIN_LIMIT="0" if mode == "off" else "1",
+                       LOGIN_LIMIT_DB=path + ".limits" if mode == "shared" else "")
+            server = subprocess.Popen([sys.executable, "serve.py", "--port", "0", "--workers", str(workers)],
+                                      env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            try:
+                port = int(server.stdout.readline().split(":")[1].split()[0])
+                deadline = time.monotonic() + seconds
+                results = multiprocessing.Queue()
+                procs = [multiprocessing.Process(target=login_load, args=(
+                    port, "attacker", [f"127.0.0.{2 + n % addresses}"], victims, "wrong", deadline, attackers / rate, results))
+                    for n in range(attackers)]
+                procs.append(multiprocessing.Process(target=login_load, args=(
+                    port, "user", [f"127.0.1.{n}" for n in range(1, 255)], members, "pw", deadline, 0.2, results)))
+                for proc in procs:
+                    proc.start()
+                answers = dict((name, []) for name in ("attacker", "user"))
+                for _ in procs:
+                    name, answer = results.get()
+                    answers[name] += answer
+                for proc in procs:
+                    proc.join()
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait()
+                for leftover in (path + ".limits", path + ".limits-wal", path + ".limits-shm"):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+            # By the second half the attackers' bursts are spent and only their refill rate gets through
+            steady = [latency for left, latency, _ in answers["user"] if left < seconds / 2]
+            ok = sum(status == 302 for _, _, status in answers["user"])
+            attacks = [status for _, _, status in answers["attacker"]]
+            print(f"{mode:>8} {percentile([a[1] for a in answers['user']], 0.5) * 1000:>8.1f} "
+                  f"{percentile(steady, 0.5) * 1000:>13.1f} {percentile(steady, 0.99) * 1000:>7.1f} {ok:>4} "
+                  f"{len(answers['user']) - ok:>8} {len(attacks) / seconds:>10.1f} {attacks.count(403):>7} "
+                  f"{attacks.count(429):>6} {attacks.count(503):>5}")
+
+IMPORT_TIME = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)")
+
+
+def import_times(module="app"):
+    """Import a module in a fresh interpreter, returning its cumulative seconds and {direct import: seconds}."""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=True).stderr
+    # A module is logged after everything it imports, so its direct imports are the depth-1 lines just before it
+    children = {}
+    for match in IMPORT_TIME.finditer(stderr):
+        depth, name, seconds = len(match[2]) // 2, match[3], int(match[1]) / 1e6
+        if depth == 1:
+            children[name] = seconds
+        elif depth == 0:
+            if name == module:
+                return seconds, children
+            children = {}
+    raise ValueError(f"{module} was not imported")
+
+
+def imports(budget, runs, top=10):
+    """Report the import time of app and its slowest direct imports; return True if over budget."""
+    total, children = min((import_times() for _ in range(runs)), key=lambda result: result[0])
+    direct = sorted(((seconds, name) for name, seconds in children.items()), reverse=True)
+    print(f"{'module':<24} {'ms':>8}")
+    for seconds, name in direct[:top]:
+        print(f"{name:<24} {seconds * 1000:>8.1f}")
+    print(f"{'app (total)':<24} {total * 1000:>8.1f}   budget {budget * 1000:.0f}")
+    if total > budget:
+        print("over budget")
+        return True
+    return False
+
+
+def auth(requests):
+    """Report the per-request overhead of @requires over an undecorated view, in microseconds."""
+    from flask import session
+    from app import app
+    from helpers import forget_principal, requires
+
+    def view():
+        return ""
+    cases = [("bare view", view, {"user_id": 1, "role": "patient"}),
+             ("patient allowed", requires("patient")(view), {"user_id": 1, "role": "patient"}),
+             ("doctor refused", requires("patient")(view), {"user_id": 1, "role": "doctor"}),
+             ("signed out", requires("patient")(view), {})]
+    print(f"{'case':<16} {'us/request':>11} {'overhead us':>12}")
+    bare = None
+    for name, fn, sess in cases:
+        best = None
+        for _ in range(5):
+            with app.test_request_context("/"):
+                session.update(sess)
+                start = time.perf_counter()
+                for _ in range(requests):
+                    # Each request starts with no principal on g
+                    forget_principal()
+                    fn()
+                elapsed = (time.perf_counter() - start) / requests
+            best = elapsed if best is None else min(best, elapsed)
+        bare = best if bare is None else bare
+        print(f"{name:<16} {best * 1e6:>11.2f} {(best - bare) * 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("listing")
+    command.add_argument("sizes", nargs="*", type=int, default=[1000, 5000, 10000])
+    command = commands.add_parser("concurrency")
+    command.add_argument("--threads", nargs="*", type=int, default=[1, 2, 4, 8])
+    command.add_argument("--seconds", type=float, default=3)
+    command = commands.add_parser("booking")
+    command.add_argument("--requests", type=int, default=400)
+    command.add_argument("--threads", type=int, default=100)
+    command = commands.add_parser("login")
+    command.add_argument("--workers", nargs="*", type=int, default=[0, os.cpu_count() or 1])
+    command.add_argument("--threads", type=int, default=8)
+    command.add_argument("--seconds", type=float, default=5)
+    command = commands.add_parser("routes")
+    command.add_argument("--scale", type=int, default=1000, help="patients and appointments to seed, e.g. 1000, 100000, 1000000")
+    command.add_argument("--requests", type=int, default=200, help="requests per route")
+    command.add_argument("--server", action="store_true", help="go through a local WSGI server instead of the test client")
+    command.add_argument("--baseline", help="JSON results to compare against")
+    command.add_argument("--save-baseline", help="write results as JSON for later --baseline runs")
+    command.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown before failing")
+    command = commands.add_parser("templates")
+    command.add_argument("--requests", type=int, default=500, help="requests per route and mode")
+    command = commands.add_parser("caching")
+    command.add_argument("--visits", type=int, default=5, help="times to browse through the public pages")
+    command = commands.add_parser("polling")
+    command.add_argument("--pollers", nargs="*", type=int, default=[50, 200])
+    command.add_argument("--seconds", type=float, default=5)
+    command = commands.add_parser("search")
+    command.add_argument("sizes", nargs="*", type=int, default=[10000, 100000, 1000000])
+    command = commands.add_parser("dashboard")
+    command.add_argument("sizes", nargs="*", type=int, default=[10000, 100000, 1000000])
+    command = commands.add_parser("archive")
+    command.add_argument("sizes", nargs="*", type=int, default=[10000, 100000, 1000000])
+    command.add_argument("--keep-days", type=int, default=7)
+    command = commands.add_parser("calendar")
+    command.add_argument("sizes", nargs="*", type=int, default=[10000, 100000, 1000000])
+    command = commands.add_parser("reports")
+    command.add_argument("--appointments", type=int, default=200000)
+    command.add_argument("--readers", type=int, default=2, help="processes streaming the full appointment report")
+    command.add_argument("--seconds", type=float, default=10)
+    command = commands.add_parser("prefork")
+    command.add_argument("--workers", nargs="*", type=int, default=[1, 2, 4])
+    command.add_argument("--clients", type=int, default=8)
+    command.add_argument("--seconds", type=float, default=5)
+    command = commands.add_parser("spike")
+    command.add_argument("--requests", type=int, default=2000)
+    command.add_argument("--clients", type=int, default=16)
+    command.add_argument("--workers", type=int, default=4)
+    command = commands.add_parser("imports")
+    command.add_argument("--budget-ms", type=float, default=250, help="fail if importing app takes longer")
+    command.add_argument("--runs", type=int, default=5, help="fresh interpreters to try; the fastest counts")
+    command = commands.add_parser("stuffing")
+    command.add_argument("--attackers", type=int, default=8, help="attacking client processes")
+    command.add_argument("--addresses", type=int, default=4, help="source addresses the attackers share")
+    command.add_argument("--rate", type=float, default=200, help="attempts per second from all attackers together")
+    command.add_argument("--seconds", type=float, default=20)
+    command.add_argument("--workers", type=int, default=2)
+    command = commands.add_parser("auth")
+    command.add_argument("--requests", type=int, default=20000, help="calls per case")
+    args = parser.parse_args()
+    if args.command == "listing":
+        listing(args.sizes)
+    elif args.command == "concurrency":
+        concurrency(args.threads, args.seconds)
+    elif args.command == "booking":
+        raise SystemExit(1 if booking(args.requests, args.threads) else 0)
+    elif args.command == "login":
+        login(args.workers, args.threads, args.seconds)
+    elif args.command == "templates":
+        templates(args.requests)
+    elif args.command == "caching":
+        caching(args.visits)
+    elif args.command == "polling":
+        polling(args.pollers, args.seconds)
+    elif args.command == "search":
+        search_lookups(args.sizes)
+    elif args.command == "dashboard":
+        dashboard_reads(args.sizes)
+    elif args.command == "archive":
+        archiving(args.sizes, args.keep_days)
+    elif args.command == "calendar":
+        calendars(args.sizes)
+    elif args.command == "reports":
+        reports(args.appointments, args.readers, args.seconds)
+    elif args.command == "prefork":
+        prefork(args.workers, args.clients, args.seconds)
+    elif args.command == "spike":
+        spike(args.requests, args.clients, args.workers)
+    elif args.command == "stuffing":
+        stuffing(args.attackers, args.addresses, args.rate, args.seconds, args.workers)
+    elif args.command == "auth":
+        auth(args.requests)
+    elif args.command == "imports":
+        raise SystemExit(1 if imports(args.budget_ms / 1000, args.runs) else 0)
+    else:
+        raise SystemExit(1 if routes(args.scale, args.requests, args.server, args.baseline,
+                                     args.save_baseline, args.tolerance) else 0)
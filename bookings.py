@@ -0,0 +1,244 @@
+"""
+Write-behind bookings, for spikes such as the moment a day's slots open.
+
+With BOOKING_QUEUE on, pbook() appends each booking to a journal file and
+answers at once with a pending confirmation. One writer thread per app in
+each process
+commits whatever has queued up every BOOKING_FLUSH_INTERVAL seconds, up to
+BOOKING_BATCH bookings per transaction, so a spike becomes a few large
+commits instead of hundreds of small ones queueing for SQLite's write lock.
+Until then the booking is listed as pending in /pview; a booking that lost
+its slot to another process is kept in the booking_rejections table and
+reported there instead, by whichever worker the patient reaches next.
+
+Each process writes its own journal, BOOKING_JOURNAL.<pid>-<random>, and
+holds an exclusive flock on it for as long as it writes there. A booking is
+written to it before the patient is told it is pending, so it survives the
+app crashing (and a power cut too with BOOKING_JOURNAL_FSYNC). The lock goes
+away with the process however it ends, so recover() replays every journal
+it can lock: those of processes that are gone, even if their pid has since
+been reused. Replaying is safe however often it happens: the unique slot
+index turns a second copy of a booking into a no-op.
+"""
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+from blinker import Namespace
+from flask import current_app
+
+# Sent with the list of bookings after each commit, so caches of appointment lists can be invalidated
+signals = Namespace()
+bookings_committed = signals.signal("bookings-committed")
+
+INSERT = """
+    INSERT INTO appointment(user_id,doctor_id,doctor,date,time) VALUES(?,?,?,?,?)
+    ON CONFLICT DO NOTHING
+"""
+
+REJECT = """
+    INSERT INTO booking_rejections(user_id,doctor_id,doctor,date,time) VALUES(?,?,?,?,?)
+    ON CONFLICT DO NOTHING
+"""
+
+
+class Backlog:
+    """One app's queued bookings, the journal they are written to and the lock of its writer thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self.pending = []
+        self.journal = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.wakeup = threading.Event()
+
+
+class BookingQueue:
+    """Journals bookings and commits them in batches from one writer thread per app."""
+
+    def __init__(self, app=None, db=None):
+        self.db = db
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """Register defaults for the booking queue settings in app.config, and give the app its own backlog."""
+        app.config.setdefault("BOOKING_QUEUE", False)
+        app.config.setdefault("BOOKING_JOURNAL", "bookings.journal")
+        app.config.setdefault("BOOKING_JOURNAL_FSYNC", False)
+        app.config.setdefault("BOOKING_BATCH", 500)
+        app.config.setdefault("BOOKING_FLUSH_INTERVAL", 0.05)
+        app.extensions["booking_queue"] = self
+        app.extensions["booking_backlog"] = Backlog(app)
+        self.db = db
+
+    @property
+    def enabled(self):
+        return current_app.config["BOOKING_QUEUE"]
+
+    def backlog(self, app=None):
+        """Return app's backlog, or the current app's."""
+        return (app or current_app).extensions["booking_backlog"]
+
+    def start(self):
+        """Open this process's journal and start its writer for the current app, replaying journals of dead processes first."""
+        backlog = self.backlog()
+        with backlog.lock:
+            if backlog.pid == os.getpid():
+                return
+            self.recover()
+            # A forked child must not share its parent's journal or pending list; closing its copy keeps the parent's lock
+            if backlog.journal is not None:
+                backlog.journal.close()
+            backlog.pending = []
+            backlog.journal = self.open_journal(backlog.app)
+            backlog.pid = os.getpid()
+            # The writer thread has no app context of its own, so it is given the backlog, which knows its app
+            threading.Thread(target=self.write_behind, args=(backlog,), name="booking-writer", daemon=True).start()
+
+    def open_journal(self, app):
+        """Create this process's journal for app under a name no other process has used, and lock it."""
+        while True:
+            journal = open(f"{app.config['BOOKING_JOURNAL']}.{os.getpid()}-{uuid.uuid4().hex[:12]}", "a",
+                           encoding="utf-8")
+            fcntl.flock(journal, fcntl.LOCK_EX)
+            # recover() in another process may have found it before it was locked, and removed it
+            if os.fstat(journal.fileno()).st_nlink:
+                return journal
+            journal.close()
+
+    def submit(self, user_id, doctor_id, doctor, date, time):
+        """Journal a booking and queue it for the current app's writer; it is durable once this returns."""
+        backlog = self.backlog()
+        if backlog.pid != os.getpid():
+            self.start()
+        booking = {"user_id": user_id, "doctor_id": doctor_id, "doctor": doctor, "date": date, "time": time}
+        with backlog.lock:
+            backlog.journal.write(json.dumps(booking) + "\n")
+            backlog.journal.flush()
+            if backlog.app.config["BOOKING_JOURNAL_FSYNC"]:
+                os.fsync(backlog.journal.fileno())
+            backlog.pending.append(booking)
+        backlog.wakeup.set()
+
+    def pending_for(self, user_id):
+        """Return a patient's bookings that this process has not committed yet."""
+        backlog = self.backlog()
+        with backlog.lock:
+            return [booking for booking in backlog.pending if booking["user_id"] == user_id]
+
+    def take_rejected(self, user_id):
+        """Return, and forget, a patient's bookings that lost their slot to another process."""
+        # Nearly always there are none, and a read does not wait for the write lock
+        if not self.db.execute("SELECT 1 FROM booking_rejections WHERE user_id=? LIMIT 1", user_id):
+            return []
+        rows = self.db.execute("DELETE FROM booking_rejections WHERE user_id=? RETURNING id, doctor, date, time",
+                               user_id)
+        return sorted(rows, key=lambda row: row["id"])
+
+    def write_behind(self, backlog):
+        while True:
+            backlog.wakeup.wait()
+            # Let the bookings of a spike gather into one transaction
+            time.sleep(backlog.app.config["BOOKING_FLUSH_INTERVAL"])
+            backlog.wakeup.clear()
+            try:
+                self.flush(backlog.app)
+            except Exception:
+                # Everything stays journaled and pending; try again shortly
+                backlog.app.logger.exception("Committing queued bookings failed")
+                time.sleep(1)
+                backlog.wakeup.set()
+
+    def flush(self, app=None):
+        """Commit every pending booking of app, or the current app, BOOKING_BATCH per transaction, returning how many were committed."""
+        backlog = self.backlog(app)
+        with backlog.flushing:
+            with backlog.lock:
+                queued = list(backlog.pending)
+            if not queued:
+                return 0
+            batch = backlog.app.config["BOOKING_BATCH"]
+            for start in range(0, len(queued), batch):
+                chunk = queued[start:start + batch]
+                self.commit(backlog.app, chunk)
+                with backlog.lock:
+                    # Only flush() removes pending bookings, always from the front
+                    del backlog.pending[:len(chunk)]
+                    if not backlog.pending:
+                        backlog.journal.truncate(0)
+            return len(queued)
+
+    def close(self, app=None):
+        """Commit every pending booking of app, or the current app, and remove this process's journal for it."""
+        backlog = self.backlog(app)
+        self.flush(backlog.app)
+        with backlog.lock:
+            if backlog.pid == os.getpid() and not backlog.pending:
+                # Removed while still locked, so no other process replays it in between
+                os.remove(backlog.journal.name)
+                backlog.journal.close()
+                backlog.journal = None
+                backlog.pid = None
+
+    def commit(self, app, bookings):
+        """Insert bookings into app's database in one transaction, recording and returning those whose slot was taken."""
+        rejected = []
+        with app.app_context():
+            with self.db.transaction():
+                for booking in bookings:
+                    values = (booking["user_id"], booking["doctor_id"], booking["doctor"], booking["date"], booking["time"])
+                    if self.db.execute(INSERT, *values) is None and not self.booked(booking):
+                        # In the same transaction, so the patient is told exactly when the booking is settled
+                        self.db.execute(REJECT, *values)
+                        rejected.append(booking)
+            bookings_committed.send(self, bookings=bookings)
+        return rejected
+
+    def booked(self, booking):
+        """Tell whether the booking's slot already belongs to the same patient, e.g. after a replay."""
+        rows = self.db.execute("SELECT user_id FROM appointment WHERE doctor_id=? AND date=? AND time=?",
+                               booking["doctor_id"], booking["date"], booking["time"])
+        return bool(rows) and rows[0]["user_id"] == booking["user_id"]
+
+    def recover(self):
+        """Commit and remove every journal no running writer holds, returning how many bookings they held."""
+        app = current_app._get_current_object()
+        recovered = 0
+        prefix = app.config["BOOKING_JOURNAL"] + "."
+        for path in glob.glob(f"{glob.escape(prefix)}*"):
+            if not path[len(prefix):].split("-", 1)[0].isdigit():
+                continue
+            try:
+                f = open(path, encoding="utf-8")
+            except FileNotFoundError:
+                # Another process has just replayed it
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Its writer is alive, or another process is replaying it
+                    continue
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    # Replayed and removed while this process was opening it
+                    continue
+                bookings = []
+                for line in f:
+                    try:
+                        bookings.append(json.loads(line))
+                    except ValueError:
+                        # The last line of a crashed writer may be cut short
+                        pass
+                batch = app.config["BOOKING_BATCH"]
+                for start in range(0, len(bookings), batch):
+                    self.commit(app, bookings[start:start + batch])
+                os.remove(path)
+            recovered += len(bookings)
+        return recovered
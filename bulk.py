@@ -0,0 +1,178 @@
+"""
+Bulk import and export of patients, doctors and appointments.
+
+Imports read CSV or JSON Lines one chunk at a time. Rows are checked with
+the same rules as /pregister, /add and /pbook. Each chunk's passwords are
+hashed across the whole hashing pool, then the chunk is inserted in a single
+transaction. A bad row is reported with its line number and does not stop
+the rest of the file. Exports stream a table in id order through the same
+keyset batches as the admin listings, so no table is ever loaded whole.
+Exports never include passwords or hashes, so an exported patient or doctor
+file needs a password column added before it can be imported again.
+"""
+import csv
+import datetime
+import io
+import json
+import sqlite3
+from itertools import islice
+
+from helpers import doctor_problem, patient_problem
+from queries import keyset_rows
+
+# Rows validated, hashed and inserted per transaction
+CHUNK_SIZE = 500
+
+# Columns each kind of record is imported from
+COLUMNS = {
+    "patients": ("id", "fname", "lname", "mail", "contact", "password", "gender"),
+    "doctors": ("id", "fname", "lname", "email", "password"),
+    "appointments": ("id", "user_id", "doctor_id", "doctor", "date", "time"),
+}
+# Exports leave out passwords, which this schema stores in plain text, and never read the hash column
+EXPORTED = {kind: tuple(column for column in columns if column != "password") for kind, columns in COLUMNS.items()}
+TABLES = {"patients": "users", "doctors": "doctors", "appointments": "appointment"}
+
+
+def field(row, name):
+    value = row.get(name)
+    return "" if value is None else str(value).strip()
+
+
+def prepare_patient(row, slot_index):
+    password = field(row, "password")
+    values = (field(row, "fname"), field(row, "lname"), field(row, "mail"), field(row, "contact"),
+              password, field(row, "gender") or "N/A")
+    return patient_problem(*values[:5], password), values
+
+
+def prepare_doctor(row, slot_index):
+    password = field(row, "password")
+    values = (field(row, "fname"), field(row, "lname"), field(row, "email"), password)
+    return doctor_problem(*values, password), values
+
+
+def prepare_appointment(row, slot_index):
+    user_id, doctor_id, date = field(row, "user_id"), field(row, "doctor_id"), field(row, "date")
+    # isdecimal(), not isdigit(): int() refuses digits like "²"
+    if not user_id.isdecimal() or not doctor_id.isdecimal():
+        return "Please give a patient id and a doctor id", None
+    try:
+        date = datetime.date.fromisoformat(date).isoformat()
+    except ValueError:
+        return "Please choose a date!", None
+    slot = slot_index.slot(field(row, "time"))
+    if slot is None:
+        return "Please choose a time between 06:00 and 18:00!", None
+    return None, (int(user_id), date, slot_index.time(slot), int(doctor_id), int(user_id))
+
+
+# kind: (row preparer, position of the password in its values or None,
+#        INSERT taking the values (plus the hash), message for a duplicate)
+IMPORTS = {
+    "patients": (prepare_patient, 4,
+                 "INSERT INTO users(fname,lname,mail,contact,password,gender,hash) VALUES(?,?,?,?,?,?,?)",
+                 "This user already exists"),
+    "doctors": (prepare_doctor, 3,
+                "INSERT INTO doctors(fname,lname,email,password,hash) VALUES(?,?,?,?,?)",
+                "This email already exists"),
+    "appointments": (prepare_appointment, None, """
+        INSERT INTO appointment(user_id,doctor_id,doctor,date,time)
+        SELECT ?, id, fname || ' ' || lname, ?, ? FROM doctors
+        WHERE id = ? AND EXISTS (SELECT 1 FROM users WHERE id = ?)
+    """, "That time is taken"),
+}
+
+
+def decoded(stream, bad):
+    """Yield a binary stream's lines as text, with each line that is not UTF-8 noted in bad and given as a blank line."""
+    for number, line in enumerate(stream, start=1):
+        try:
+            text = line.decode("utf-8-sig" if number == 1 else "utf-8")
+        except UnicodeDecodeError:
+            bad.append(number)
+            text = "\n"
+        yield text
+
+
+def read_rows(stream, fmt):
+    """Yield (line number, record) from a binary CSV or JSON Lines stream; unreadable records, including lines that are not UTF-8, are None."""
+    bad = []
+    lines = decoded(stream, bad)
+    if fmt == "csv":
+        # Blank lines are skipped by the reader, so a line that cannot be decoded only loses its own row
+        reader = csv.DictReader(lines)
+        for row in reader:
+            while bad and bad[0] < reader.line_num:
+                yield bad.pop(0), None
+            yield reader.line_num, row
+        for number in bad:
+            yield number, None
+        return
+    for number, line in enumerate(lines, start=1):
+        if bad and bad[0] == number:
+            yield bad.pop(0), None
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+
+def import_rows(db, hasher, kind, rows, slot_index, chunk=CHUNK_SIZE):
+    """Validate and insert (line number, record) pairs, returning (rows inserted, [(line, error), ...])."""
+    prepare, password, insert, duplicate = IMPORTS[kind]
+    inserted = 0
+    errors = []
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, chunk))
+        if not batch:
+            return inserted, errors
+        valid = []
+        for number, record in batch:
+            if record is None:
+                errors.append((number, "Not a readable record (is the file UTF-8?)"))
+                continue
+            problem, values = prepare(record, slot_index)
+            if problem:
+                errors.append((number, problem))
+            else:
+                valid.append((number, values))
+        if password is not None:
+            hashes = hasher.generate_many([values[password] for _, values in valid])
+            valid = [(number, values + (hashed,)) for (number, values), hashed in zip(valid, hashes)]
+        with db.transaction():
+            for number, values in valid:
+                try:
+                    added = db.execute(insert, *values)
+                except sqlite3.IntegrityError:
+                    errors.append((number, duplicate))
+                    continue
+                if added is None:
+                    errors.append((number, "No such patient or doctor"))
+                else:
+                    inserted += 1
+
+
+def export_rows(db, kind, fmt):
+    """Yield a whole table as CSV or JSON Lines text, one batch of rows at a time."""
+    columns = EXPORTED[kind]
+    query = f"SELECT {','.join(columns)} FROM {TABLES[kind]} WHERE {{cond}}"
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for row in keyset_rows(db, query):
+            writer.writerow(row[column] for column in columns)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for row in keyset_rows(db, query):
+            yield json.dumps(row) + "\n"
@@ -0,0 +1,206 @@
+"""In-process caches for data that changes far less often than it is read."""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, render_template
+
+
+class Roster:
+    """One app's doctors, as loaded at a version of the roster."""
+
+    def __init__(self):
+        self.version = 0
+        self.loaded = None
+        self.doctors = []
+        self.by_id = {}
+        self.by_name = {}
+
+
+class DoctorDirectory:
+    """
+    The doctor roster, reloaded only after a write has bumped its version.
+
+    Every write to doctors must call bump(). With DOCTOR_VERSION_FILE, the
+    version is also shared between worker processes: bump() stamps the file
+    with a new token and every worker reloads once it sees the token change.
+    Each app keeps its own roster in app.extensions["doctor_roster"].
+    """
+
+    def __init__(self, version_file=None):
+        self.version_file = version_file
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """Register the DOCTOR_VERSION_FILE setting and give the app an empty roster."""
+        app.config.setdefault("DOCTOR_VERSION_FILE", self.version_file)
+        app.extensions["doctor_directory"] = self
+        app.extensions["doctor_roster"] = Roster()
+
+    def token(self):
+        """Return the current version, including other workers' bumps when sharing a file."""
+        version = current_app.extensions["doctor_roster"].version
+        version_file = current_app.config["DOCTOR_VERSION_FILE"]
+        if version_file is None:
+            return version
+        try:
+            with open(version_file) as f:
+                return version, f.read()
+        except FileNotFoundError:
+            return version, None
+
+    def bump(self):
+        """Invalidate the roster here and, when sharing a file, in every other worker."""
+        roster = current_app.extensions["doctor_roster"]
+        with self.lock:
+            roster.version += 1
+        version_file = current_app.config["DOCTOR_VERSION_FILE"]
+        if version_file is not None:
+            temp = f"{version_file}.{os.getpid()}.{threading.get_ident()}"
+            with open(temp, "w") as f:
+                f.write(f"{time.time_ns()}-{os.getpid()}-{roster.version}")
+            os.replace(temp, version_file)
+
+    def refresh(self, db):
+        """Reload the roster if its version has changed since the last load, returning it."""
+        roster = current_app.extensions["doctor_roster"]
+        token = self.token()
+        if token == roster.loaded:
+            return roster
+        with self.lock:
+            if token == roster.loaded:
+                return roster
+            doctors = db.execute("SELECT id,fname,lname FROM doctors ORDER BY id")
+            by_name = {}
+            for doctor in doctors:
+                by_name.setdefault(doctor["fname"] + " " + doctor["lname"], []).append(doctor)
+            roster.doctors = doctors
+            roster.by_id = {doctor["id"]: doctor for doctor in doctors}
+            roster.by_name = by_name
+            roster.loaded = token
+        return roster
+
+    def all(self, db):
+        """Return every doctor as a dict with id, fname and lname."""
+        return self.refresh(db).doctors
+
+    def find(self, db, doctor):
+        """Look a doctor up by id or by an unambiguous "fname lname", returning None if not found."""
+        roster = self.refresh(db)
+        # isdecimal(), not isdigit(): int() refuses digits like "²"
+        if doctor.isdecimal():
+            return roster.by_id.get(int(doctor))
+        matches = roster.by_name.get(doctor, [])
+        return matches[0] if len(matches) == 1 else None
+
+
+class ProfileCache:
+    """
+    "fname lname" of signed-in patients and doctors, keyed by (role, id).
+
+    Filled at login, so dashboards greet the user without a query. Entries
+    last PROFILE_CACHE_TTL seconds and at most PROFILE_CACHE_SIZE are kept,
+    least recently used first out. Every write to a user's name must call
+    forget(); other workers pick the change up within the TTL. Each app
+    keeps its own entries.
+    """
+
+    TABLES = {"patient": "users", "doctor": "doctors"}
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register defaults for the cache size and TTL in app.config."""
+        app.config.setdefault("PROFILE_CACHE_SIZE", 10000)
+        app.config.setdefault("PROFILE_CACHE_TTL", 300)
+        app.extensions["profile_cache"] = self
+        app.extensions["profile_cache_entries"] = OrderedDict()
+
+    @property
+    def entries(self):
+        return current_app.extensions["profile_cache_entries"]
+
+    def put(self, role, user_id, row):
+        """Remember a user's name from a row with fname and lname, returning it."""
+        name = row["fname"] + " " + row["lname"]
+        with self.lock:
+            self.entries[(role, user_id)] = (time.monotonic() + current_app.config["PROFILE_CACHE_TTL"], name)
+            self.entries.move_to_end((role, user_id))
+            if len(self.entries) > current_app.config["PROFILE_CACHE_SIZE"]:
+                self.entries.popitem(last=False)
+        return name
+
+    def name(self, db, role, user_id):
+        """Return a patient's or doctor's name, querying only when it is not cached or has expired."""
+        with self.lock:
+            entry = self.entries.get((role, user_id))
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end((role, user_id))
+                return entry[1]
+        rows = db.execute(f"SELECT fname,lname FROM {self.TABLES[role]} WHERE id=?", user_id)
+        return self.put(role, user_id, rows[0])
+
+    def forget(self, role, user_id):
+        with self.lock:
+            self.entries.pop((role, user_id), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RenderCache:
+    """
+    Rendered pages and fragments, each kept until its key changes.
+
+    Enabled by RENDER_CACHE, which defaults to on unless templates are
+    auto-reloaded. init_app then compiles every template up front, so no
+    request pays for parsing one or for Jinja re-checking its source file.
+    Each app keeps its own entries.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the RENDER_CACHE setting and precompile templates when it is on."""
+        app.config.setdefault("RENDER_CACHE", not app.config.get("TEMPLATES_AUTO_RELOAD"))
+        app.extensions["render_cache"] = self
+        app.extensions["render_cache_entries"] = {}
+        if app.config["RENDER_CACHE"]:
+            self.precompile(app)
+
+    def precompile(self, app):
+        """Compile every template into app's Jinja cache, returning how many there are."""
+        env = app.jinja_env
+        names = env.list_templates()
+        for name in names:
+            env.get_template(name)
+        return len(names)
+
+    @property
+    def entries(self):
+        return current_app.extensions["render_cache_entries"]
+
+    def get(self, name, key, render):
+        """Return the cached output for name if it was rendered under key, otherwise render and cache it."""
+        if not current_app.config["RENDER_CACHE"]:
+            return render()
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        output = render()
+        self.entries[name] = (key, output)
+        return output
+
+    def page(self, template):
+        """Render a template that takes no context, once."""
+        return self.get(template, None, lambda: render_template(template))
+
+    def clear(self):
+        self.entries.clear()
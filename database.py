@@ -0,0 +1,88 @@
+"""
+SQLite access for the app.
+
+Replaces the single shared cs50 SQL handle with one connection per thread and
+database file, so concurrent requests never queue on a shared connection.
+Connections run in WAL mode, wait out short write locks instead of failing
+with "database is locked", and keep their prepared statements cached.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from flask import current_app
+
+
+class Database:
+    """Per-thread SQLite connections behind a cs50-style execute()."""
+
+    def __init__(self, app=None, path=None, timeout=30, statement_cache=256, pragmas=None):
+        self.path = path
+        self.timeout = timeout
+        self.statement_cache = statement_cache
+        self.pragmas = pragmas or {}
+        self.local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register defaults for the database settings in app.config."""
+        app.config.setdefault("DATABASE", "patients.db")
+        app.config.setdefault("DATABASE_TIMEOUT", self.timeout)
+        app.config.setdefault("DATABASE_STATEMENT_CACHE", self.statement_cache)
+        app.extensions["database"] = self
+
+    def settings(self):
+        """Return (path, timeout, statement cache size) from the fixed path or the current app."""
+        if self.path is not None:
+            return self.path, self.timeout, self.statement_cache
+        config = current_app.config
+        return config["DATABASE"], config["DATABASE_TIMEOUT"], config["DATABASE_STATEMENT_CACHE"]
+
+    def connection(self):
+        """Return this thread's connection to the configured database, opening it if needed."""
+        path, timeout, cache = self.settings()
+        connections = self.local.__dict__.setdefault("connections", {})
+        conn = connections.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, timeout=timeout, cached_statements=cache,
+                                   isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for name, value in self.pragmas.items():
+                conn.execute(f"PRAGMA {name}={value}")
+            connections[path] = conn
+        return conn
+
+    def execute(self, sql, *args):
+        """
+        Run one statement.
+
+        Like cs50's SQL.execute, returns a list of dicts for queries, the new
+        row's id for INSERT and the number of affected rows otherwise.
+        """
+        cursor = self.connection().execute(sql, args)
+        if cursor.description is not None:
+            return [dict(row) for row in cursor.fetchall()]
+        if sql.lstrip()[:6].upper() == "INSERT":
+            return cursor.lastrowid if cursor.rowcount else None
+        return cursor.rowcount
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements in one write transaction, rolled back on error."""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def close(self):
+        """Close this thread's connections."""
+        for conn in self.local.__dict__.pop("connections", {}).values():
+            conn.close()
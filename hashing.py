@@ -0,0 +1,129 @@
+"""
+Password hashing off the request threads.
+
+Hashes run in a process pool so a burst of logins cannot starve every other
+request of CPU. At most HASH_QUEUE_LIMIT hashes may be queued or running at
+once; beyond that, Overloaded is raised and the app answers 503 with a
+Retry-After header instead of piling up more work. Bulk imports share the
+same queue, but each hash waits for a free place and at most
+HASH_IMPORT_SLOTS of them are queued at once, so logins that arrive during
+an import are hashed between its passwords rather than after all of them.
+Each app gets its own pool and queue, sized from its own settings.
+"""
+import os
+import threading
+from collections import namedtuple
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# One app's hashing processes (None to hash inline) and the places in their queue
+HashQueue = namedtuple("HashQueue", ["pool", "slots", "import_slots"])
+
+
+class Overloaded(Exception):
+    """Raised when the hashing queue is full."""
+
+
+class PasswordHasher:
+    """Generate and check password hashes in a bounded worker pool."""
+
+    def __init__(self, app=None):
+        self.prefixes = {}
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register defaults for the hashing settings in app.config."""
+        app.config.setdefault("PASSWORD_HASH_METHOD", "pbkdf2:sha256:600000")
+        app.config.setdefault("HASH_WORKERS", os.cpu_count() or 1)
+        app.config.setdefault("HASH_QUEUE_LIMIT", 4 * app.config["HASH_WORKERS"])
+        app.config.setdefault("HASH_RETRY_AFTER", 2)
+        app.config.setdefault("HASH_IMPORT_SLOTS", max(1, app.config["HASH_WORKERS"]))
+        app.extensions["hasher"] = self
+
+    def start(self):
+        """Return the current app's HashQueue, creating its pool and queue limits on first use."""
+        queue = current_app.extensions.get("hash_queue")
+        if queue is not None:
+            return queue
+        with self.lock:
+            queue = current_app.extensions.get("hash_queue")
+            if queue is None:
+                config = current_app.config
+                pool = None
+                if config["HASH_WORKERS"]:
+                    # Imported here since it pulls in multiprocessing, which most app imports never need
+                    from concurrent.futures import ProcessPoolExecutor
+                    pool = ProcessPoolExecutor(config["HASH_WORKERS"])
+                queue = current_app.extensions["hash_queue"] = HashQueue(
+                    pool, threading.BoundedSemaphore(config["HASH_QUEUE_LIMIT"]),
+                    threading.BoundedSemaphore(config["HASH_IMPORT_SLOTS"]))
+            return queue
+
+    def run(self, fn, *args):
+        """Run fn in the pool, or inline when HASH_WORKERS is 0, raising Overloaded if the queue is full."""
+        queue = self.start()
+        if not queue.slots.acquire(blocking=False):
+            raise Overloaded()
+        try:
+            if queue.pool is None:
+                return fn(*args)
+            return queue.pool.submit(fn, *args).result()
+        finally:
+            queue.slots.release()
+
+    def generate(self, password):
+        """Hash a password with the configured method."""
+        return self.run(generate_password_hash, password, current_app.config["PASSWORD_HASH_METHOD"])
+
+    def generate_many(self, passwords):
+        """Hash a batch of passwords for bulk imports, waiting for queue places instead of raising Overloaded."""
+        pool, slots, import_slots = self.start()
+        method = current_app.config["PASSWORD_HASH_METHOD"]
+        if pool is None:
+            return [generate_password_hash(password, method) for password in passwords]
+
+        def release(future):
+            slots.release()
+            import_slots.release()
+        futures = []
+        for password in passwords:
+            import_slots.acquire()
+            slots.acquire()
+            try:
+                future = pool.submit(generate_password_hash, password, method)
+            except BaseException:
+                release(None)
+                raise
+            future.add_done_callback(release)
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def check(self, pwhash, password):
+        """Check a password against a stored hash."""
+        return self.run(check_password_hash, pwhash, password)
+
+    def rehash(self, pwhash, password):
+        """Return a new hash of password if pwhash was made with a different method or cost than configured, else None.
+
+        Raises Overloaded like generate(). Werkzeug fills in default
+        parameters, so a method's full prefix is only learnt from the first
+        hash made with it, which is made in the pool like any other.
+        """
+        method = current_app.config["PASSWORD_HASH_METHOD"]
+        prefix = self.prefixes.get(method)
+        if prefix is not None and pwhash.split("$", 1)[0] == prefix:
+            return None
+        new = self.generate(password)
+        self.prefixes[method] = new.split("$", 1)[0]
+        return None if pwhash.split("$", 1)[0] == self.prefixes[method] else new
+
+    def shutdown(self, app=None):
+        """Stop app's pool, or the current app's; it is recreated on next use."""
+        with self.lock:
+            queue = (app or current_app).extensions.pop("hash_queue", None)
+        if queue is not None and queue.pool is not None:
+            queue.pool.shutdown()
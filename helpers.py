@@ -1,10 +1,14 @@
-import os
-import requests
-import urllib.parse
 
-from flask import redirect, render_template, request, session
+from blinker import Namespace
+from collections import namedtuple
+from flask import current_app, g, render_template, session
 from functools import wraps
 
+# Signals for instrumentation; sending them costs next to nothing when nobody listens
+signals = Namespace()
+apology_rendered = signals.signal("apology-rendered")
+login_checked = signals.signal("login-checked")
+
 def apology(message, code=400):
     """Render message as an apology to user."""
     def escape(s):
@@ -17,18 +21,70 @@ def apology(message, code=400):
                          ("%", "~p"), ("#", "~h"), ("/", "~s"), ("\"", "''")]:
             s = s.replace(old, new)
         return s
+    apology_rendered.send(current_app._get_current_object(), code=code, message=message)
     return render_template("apology.html", top=code, bottom=escape(message)), code
 
-def login_required(f):
+# Who is signed in: role is "patient", "doctor" or "admin", and id is a row id in that role's table
+Principal = namedtuple("Principal", ["role", "id"])
+
+def sign_in(role, user_id):
+    """Remember who has logged in; call after session.clear()."""
+    session["user_id"] = user_id
+    session["role"] = role
+
+def forget_principal():
+    """Drop the principal cached on g; runs before each request, since g outlives one when an app context was already pushed."""
+    g.pop("principal", None)
+
+def principal():
+    """Return the signed-in Principal, or None, reading the session only once per request."""
+    if "principal" not in g:
+        role, user_id = session.get("role"), session.get("user_id")
+        g.principal = None if role is None or user_id is None else Principal(role, user_id)
+    return g.principal
+
+def requires(*roles):
     """
-    Decorate routes to require login.
+    Decorate routes to require a user signed in with one of the given roles.
 
-    https://flask.palletsprojects.com/en/1.1.x/patterns/viewdecorators/
+    Anyone else is turned away before the view runs any SQL; views find
+    the user in principal().
     """
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if session.get("user_id") is None:
-            return apology("Must Login!")
-        return f(*args, **kwargs)
-    return decorated_function
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            user = principal()
+            allowed = user is not None and user.role in roles
+            login_checked.send(current_app._get_current_object(), allowed=allowed)
+            if user is None:
+                return apology("Must Login!")
+            if not allowed:
+                return apology("Not allowed here", 403)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def patient_problem(fname, lname, email, contact, password, confirmation):
+    """Return why a patient registration is invalid, or None if it is fine."""
+    if not fname or not lname:
+        return "Please enter your first and last name"
+    if not email or not contact:
+        return "Please enter your email id and your contact info"
+    if not password or not confirmation:
+        return "Please enter a password and confirm it"
+    if password != confirmation:
+        return "Your passwords do not match"
+    return None
 
+def doctor_problem(fname, lname, email, password, confirmation):
+    """Return why a new doctor's details are invalid, or None if they are fine."""
+    if not fname or not lname:
+        return "Please enter your first and last name"
+    if not email:
+        return "Please enter your email id"
+    if not password or not confirmation:
+        return "Please enter a password and confirm it"
+    if password != confirmation:
+        return "Your passwords do not match"
+    return None
@@ -0,0 +1,90 @@
+"""
+Per-route Cache-Control policy.
+
+Files under static/ are linked through static_url(), which adds a hash of the
+file's contents to the URL, so a versioned URL can be cached for a year and
+marked immutable. Views decorated with @public carry an ETag and a
+Last-Modified date and must be revalidated, which lets browsers get a 304
+instead of the whole page. Every other response, including anything showing
+patient details, is still sent with no-store. Set HTTP_CACHE to False to go
+back to no-store everywhere.
+"""
+import hashlib
+import os
+from datetime import datetime, timezone
+
+from flask import current_app, request, url_for
+
+# Cache-Control for each kind of response
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+NO_STORE = "no-cache, no-store, must-revalidate"
+
+
+def public(f):
+    """Mark a view as the same for every visitor, so its GET responses may be cached and revalidated."""
+    f.public = True
+    return f
+
+
+class HttpCache:
+    """Sets caching headers on every response; each app keeps its own static file hashes."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register the after_request hook and the static_url() template global."""
+        app.config.setdefault("HTTP_CACHE", True)
+        app.extensions["http_cache"] = self
+        app.extensions["static_versions"] = {}
+        app.after_request(self.headers)
+        app.add_template_global(self.static_url)
+        # Public pages only change when a template or a static file they link to does
+        folders = (os.path.join(app.root_path, app.template_folder), app.static_folder)
+        app.extensions["static_last_modified"] = datetime.fromtimestamp(
+            max(os.path.getmtime(os.path.join(folder, name)) for folder in folders for name in os.listdir(folder)),
+            timezone.utc)
+
+    def version(self, filename):
+        """Return a short hash of a static file's contents, rechecking its mtime only while templates auto-reload."""
+        path = os.path.join(current_app.static_folder, filename)
+        versions = current_app.extensions["static_versions"]
+        cached = versions.get(path)
+        if cached is not None and not current_app.config["TEMPLATES_AUTO_RELOAD"]:
+            return cached[1]
+        mtime = os.path.getmtime(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, "rb") as f:
+                cached = versions[path] = (mtime, hashlib.sha256(f.read()).hexdigest()[:12])
+        return cached[1]
+
+    def static_url(self, filename):
+        """URL of a static file, versioned by its contents."""
+        return url_for("static", filename=filename, v=self.version(filename))
+
+    def headers(self, response):
+        if not current_app.config["HTTP_CACHE"]:
+            return self.no_store(response)
+        if request.endpoint == "static":
+            filename = request.view_args["filename"]
+            if response.status_code == 200 or response.status_code == 304:
+                versioned = request.args.get("v") == self.version(filename)
+                response.headers["Cache-Control"] = IMMUTABLE if versioned else REVALIDATE
+                return response
+            return self.no_store(response)
+        view = current_app.view_functions.get(request.endpoint)
+        if (getattr(view, "public", False) and request.method in ("GET", "HEAD")
+                and response.status_code == 200 and not response.is_streamed):
+            response.headers["Cache-Control"] = REVALIDATE
+            response.last_modified = current_app.extensions["static_last_modified"]
+            response.add_etag()
+            return response.make_conditional(request)
+        return self.no_store(response)
+
+    def no_store(self, response):
+        response.headers["Cache-Control"] = NO_STORE
+        response.headers["Expires"] = 0
+        response.headers["Pragma"] = "no-cache"
+        return response
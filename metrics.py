@@ -0,0 +1,242 @@
+"""
+Opt-in request instrumentation, exported in Prometheus text format.
+
+With METRICS_ENABLED set, every request records its latency, the number and
+total time of its database queries, time spent hashing passwords and time
+spent rendering each template, plus counts of apologies and login checks.
+GET /metrics serves the totals. With METRICS_PROFILE_DIR set, a request
+carrying the METRICS_PROFILE_HEADER header is also run under cProfile and its
+stats are dumped there for pstats/snakeviz, but only for a signed-in admin or
+when the header's value is METRICS_PROFILE_SECRET; anyone else's header is
+ignored, so outsiders cannot fill the disk with dumps.
+
+/metrics reveals traffic and timings, so it is for the scraper only. Set
+METRICS_TOKEN and it answers 403 unless the request carries
+"Authorization: Bearer <METRICS_TOKEN>" (Prometheus' bearer_token setting).
+Without a token it is open to anyone who can reach the app, so block
+/metrics at the reverse proxy in front of it.
+"""
+import hmac
+import cProfile
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import Response, abort, before_render_template, current_app, request, template_rendered
+
+from helpers import apology_rendered, login_checked, principal
+
+# Histogram bucket upper bounds
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES = (0, 1, 2, 3, 5, 10, 20, 50, 100, 1000)
+
+# Per-request state while instrumentation is on; None otherwise
+current = ContextVar("metrics", default=None)
+
+
+class Histogram:
+    """Cumulative bucket counts with a running sum."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Collects per-route and per-template measurements; each app keeps its own histograms and counters."""
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Hook into the app's requests, database, hasher, templates and helpers."""
+        app.config.setdefault("METRICS_ENABLED", False)
+        app.config.setdefault("METRICS_PROFILE_DIR", None)
+        app.config.setdefault("METRICS_PROFILE_HEADER", "X-Profile")
+        app.config.setdefault("METRICS_PROFILE_SECRET", None)
+        app.config.setdefault("METRICS_TOKEN", None)
+        app.extensions["metrics"] = self
+        app.extensions["metrics_histograms"] = {}
+        app.extensions["metrics_counters"] = {}
+
+        app.before_request(self.start)
+        app.after_request(self.status)
+        app.teardown_request(self.finish)
+        app.add_url_rule("/metrics", "metrics", self.export)
+
+        for name in ("database", "hasher"):
+            extension = app.extensions.get(name)
+            method = "execute" if name == "database" else "run"
+            # Extensions are shared by every app built from them, so wrap each one only once
+            if extension is not None and not hasattr(getattr(extension, method), "timed"):
+                setattr(extension, method, self.timed(getattr(extension, method), name))
+
+        before_render_template.connect(self.template_started, app)
+        template_rendered.connect(self.template_finished, app)
+        apology_rendered.connect(self.apologised, app)
+        login_checked.connect(self.login_checked, app)
+
+    @property
+    def histograms(self):
+        return current_app.extensions["metrics_histograms"]
+
+    @property
+    def counters(self):
+        return current_app.extensions["metrics_counters"]
+
+    # Recording
+
+    def observe(self, name, labels, value, buckets=SECONDS):
+        histograms = self.histograms
+        with self.lock:
+            histogram = histograms.get((name, labels))
+            if histogram is None:
+                histogram = histograms[(name, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, name, labels, value=1):
+        counters = self.counters
+        with self.lock:
+            counters[(name, labels)] = counters.get((name, labels), 0) + value
+
+    def timed(self, fn, kind):
+        """Wrap a database or hasher method so calls made during a request are timed."""
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            state = current.get()
+            if state is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                state[kind + "_seconds"] += time.perf_counter() - start
+                state[kind + "_calls"] += 1
+        wrapper.timed = kind
+        return wrapper
+
+    # Request hooks
+
+    def start(self):
+        config = current_app.config
+        if not config["METRICS_ENABLED"] or request.endpoint == "metrics":
+            return
+        state = {"start": time.perf_counter(), "status": 500, "templates": [], "profile": None,
+                 "database_seconds": 0, "database_calls": 0, "hasher_seconds": 0, "hasher_calls": 0}
+        if config["METRICS_PROFILE_DIR"] and self.may_profile():
+            state["profile"] = cProfile.Profile()
+            state["profile"].enable()
+        current.set(state)
+
+    def may_profile(self):
+        """Tell whether this request asked to be profiled and is allowed to be."""
+        config = current_app.config
+        value = request.headers.get(config["METRICS_PROFILE_HEADER"])
+        if value is None:
+            return False
+        if config["METRICS_PROFILE_SECRET"] and hmac.compare_digest(value.encode(), config["METRICS_PROFILE_SECRET"].encode()):
+            return True
+        user = principal()
+        return user is not None and user.role == "admin"
+
+    def status(self, response):
+        state = current.get()
+        if state is not None:
+            state["status"] = response.status_code
+        return response
+
+    def finish(self, exc):
+        state = current.get()
+        if state is None:
+            return
+        current.set(None)
+        route = (request.endpoint or "unknown",)
+        self.observe("http_request_duration_seconds", route, time.perf_counter() - state["start"])
+        self.increment("http_requests_total", route + (str(state["status"]),))
+        self.observe("db_queries_per_request", route, state["database_calls"], QUERIES)
+        self.increment("db_query_seconds_total", route, state["database_seconds"])
+        self.increment("password_hash_seconds_total", route, state["hasher_seconds"])
+        if state["profile"] is not None:
+            state["profile"].disable()
+            name = f"{route[0]}-{time.time_ns()}.prof"
+            state["profile"].dump_stats(os.path.join(current_app.config["METRICS_PROFILE_DIR"], name))
+
+    # Signal receivers
+
+    def template_started(self, app, template, context):
+        state = current.get()
+        if state is not None:
+            state["templates"].append(time.perf_counter())
+
+    def template_finished(self, app, template, context):
+        state = current.get()
+        if state is not None and state["templates"]:
+            self.observe("template_render_seconds", (template.name,), time.perf_counter() - state["templates"].pop())
+
+    def apologised(self, app, code, message):
+        if current.get() is not None:
+            self.increment("apologies_total", (request.endpoint or "unknown", str(code)))
+
+    def login_checked(self, app, allowed):
+        if current.get() is not None:
+            self.increment("login_required_total", (request.endpoint or "unknown", "allowed" if allowed else "rejected"))
+
+    # Export
+
+    LABELS = {
+        "http_request_duration_seconds": ("route",),
+        "http_requests_total": ("route", "status"),
+        "db_queries_per_request": ("route",),
+        "db_query_seconds_total": ("route",),
+        "password_hash_seconds_total": ("route",),
+        "template_render_seconds": ("template",),
+        "apologies_total": ("route", "code"),
+        "login_required_total": ("route", "result"),
+    }
+
+    def labels(self, name, values, extra=None):
+        pairs = [f'{key}="{value}"' for key, value in zip(self.LABELS[name], values)]
+        if extra is not None:
+            pairs.append(f'le="{extra}"')
+        return "{" + ",".join(pairs) + "}"
+
+    def export(self):
+        """Serve all metrics in the Prometheus text exposition format."""
+        if not current_app.config["METRICS_ENABLED"]:
+            abort(404)
+        token = current_app.config["METRICS_TOKEN"]
+        # compare_digest() only takes str of ASCII, and headers can be anything
+        if token and not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+            abort(403)
+        lines = []
+        all_counters, all_histograms = self.counters, self.histograms
+        with self.lock:
+            for name in self.LABELS:
+                counters = sorted((values, value) for (key, values), value in all_counters.items() if key == name)
+                histograms = sorted((values, h) for (key, values), h in all_histograms.items() if key == name)
+                if counters:
+                    lines.append(f"# TYPE {name} counter")
+                for values, value in counters:
+                    lines.append(f"{name}{self.labels(name, values)} {value}")
+                if histograms:
+                    lines.append(f"# TYPE {name} histogram")
+                for values, histogram in histograms:
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self.labels(name, values, bound)} {cumulative}")
+                    lines.append(f"{name}_sum{self.labels(name, values)} {histogram.sum}")
+                    lines.append(f"{name}_count{self.labels(name, values)} {histogram.count}")
+        return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,329 @@
+"""
+Schema migrations for patients.db.
+
+Each migration runs once, in order, and bumps PRAGMA user_version when it
+finishes. Data backfills walk the table in small id ranges, committing after
+every batch, so the migrations can run against the live database while the
+app keeps serving requests.
+
+Usage: python migrations.py [patients.db] [--batch 1000]
+"""
+import argparse
+import os
+import sqlite3
+import urllib.parse
+
+# Rows updated per transaction during a backfill
+BATCH_SIZE = 1000
+
+# Seconds to wait for the app's writers to release the database
+BUSY_TIMEOUT = 30
+
+
+def columns(conn, table):
+    """Return the column names of a table."""
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def backfill(conn, sql, batch, table="appointment", last=None):
+    """
+    Run a statement over a table one id range at a time.
+
+    sql must restrict itself with "id > ? AND id <= ?"; each range is its own
+    short transaction so readers and writers can get in between batches.
+    Ranges stop at last, or at the table's highest id when last is None.
+    """
+    if last is None:
+        last = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+    start = 0
+    while start < last:
+        with conn:
+            conn.execute(sql, (start, min(start + batch, last)))
+        start += batch
+
+
+def doctor_id(conn, batch):
+    """Link appointments to doctors by id instead of by "fname lname"."""
+    if "doctor_id" not in columns(conn, "appointment"):
+        with conn:
+            conn.execute("ALTER TABLE appointment ADD COLUMN doctor_id INTEGER REFERENCES doctors(id)")
+
+    # Names shared by several doctors are ambiguous and are left unlinked
+    backfill(conn, """
+        UPDATE appointment SET doctor_id = (
+            SELECT id FROM doctors WHERE fname || ' ' || lname = appointment.doctor
+            GROUP BY fname, lname HAVING COUNT(*) = 1
+        )
+        WHERE doctor_id IS NULL AND id > ? AND id <= ?
+    """, batch)
+
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS appointment_doctor_slot ON appointment(doctor_id, date, time)")
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS appointment_user ON appointment(user_id)")
+
+
+def unique_slots(conn, batch):
+    """Allow at most one appointment per doctor, date and time."""
+    clashes = conn.execute("""
+        SELECT doctor_id, date, time FROM appointment WHERE doctor_id IS NOT NULL
+        GROUP BY doctor_id, date, time HAVING COUNT(*) > 1
+    """).fetchall()
+    if clashes:
+        raise SystemExit(f"Resolve double bookings before migrating: {clashes}")
+
+    # Swap the index in one transaction so lookups never lose it
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute("DROP INDEX IF EXISTS appointment_doctor_slot")
+        conn.execute("CREATE UNIQUE INDEX appointment_doctor_slot ON appointment(doctor_id, date, time)")
+
+
+# Full-text indexes: (indexed table, index table, indexed columns)
+SEARCH = [
+    ("users", "users_search", ("fname", "lname", "mail", "contact")),
+    ("doctors", "doctors_search", ("fname", "lname", "email")),
+]
+
+
+def search_index(conn, batch):
+    """Index patients and doctors for full-text and prefix search, kept in sync by triggers."""
+    for table, index, fields in SEARCH:
+        names = ", ".join(fields)
+        new = ", ".join("new." + field for field in fields)
+        old = ", ".join("old." + field for field in fields)
+        # Rows up to last are backfilled below; the triggers index everything written from here on
+        with conn:
+            conn.execute("BEGIN")
+            resumed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (index,)).fetchone()
+            conn.execute(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {index}
+                USING fts5({names}, content='{table}', content_rowid='id', prefix='2 3')
+            """)
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {index}(rowid, {names}) VALUES (new.id, {new});
+                END
+            """)
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {index}({index}, rowid, {names}) VALUES ('delete', old.id, {old});
+                END
+            """)
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {names} ON {table} BEGIN
+                    INSERT INTO {index}({index}, rowid, {names}) VALUES ('delete', old.id, {old});
+                    INSERT INTO {index}(rowid, {names}) VALUES (new.id, {new});
+                END
+            """)
+            last = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+            if resumed:
+                # An interrupted backfill left an unknown part indexed, so start that index over
+                conn.execute(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+                continue
+        backfill(conn, f"""
+            INSERT INTO {index}(rowid, {names}) SELECT id, {names} FROM {table} WHERE id > ? AND id <= ?
+        """, batch, table=table, last=last)
+
+
+def rebuild_aggregates(conn):
+    """Recount every aggregate table from the rows it summarises, in one transaction."""
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM totals")
+        conn.execute("DELETE FROM daily_appointments")
+        conn.execute("DELETE FROM weekly_registrations")
+        # Archived appointments still count towards history
+        appointments = "appointment"
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'appointment_archive'").fetchone():
+            appointments = """(
+                SELECT date, doctor_id FROM appointment UNION ALL SELECT date, doctor_id FROM appointment_archive
+            )"""
+        for name, table in (("patients", "users"), ("doctors", "doctors"), ("appointments", appointments)):
+            conn.execute(f"INSERT INTO totals(name, count) SELECT ?, COUNT(*) FROM {table}", (name,))
+        conn.execute(f"""
+            INSERT INTO daily_appointments(date, doctor_id, count)
+            SELECT date, COALESCE(doctor_id, 0), COUNT(*) FROM {appointments} GROUP BY 1, 2
+        """)
+        for kind, table in (("patients", "users"), ("doctors", "doctors")):
+            conn.execute(f"""
+                INSERT INTO weekly_registrations(week, kind, count)
+                SELECT date(created, 'weekday 0', '-6 days'), ?, COUNT(*) FROM {table}
+                WHERE created IS NOT NULL GROUP BY 1
+            """, (kind,))
+
+
+def aggregates(conn, batch):
+    """Keep running counts of registrations and bookings for the admin dashboard."""
+    for table in ("users", "doctors"):
+        if "created" not in columns(conn, table):
+            with conn:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN created TEXT")
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute("CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS daily_appointments (
+                date TEXT NOT NULL, doctor_id INTEGER NOT NULL, count INTEGER NOT NULL,
+                PRIMARY KEY (date, doctor_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS weekly_registrations (
+                week TEXT NOT NULL, kind TEXT NOT NULL, count INTEGER NOT NULL,
+                PRIMARY KEY (week, kind)
+            ) WITHOUT ROWID
+        """)
+        # Registrations are stamped and counted under the Monday of their week
+        for kind, table in (("patients", "users"), ("doctors", "doctors")):
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_count AFTER INSERT ON {table} BEGIN
+                    UPDATE {table} SET created = datetime('now') WHERE id = new.id AND new.created IS NULL;
+                    INSERT INTO totals(name, count) VALUES ('{kind}', 1)
+                        ON CONFLICT(name) DO UPDATE SET count = count + 1;
+                    INSERT INTO weekly_registrations(week, kind, count)
+                        VALUES (date(COALESCE(new.created, 'now'), 'weekday 0', '-6 days'), '{kind}', 1)
+                        ON CONFLICT(week, kind) DO UPDATE SET count = count + 1;
+                END
+            """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS appointment_count AFTER INSERT ON appointment BEGIN
+                INSERT INTO totals(name, count) VALUES ('appointments', 1)
+                    ON CONFLICT(name) DO UPDATE SET count = count + 1;
+                INSERT INTO daily_appointments(date, doctor_id, count) VALUES (new.date, COALESCE(new.doctor_id, 0), 1)
+                    ON CONFLICT(date, doctor_id) DO UPDATE SET count = count + 1;
+            END
+        """)
+    rebuild_aggregates(conn)
+
+
+def appointment_archive(conn, batch):
+    """Add the table archive.py moves past appointments into, and the date index it finds them by."""
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS appointment_archive (
+                id INTEGER PRIMARY KEY NOT NULL,
+                user_id INTEGER NOT NULL,
+                doctor_id INTEGER,
+                doctor TEXT NOT NULL,
+                date TEXT NOT NULL,
+                time TEXT NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS appointment_archive_user ON appointment_archive(user_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS appointment_archive_doctor ON appointment_archive(doctor_id, date, time)")
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS appointment_date ON appointment(date)")
+
+
+# An appointment's start as "YYYY-MM-DD HH:MM", which sorts in time order, from its free-form date and time.
+# Times like "9:00" get their leading zero; anything SQLite cannot read as a date and time gives NULL. The app only
+# writes ISO dates and HH:MM slot times (see pbook() and bulk.py), so rows it adds always get a start.
+STARTS = """strftime('%Y-%m-%d %H:%M', trim({date}) || ' ' ||
+    CASE WHEN instr(trim({time}), ':') = 2 THEN '0' ELSE '' END || trim({time}))"""
+
+
+def appointment_starts(conn, batch):
+    """Give appointments a sortable start, kept in step with date and time by triggers, and index each doctor's by it."""
+    for table in ("appointment", "appointment_archive"):
+        if "starts" not in columns(conn, table):
+            with conn:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN starts TEXT")
+    starts = STARTS.format(date="new.date", time="new.time")
+    last = {}
+    with conn:
+        conn.execute("BEGIN")
+        for table in ("appointment", "appointment_archive"):
+            # Writers need not know about starts; rows copied with it already set are left alone
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_starts AFTER INSERT ON {table} WHEN new.starts IS NULL BEGIN
+                    UPDATE {table} SET starts = {starts} WHERE id = new.id;
+                END
+            """)
+            conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_moved AFTER UPDATE OF date, time ON {table} BEGIN
+                    UPDATE {table} SET starts = {starts} WHERE id = new.id;
+                END
+            """)
+            last[table] = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+    for table in ("appointment", "appointment_archive"):
+        backfill(conn, f"""
+            UPDATE {table} SET starts = {STARTS.format(date="date", time="time")} WHERE id > ? AND id <= ?
+        """, batch, table=table, last=last[table])
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS appointment_doctor_starts ON appointment(doctor_id, starts)")
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS appointment_archive_doctor_starts ON appointment_archive(doctor_id, starts)")
+    # Booked slots per doctor and day are already counted in daily_appointments; this finds a doctor's days in order
+    with conn:
+        conn.execute("CREATE INDEX IF NOT EXISTS daily_appointments_doctor ON daily_appointments(doctor_id, date)")
+
+
+def booking_rejections(conn, batch):
+    """Keep queued bookings that lost their slot until the patient has been told, whichever process committed them."""
+    with conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS booking_rejections (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                doctor_id INTEGER,
+                doctor TEXT NOT NULL,
+                date TEXT NOT NULL,
+                time TEXT NOT NULL
+            )
+        """)
+    # Found by patient; a journal replayed twice records each lost booking once
+    with conn:
+        conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS booking_rejections_booking
+            ON booking_rejections(user_id, doctor_id, date, time)
+        """)
+
+
+def doctor_listing(conn, batch):
+    """Index each doctor's appointments in id order, so keyset batches of one doctor's listing seek instead of sorting."""
+    for table in ("appointment", "appointment_archive"):
+        with conn:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_doctor_id ON {table}(doctor_id, id)")
+
+
+# Applied in order; a database at user_version n has run the first n
+MIGRATIONS = [doctor_id, unique_slots, search_index, aggregates, appointment_archive, appointment_starts,
+              booking_rejections, doctor_listing]
+
+
+def pending(path):
+    """Return the names of the migrations an existing database at path has not run yet, without changing it."""
+    if not os.path.exists(path):
+        return []
+    conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro", uri=True, timeout=BUSY_TIMEOUT)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+    return [migration.__name__ for migration in MIGRATIONS[version:]]
+
+
+def migrate(path, batch=BATCH_SIZE):
+    """Bring the database at path up to the latest schema, returning the migrations run."""
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        done = []
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(conn, batch)
+            conn.execute(f"PRAGMA user_version = {number}")
+            done.append(migration.__name__)
+        return done
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate patients.db to the latest schema.")
+    parser.add_argument("database", nargs="?", default="patients.db")
+    parser.add_argument("--batch", type=int, default=BATCH_SIZE, help="rows updated per transaction")
+    args = parser.parse_args()
+    ran = migrate(args.database, args.batch)
+    print("Applied: " + ", ".join(ran) if ran else "Already up to date")
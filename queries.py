@@ -0,0 +1,160 @@
+"""Set-based read queries shared by the listing routes."""
+import datetime
+import re
+from collections import namedtuple
+
+# Number of rows fetched per round trip while streaming a listing
+BATCH_SIZE = 500
+
+# Number of rows shown per page of a paginated listing
+PAGE_SIZE = 100
+
+# Listing queries; {cond} is filled in with the keyset condition on id
+PATIENTS = "SELECT id,fname,lname,mail,contact,password FROM users WHERE {cond}"
+DOCTORS = "SELECT id,fname,lname,password,email FROM doctors WHERE {cond}"
+APPOINTMENTS = """
+    SELECT a.id, u.fname, u.lname, u.mail, u.contact,
+           COALESCE(d.fname || ' ' || d.lname, a.doctor) AS doctor, a.date, a.time
+    FROM appointment a JOIN users u ON u.id = a.user_id
+    LEFT JOIN doctors d ON d.id = a.doctor_id
+    WHERE {cond}
+"""
+DOCTOR_APPOINTMENTS = APPOINTMENTS.replace("{cond}", "a.doctor_id = ? AND {cond}")
+
+# One patient's own appointments
+PATIENT_APPOINTMENTS = """
+    SELECT a.id, COALESCE(d.fname || ' ' || d.lname, a.doctor) AS doctor, a.date, a.time
+    FROM appointment a LEFT JOIN doctors d ON d.id = a.doctor_id
+    WHERE a.user_id = ? ORDER BY a.id
+"""
+
+# One doctor's appointments starting in [first, after), in order, found by a range scan of (doctor_id, starts)
+CALENDAR = """
+    SELECT a.id, u.fname, u.lname, u.mail, u.contact, a.date, a.time, a.starts
+    FROM appointment a JOIN users u ON u.id = a.user_id
+    WHERE a.doctor_id = ? AND a.starts >= ? AND a.starts < ? ORDER BY a.starts
+"""
+
+# Booked slots on each day of [first, after) that a doctor has any, from the daily_appointments aggregate
+OCCUPANCY = "SELECT date, count FROM daily_appointments WHERE doctor_id = ? AND date >= ? AND date < ?"
+
+# Full-text searches over the indexes built by migrations.search_index, best match first
+SEARCHES = {
+    "patients": """
+        SELECT u.id, u.fname, u.lname, u.mail, u.contact
+        FROM users_search JOIN users u ON u.id = users_search.rowid
+        WHERE users_search MATCH ? ORDER BY rank LIMIT ?
+    """,
+    "doctors": """
+        SELECT d.id, d.fname, d.lname, d.email
+        FROM doctors_search JOIN doctors d ON d.id = doctors_search.rowid
+        WHERE doctors_search MATCH ? ORDER BY rank LIMIT ?
+    """,
+}
+
+# Rows returned by a search
+SEARCH_LIMIT = 50
+
+# Shortest word search() looks up; the FTS5 tables keep prefix indexes for 2 and 3 characters, so a
+# one-character prefix would scan the whole term list
+SEARCH_MIN_WORD = 2
+
+Page = namedtuple("Page", ["rows", "prev", "next"])
+
+
+def keyset_rows(db, query, *args, key="id", batch=BATCH_SIZE):
+    """
+    Yield every row of a listing query in id order.
+
+    Rows are fetched one batch per query, seeking past the last id seen,
+    so the whole listing never has to sit in memory.
+    """
+    last_id = 0
+    while True:
+        rows = db.execute(query.format(cond=f"{key} > ? ORDER BY {key} LIMIT ?"), *args, last_id, batch)
+        yield from rows
+        if len(rows) < batch:
+            return
+        last_id = rows[-1]["id"]
+
+
+def keyset_page(db, query, *args, key="id", after=None, before=None, size=PAGE_SIZE):
+    """
+    Return one page of a listing query along with the cursors around it.
+
+    Pages are addressed by the id just outside them (after= or before=),
+    so fetching page n costs the same as fetching the first one.
+    """
+    if before is not None:
+        rows = db.execute(query.format(cond=f"{key} < ? ORDER BY {key} DESC LIMIT ?"), *args, before, size + 1)
+        more = len(rows) > size
+        rows = rows[:size][::-1]
+        return Page(rows, rows[0]["id"] if more else None, rows[-1]["id"] if rows else None)
+    rows = db.execute(query.format(cond=f"{key} > ? ORDER BY {key} LIMIT ?"), *args, after or 0, size + 1)
+    more = len(rows) > size
+    rows = rows[:size]
+    return Page(rows, rows[0]["id"] if after and rows else None, rows[-1]["id"] if more else None)
+
+
+def appointments_with_patients(db, doctor_id=None, batch=BATCH_SIZE, history=False):
+    """Yield appointments joined with their patient's details, without per-row lookups, archived ones too with history."""
+    query = APPOINTMENTS if doctor_id is None else DOCTOR_APPOINTMENTS
+    args = () if doctor_id is None else (doctor_id,)
+    if history:
+        query = with_history(query)
+    return keyset_rows(db, query, *args, key="a.id", batch=batch)
+
+
+def search(db, kind, text, limit=SEARCH_LIMIT):
+    """
+    Return the patients or doctors best matching every word of text.
+
+    Each word matches as a prefix, so "ann 555" finds Annabel with a contact
+    number starting 555. Words shorter than SEARCH_MIN_WORD are ignored.
+    Punctuation only separates words, so input can never form FTS5 query
+    syntax.
+    """
+    words = [word for word in re.findall(r"\w+", text) if len(word) >= SEARCH_MIN_WORD]
+    if not words:
+        return []
+    return db.execute(SEARCHES[kind], " ".join(f'"{word}"*' for word in words), limit)
+
+
+def calendar_span(view, day):
+    """Return the first day, the day after the last and the first day of the previous span for a "day", "week" or "month" view."""
+    if view == "day":
+        return day, day + datetime.timedelta(days=1), day - datetime.timedelta(days=1)
+    if view == "week":
+        monday = day - datetime.timedelta(days=day.weekday())
+        return monday, monday + datetime.timedelta(weeks=1), monday - datetime.timedelta(weeks=1)
+    first = day.replace(day=1)
+    after = (first + datetime.timedelta(days=31)).replace(day=1)
+    return first, after, (first - datetime.timedelta(days=1)).replace(day=1)
+
+
+def calendar(db, doctor_id, first, after, appointments=True):
+    """
+    Return (date, booked slots, appointments) for each day in [first, after) of a doctor's calendar.
+
+    Archived appointments are included, so past days read the same before
+    and after archive.py runs. Both reads are index range scans, so their
+    cost follows the days shown, not the doctor's history. Pass
+    appointments=False for the counts alone, e.g. for a month.
+    """
+    span = first.isoformat(), after.isoformat()
+    booked = {row["date"]: row["count"] for row in db.execute(OCCUPANCY, doctor_id, *span)}
+    days = {}
+    if appointments:
+        for row in db.execute(with_history(CALENDAR), doctor_id, *span):
+            days.setdefault(row["starts"][:10], []).append(row)
+    return [(day, booked.get(day, 0), days.get(day, [])) for day in
+            ((first + datetime.timedelta(days=n)).isoformat() for n in range((after - first).days))]
+
+
+def with_history(query):
+    """Rewrite an appointment query to read archived appointments as well as current ones."""
+    return query.replace("FROM appointment a", """FROM (
+        SELECT id, user_id, doctor_id, doctor, date, time, starts FROM appointment
+        UNION ALL
+        SELECT id, user_id, doctor_id, doctor, date, time, starts FROM appointment_archive
+    ) a""")
@@ -0,0 +1,172 @@
+"""
+Login rate limiting, so a credential-stuffing burst is turned away before it costs a password hash.
+
+Every POST to a login form takes a token from two buckets: one for the
+client's address and one for the account named in the form. A bucket holds
+up to BURST tokens and refills at PER_MINUTE tokens a minute. An attempt
+that finds either bucket empty raises TooManyAttempts, which the app answers
+with 429 and Retry-After before the view has run any SQL or hashing. A
+refilled bucket is the same as no bucket, so full ones are dropped every
+LOGIN_LIMIT_COMPACT_INTERVAL seconds and the table only holds clients that
+tried recently.
+
+Buckets live in each process's memory, so behind serve.py every worker
+gives an attacker its own allowance. Set LOGIN_LIMIT_DB to an SQLite file to
+keep them in one table that all workers share instead.
+
+Addresses are the peer of the connection. Behind a reverse proxy that would
+be the proxy itself, so set PROXY_HOPS to the number of proxies in front of
+the app and the client's address is read from X-Forwarded-For instead. Only
+the last PROXY_HOPS entries are trusted, so a client cannot choose its own.
+"""
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, request
+
+from database import Database
+
+# Refill a shared bucket for the time since it was last updated, then take a token; no row comes back when it is empty.
+# ?1 is the key, ?2 the burst, ?3 the time now and ?4 the tokens added per second.
+TAKE = """
+    INSERT INTO login_buckets(key, tokens, updated, full) VALUES(?1, ?2 - 1, ?3, ?3 + 1 / ?4)
+    ON CONFLICT(key) DO UPDATE SET
+        tokens = MIN(?2, tokens + (?3 - updated) * ?4) - 1,
+        updated = ?3,
+        full = ?3 + (?2 - MIN(?2, tokens + (?3 - updated) * ?4) + 1) / ?4
+    WHERE MIN(?2, tokens + (?3 - updated) * ?4) >= 1
+    RETURNING tokens
+"""
+
+
+class TooManyAttempts(Exception):
+    """Raised when a login attempt finds its address's or account's bucket empty."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class Buckets:
+    """One app's in-memory buckets, when they were last compacted and its connection to the shared table."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.compacted = time.time()
+        self.store = None
+
+
+class LoginLimiter:
+    """Token buckets per client address and per account, checked before a login view runs; each app keeps its own."""
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register defaults for the rate limit settings in app.config."""
+        app.config.setdefault("LOGIN_LIMIT", True)
+        app.config.setdefault("LOGIN_LIMIT_IP_BURST", 10)
+        app.config.setdefault("LOGIN_LIMIT_IP_PER_MINUTE", 12)
+        app.config.setdefault("LOGIN_LIMIT_ACCOUNT_BURST", 5)
+        app.config.setdefault("LOGIN_LIMIT_ACCOUNT_PER_MINUTE", 2)
+        app.config.setdefault("LOGIN_LIMIT_COMPACT_INTERVAL", 60)
+        app.config.setdefault("LOGIN_LIMIT_DB", None)
+        app.extensions["login_limiter"] = self
+        app.extensions["login_buckets"] = Buckets()
+
+    @property
+    def state(self):
+        return current_app.extensions["login_buckets"]
+
+    def limit(self, field):
+        """Decorate a login view to rate limit its POSTs by client address and by the account in form[field]."""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if request.method == "POST" and current_app.config["LOGIN_LIMIT"]:
+                    self.attempt(request.remote_addr, request.endpoint, request.form.get(field))
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+    def attempt(self, address, endpoint, account):
+        """Take a token for one login attempt, raising TooManyAttempts if the address or account has none left."""
+        config = current_app.config
+        buckets = [(f"ip:{address}", config["LOGIN_LIMIT_IP_BURST"], config["LOGIN_LIMIT_IP_PER_MINUTE"] / 60)]
+        if account:
+            buckets.append((f"{endpoint}:{account.strip().lower()}", config["LOGIN_LIMIT_ACCOUNT_BURST"],
+                            config["LOGIN_LIMIT_ACCOUNT_PER_MINUTE"] / 60))
+        take = self.take_shared if config["LOGIN_LIMIT_DB"] else self.take
+        now = time.time()
+        # The address goes first, so attempts from a blocked address never use up an account's tokens
+        for key, burst, rate in buckets:
+            wait = take(key, burst, rate, now)
+            if wait:
+                raise TooManyAttempts(wait)
+        if now - self.state.compacted >= config["LOGIN_LIMIT_COMPACT_INTERVAL"]:
+            self.compact(now)
+
+    def take(self, key, burst, rate, now):
+        """Take a token from an in-memory bucket, returning 0 or the seconds until one is available."""
+        buckets = self.state.buckets
+        with self.lock:
+            tokens, updated, _ = buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                return (1 - tokens) / rate
+            # Kept with the time it will be full again, so compact() needs no settings
+            buckets[key] = (tokens - 1, now, now + (burst - tokens + 1) / rate)
+            return 0
+
+    def take_shared(self, key, burst, rate, now):
+        """Take a token from a bucket in the LOGIN_LIMIT_DB table, returning 0 or the seconds until one is available."""
+        store = self.shared()
+        if store.execute(TAKE, key, burst, now, rate):
+            return 0
+        rows = store.execute("SELECT tokens, updated FROM login_buckets WHERE key=?", key)
+        tokens = min(burst, rows[0]["tokens"] + (now - rows[0]["updated"]) * rate) if rows else 0
+        # Another worker may have refilled it since; a second is soon enough to try again then
+        return max((1 - tokens) / rate, 1)
+
+    def shared(self):
+        """Open the shared bucket table on first use, or when LOGIN_LIMIT_DB has changed."""
+        path = current_app.config["LOGIN_LIMIT_DB"]
+        state = self.state
+        with self.lock:
+            if state.store is None or state.store.path != path:
+                store = Database(path=path)
+                store.execute("""
+                    CREATE TABLE IF NOT EXISTS login_buckets (
+                        key TEXT PRIMARY KEY NOT NULL,
+                        tokens REAL NOT NULL,
+                        updated REAL NOT NULL,
+                        full REAL NOT NULL
+                    ) WITHOUT ROWID
+                """)
+                store.execute("CREATE INDEX IF NOT EXISTS login_buckets_full ON login_buckets(full)")
+                state.store = store
+            return state.store
+
+    def compact(self, now):
+        """Drop buckets that have refilled, in memory and in the shared table."""
+        state = self.state
+        with self.lock:
+            state.compacted = now
+            state.buckets = {key: bucket for key, bucket in state.buckets.items() if bucket[2] > now}
+        if current_app.config["LOGIN_LIMIT_DB"]:
+            self.shared().execute("DELETE FROM login_buckets WHERE full <= ?", now)
+
+    def close(self, app):
+        """Close this thread's connection to app's shared table."""
+        store = app.extensions["login_buckets"].store
+        if store is not None:
+            store.close()
+
+    def clear(self):
+        with self.lock:
+            self.state.buckets = {}
+        if current_app.config["LOGIN_LIMIT_DB"]:
+            self.shared().execute("DELETE FROM login_buckets")
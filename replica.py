@@ -0,0 +1,139 @@
+"""
+A read-only snapshot of patients.db for the admin reports.
+
+With REPORT_SNAPSHOT set to a file path, /plist, /dlist and /vapp read a copy
+of the database instead of the live one, so a big report never holds up the
+checkpoints that keep bookings and registrations fast. The copy is made with
+SQLite's online backup API in a single read transaction, which writers do
+not wait for. It is written to a temporary file that then replaces the
+snapshot, so readers always see one whole copy, and they open it immutable,
+without any locking. Once the snapshot is older than REPORT_SNAPSHOT_MAX_AGE
+seconds the next report refreshes it in the background and is answered from
+the old copy meanwhile; one process refreshes at a time. Reports show when
+their copy was taken. `flask snapshot` refreshes it at once, e.g. from cron.
+"""
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+from flask import current_app
+
+from migrations import BUSY_TIMEOUT
+
+
+class ReportSnapshot:
+    """A periodically refreshed copy of the database, read through per-thread immutable connections."""
+
+    def __init__(self, app=None):
+        self.local = threading.local()
+        self.refreshing = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Register defaults for the snapshot settings in app.config."""
+        app.config.setdefault("REPORT_SNAPSHOT", None)
+        app.config.setdefault("REPORT_SNAPSHOT_MAX_AGE", 60)
+        app.extensions["report_snapshot"] = self
+
+    @property
+    def enabled(self):
+        return bool(current_app.config["REPORT_SNAPSHOT"])
+
+    def reader(self, db):
+        """Return what a report should read: this snapshot when enabled, refreshed if stale, otherwise db."""
+        if not self.enabled:
+            return db
+        config = current_app.config
+        source, path = config["DATABASE"], config["REPORT_SNAPSHOT"]
+        age = self.age(path)
+        if age is None:
+            # The first report waits for the first copy
+            self.refresh(source, path, wait=True)
+        elif age > config["REPORT_SNAPSHOT_MAX_AGE"] and not self.refreshing.locked():
+            threading.Thread(target=self.refresh, args=(source, path), name="report-snapshot", daemon=True).start()
+        return self
+
+    def taken(self):
+        """Return when the snapshot was taken, or None if there is none yet."""
+        try:
+            return datetime.fromtimestamp(os.path.getmtime(current_app.config["REPORT_SNAPSHOT"]))
+        except FileNotFoundError:
+            return None
+
+    def age(self, path=None):
+        """Return the age in seconds of the snapshot at path, or REPORT_SNAPSHOT, or None if there is none yet."""
+        try:
+            return time.time() - os.path.getmtime(path or current_app.config["REPORT_SNAPSHOT"])
+        except FileNotFoundError:
+            return None
+
+    def refresh(self, source=None, path=None, wait=False, force=False):
+        """
+        Copy the database into the snapshot, returning False if another thread or process was already copying.
+
+        With wait, wait for that copy instead, and only copy again if the
+        snapshot is still missing or stale afterwards, or always with force.
+        """
+        source = source or current_app.config["DATABASE"]
+        path = path or current_app.config["REPORT_SNAPSHOT"]
+        if not self.refreshing.acquire(blocking=wait):
+            return False
+        try:
+            with open(path + ".lock", "w") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                # Only waiting callers have an app context; a background refresh always copies
+                if wait and not force:
+                    age = self.age(path)
+                    if age is not None and age < current_app.config["REPORT_SNAPSHOT_MAX_AGE"]:
+                        return True
+                temporary = f"{path}.{os.getpid()}.tmp"
+                try:
+                    src = sqlite3.connect(source, timeout=BUSY_TIMEOUT)
+                    dst = sqlite3.connect(temporary)
+                    try:
+                        src.backup(dst)
+                        # A copy in WAL mode would need a writable -shm file next to it to be read
+                        dst.execute("PRAGMA journal_mode=DELETE")
+                    finally:
+                        dst.close()
+                        src.close()
+                    os.replace(temporary, path)
+                except BaseException:
+                    if os.path.exists(temporary):
+                        os.remove(temporary)
+                    raise
+                return True
+        finally:
+            self.refreshing.release()
+
+    def connection(self):
+        """Return this thread's connection to the current snapshot, reopening it after a refresh replaced the file."""
+        path = current_app.config["REPORT_SNAPSHOT"]
+        stat = os.stat(path)
+        key = (path, stat.st_ino, stat.st_mtime_ns)
+        if getattr(self.local, "key", None) != key:
+            self.close()
+            conn = sqlite3.connect(f"file:{urllib.parse.quote(path)}?mode=ro&immutable=1", uri=True,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self.local.conn, self.local.key = conn, key
+        return self.local.conn
+
+    def execute(self, sql, *args):
+        """Run a query against the snapshot, returning a list of dicts like Database.execute()."""
+        return [dict(row) for row in self.connection().execute(sql, args)]
+
+    def close(self):
+        """Close this thread's connection to the snapshot."""
+        conn = self.local.__dict__.pop("conn", None)
+        self.local.__dict__.pop("key", None)
+        if conn is not None:
+            conn.close()
@@ -0,0 +1,216 @@
+"""
+Production server: one listening socket shared by preforked worker processes.
+
+The master imports the app once, so templates are compiled and the doctor
+roster is loaded before any worker exists. It closes its own database
+connections and forks --workers processes (one per CPU by default). Each
+worker answers requests on a fixed pool of --threads threads. Every thread
+opens its own database connections after the fork and keeps them for the
+life of the worker. Unless HASH_WORKERS is set, each worker's password
+hashing pool gets an equal share of the CPUs rather than one process per CPU. Workers that die are replaced, and with BOOKING_QUEUE on
+the master first commits the bookings journaled by workers that are gone.
+
+Signals to the master:
+    TERM, INT  stop: workers finish the requests they are serving, then exit
+    HUP        graceful reload: workers finish their requests while the
+               master re-executes itself with the same socket, so new
+               connections wait in the listen backlog instead of being
+               refused, then are served by workers running the new code
+
+Usage: python serve.py [--host 0.0.0.0] [--port 8000] [--workers N] [--threads 8]
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+# Environment variable carrying the listening socket across a reload
+LISTEN_FD = "SERVE_LISTEN_FD"
+
+
+class RequestHandler(WSGIRequestHandler):
+    # One request per connection, so an idle keep-alive client never holds a pool thread
+    protocol_version = "HTTP/1.0"
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """A WSGI server that answers requests on a fixed pool of threads, so each thread keeps its connections."""
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, app, fd, threads):
+        super().__init__("0.0.0.0", 0, app, handler=RequestHandler, fd=fd)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="request")
+        # A connection is only accepted once a thread is free to serve it, so a busy worker leaves new
+        # connections in the backlog for its idle siblings instead of queueing them behind its own
+        self.idle = threading.BoundedSemaphore(threads)
+        # Every worker wakes for each new connection but only one gets it; the rest must not block in accept(),
+        # or they could not notice shutdown() until another connection arrived
+        self.socket.setblocking(False)
+
+    def get_request(self):
+        # Waiting briefly, not forever, keeps serve_forever() responsive to shutdown()
+        if not self.idle.acquire(timeout=0.1):
+            raise BlockingIOError("every request thread is busy")
+        try:
+            request, client_address = super().get_request()
+        except BaseException:
+            self.idle.release()
+            raise
+        request.setblocking(True)
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        try:
+            self.pool.submit(self.process_request_thread, request, client_address)
+        except BaseException:
+            self.idle.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.idle.release()
+
+
+def share_cpus(config, workers):
+    """Size each worker's hashing pool and queue so all workers together use one process per CPU."""
+    if os.environ.get("HASH_WORKERS"):
+        return
+    config["HASH_WORKERS"] = max(1, (os.cpu_count() or 1) // workers)
+    config["HASH_QUEUE_LIMIT"] = 4 * config["HASH_WORKERS"]
+    config["HASH_IMPORT_SLOTS"] = config["HASH_WORKERS"]
+
+
+def preload(workers):
+    """Import the app and warm everything workers can share copy-on-write."""
+    from app import app, booking_queue, db, doctor_directory
+    share_cpus(app.config, workers)
+    with app.app_context():
+        doctor_directory.refresh(db)
+        if booking_queue.enabled:
+            booking_queue.recover()
+    return app
+
+
+def release(app):
+    """Close the master's database connections so no worker inherits one."""
+    app.extensions["database"].close()
+    app.extensions["login_limiter"].close(app)
+    store = getattr(app.session_interface, "store", None)
+    if store is not None:
+        store.close()
+
+
+def worker(app, fd, threads):
+    """Serve on the shared socket until told to stop, then finish in-flight requests."""
+    server = PooledWSGIServer(app, fd, threads)
+    db = app.extensions["database"]
+    store = getattr(app.session_interface, "store", None)
+    ready = threading.Barrier(threads)
+
+    def connect():
+        # Open this pool thread's connections before the first request arrives
+        try:
+            with app.app_context():
+                db.execute("SELECT 1")
+            if store is not None:
+                store.execute("SELECT 1")
+        finally:
+            try:
+                ready.wait(5)
+            except threading.BrokenBarrierError:
+                pass
+    for _ in range(threads):
+        server.pool.submit(connect)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        server.serve_forever()
+    finally:
+        # Let every accepted request finish before closing
+        server.pool.shutdown(wait=True)
+        server.server_close()
+        # Commit queued bookings now rather than leaving them for the next start to replay
+        app.extensions["booking_queue"].close(app)
+        # Hashing pool processes are this worker's children and would outlive it
+        app.extensions["hasher"].shutdown(app)
+
+
+def spawn(app, fd, threads):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            worker(app, fd, threads)
+        except BaseException:
+            sys.excepthook(*sys.exc_info())
+            status = 1
+        finally:
+            os._exit(status)
+    return pid
+
+
+def serve(host, port, workers, threads):
+    """Run the master: fork workers, replace any that die, and handle stop and reload signals."""
+    if LISTEN_FD in os.environ:
+        listener = socket.socket(fileno=int(os.environ[LISTEN_FD]))
+    else:
+        listener = socket.create_server((host, port), backlog=2048)
+    listener.set_inheritable(True)
+    received = []
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: received.append(signum))
+    app = preload(workers)
+    release(app)
+
+    children = {} if received else {spawn(app, listener.fileno(), threads): time.monotonic() for _ in range(workers)}
+    print(f"Serving on {host}:{listener.getsockname()[1]} with {workers} workers x {threads} threads (master {os.getpid()})",
+          flush=True)
+    while not received:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid in children:
+            # A worker that dies straight after starting would otherwise be respawned in a tight loop
+            if time.monotonic() - children.pop(pid) < 1:
+                time.sleep(1)
+            children[spawn(app, listener.fileno(), threads)] = time.monotonic()
+        elif not pid:
+            time.sleep(0.2)
+
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+    # A stop that arrives alongside a reload wins
+    if set(received) == {signal.SIGHUP}:
+        # Old workers drain on their own; the new master reaps nothing it did not fork
+        os.environ[LISTEN_FD] = str(listener.fileno())
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the app with preforked workers.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes (default: CPU count)")
+    parser.add_argument("--threads", type=int, default=8, help="request threads per worker")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.threads)
@@ -0,0 +1,94 @@
+"""
+Server-side sessions kept in a single SQLite table.
+
+Adds SESSION_TYPE = "sqlite" to Flask-Session. Sessions live in one
+WITHOUT ROWID table in their own memory-mapped database file, so patient
+traffic never waits on session writes. A session is written only when its
+contents change. Expired rows are removed in small batches, on average once
+every SESSION_CLEANUP_N_REQUESTS requests.
+"""
+import time
+
+import flask_session
+from flask_session.base import ServerSideSessionInterface
+from flask_session.defaults import Defaults
+
+from database import Database
+
+# Expired sessions deleted per statement during cleanup
+CLEANUP_BATCH = 500
+
+
+class SQLiteSessionInterface(ServerSideSessionInterface):
+    """Store sessions in an SQLite table with an expiry column."""
+
+    ttl = False
+
+    def __init__(self, app, path="sessions.db", mmap_size=64 * 1024 * 1024, **kwargs):
+        self.open_store(path, mmap_size)
+        super().__init__(app, **kwargs)
+
+    def open_store(self, path, mmap_size=64 * 1024 * 1024):
+        """Keep sessions in the database file at path, creating its table if needed."""
+        self.store = Database(path=path, pragmas={"mmap_size": mmap_size})
+        self.store.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY NOT NULL,
+                data BLOB NOT NULL,
+                expires REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self.store.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions(expires)")
+
+    def open_session(self, app, request):
+        session = super().open_session(app, request)
+        # Stored sessions are never empty, so an empty one has nothing in storage to delete
+        session.stored = bool(session)
+        return session
+
+    def save_session(self, app, session, response):
+        if not session and not getattr(session, "stored", False):
+            return
+        super().save_session(app, session, response)
+
+    def should_set_storage(self, app, session):
+        return session.modified
+
+    def _retrieve_session_data(self, store_id):
+        rows = self.store.execute("SELECT data FROM sessions WHERE id=? AND expires>?", store_id, time.time())
+        if not rows:
+            return None
+        return self.serializer.decode(rows[0]["data"])
+
+    def _delete_session(self, store_id):
+        self.store.execute("DELETE FROM sessions WHERE id=?", store_id)
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        self.store.execute("INSERT OR REPLACE INTO sessions(id,data,expires) VALUES(?,?,?)",
+                           store_id, self.serializer.encode(session),
+                           time.time() + session_lifetime.total_seconds())
+
+    def _delete_expired_sessions(self):
+        now = time.time()
+        while self.store.execute("""
+            DELETE FROM sessions WHERE id IN (SELECT id FROM sessions WHERE expires<=? LIMIT ?)
+        """, now, CLEANUP_BATCH) == CLEANUP_BATCH:
+            pass
+
+
+class Session(flask_session.Session):
+    """Flask-Session, with "sqlite" accepted as a SESSION_TYPE."""
+
+    def _get_interface(self, app):
+        config = app.config
+        if config.get("SESSION_TYPE") != "sqlite":
+            return super()._get_interface(app)
+        return SQLiteSessionInterface(
+            app,
+            path=config.get("SESSION_SQLITE_PATH", "sessions.db"),
+            key_prefix=config.get("SESSION_KEY_PREFIX", Defaults.SESSION_KEY_PREFIX),
+            permanent=config.get("SESSION_PERMANENT", Defaults.SESSION_PERMANENT),
+            sid_length=config.get("SESSION_ID_LENGTH", Defaults.SESSION_ID_LENGTH),
+            serialization_format=config.get("SESSION_SERIALIZATION_FORMAT", Defaults.SESSION_SERIALIZATION_FORMAT),
+            cleanup_n_requests=config.get("SESSION_CLEANUP_N_REQUESTS") or 1000,
+        )
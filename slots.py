@@ -0,0 +1,134 @@
+"""
+Per-doctor, per-day slot availability for bookings.
+
+Each (doctor, date) day is a bitmap of fixed-length slots between opening and
+closing time, loaded from the appointment table the first time the day is
+touched. Reserving a slot is a single bit test-and-set under a lock, so a
+conflict is rejected without querying the database. The unique index on
+appointment(doctor_id, date, time) remains the source of truth across
+processes: a booking that loses the race there is reported as taken too.
+Days are loaded from appointment_archive as well, since archive.py moves
+past appointments out of appointment and so out of that index.
+"""
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+# A doctor's booked times on one day, archived ones included
+DAY = """
+    SELECT time FROM appointment WHERE doctor_id = ?1 AND date = ?2
+    UNION ALL
+    SELECT time FROM appointment_archive WHERE doctor_id = ?1 AND date = ?2
+"""
+
+
+class SlotIndex:
+    """Bitmaps of booked slots, keyed by (doctor_id, date) and kept separately for each app."""
+
+    def __init__(self, minutes=15, opens="06:00", closes="18:00", max_days=10000):
+        self.default_minutes = minutes
+        self.opens = self.to_minutes(opens)
+        self.closes = self.to_minutes(closes)
+        self.max_days = max_days
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        """Register the slot length setting, SLOT_MINUTES, and give the app its own days."""
+        app.config.setdefault("SLOT_MINUTES", self.default_minutes)
+        app.extensions["slot_index"] = self
+        app.extensions["slot_days"] = OrderedDict()
+
+    @property
+    def minutes(self):
+        return current_app.config["SLOT_MINUTES"]
+
+    @property
+    def count(self):
+        """Number of slots in a day."""
+        return (self.closes - self.opens) // self.minutes
+
+    @property
+    def days(self):
+        """The current app's loaded days, least recently used first."""
+        return current_app.extensions["slot_days"]
+
+    @staticmethod
+    def to_minutes(time):
+        """Convert "HH:MM" to minutes after midnight, or None if it isn't a time."""
+        try:
+            hours, minutes = time.split(":")[:2]
+            hours, minutes = int(hours), int(minutes)
+        except (AttributeError, ValueError):
+            return None
+        if not (0 <= hours < 24 and 0 <= minutes < 60):
+            return None
+        return hours * 60 + minutes
+
+    def slot(self, time):
+        """Return the slot number a "HH:MM" time falls in, or None if outside opening hours."""
+        minutes = self.to_minutes(time)
+        if minutes is None or minutes < self.opens:
+            return None
+        slot = (minutes - self.opens) // self.minutes
+        return slot if slot < self.count else None
+
+    def time(self, slot):
+        """Return the "HH:MM" start time of a slot."""
+        minutes = self.opens + slot * self.minutes
+        return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+    def day(self, db, doctor_id, date):
+        """Return the bitmap for a doctor's day, loading it on first use. Caller holds the lock."""
+        key = (doctor_id, date)
+        bitmap = self.days.get(key)
+        if bitmap is None:
+            bitmap = 0
+            for row in db.execute(DAY, doctor_id, date):
+                slot = self.slot(row["time"])
+                if slot is not None:
+                    bitmap |= 1 << slot
+            self.days[key] = bitmap
+            if len(self.days) > self.max_days:
+                self.days.popitem(last=False)
+        else:
+            self.days.move_to_end(key)
+        return bitmap
+
+    def reserve(self, db, doctor_id, date, slot):
+        """Mark a slot as booked, returning False if it already was."""
+        with self.lock:
+            bitmap = self.day(db, doctor_id, date)
+            if bitmap >> slot & 1:
+                return False
+            self.days[(doctor_id, date)] = bitmap | 1 << slot
+            return True
+
+    def release(self, doctor_id, date, slot):
+        """Mark a reserved slot as free again."""
+        with self.lock:
+            if (doctor_id, date) in self.days:
+                self.days[(doctor_id, date)] &= ~(1 << slot)
+
+    def taken(self, doctor_id, date, slot):
+        """Record a slot found booked elsewhere, e.g. by another process."""
+        with self.lock:
+            if (doctor_id, date) in self.days:
+                self.days[(doctor_id, date)] |= 1 << slot
+
+    def next_free(self, db, doctor_id, date, slot, limit=3):
+        """Return up to limit free slot times after the given slot on the same day."""
+        with self.lock:
+            bitmap = self.day(db, doctor_id, date)
+        free = []
+        for candidate in range(slot + 1, self.count):
+            if not bitmap >> candidate & 1:
+                free.append(self.time(candidate))
+                if len(free) == limit:
+                    break
+        return free
+
+    def clear(self):
+        """Forget every loaded day."""
+        with self.lock:
+            self.days.clear()
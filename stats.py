@@ -0,0 +1,71 @@
+"""
+Counts and trends for the admin dashboard.
+
+Triggers added by migrations.aggregates bump the totals, daily_appointments
+and weekly_registrations tables on every insert, so the dashboard reads a few
+dozen rows however much history there is. Rows are never deleted by the app;
+if the tables are ever edited by hand, recount everything with:
+
+Usage: python stats.py [patients.db]
+"""
+import argparse
+import datetime
+import sqlite3
+
+from migrations import BUSY_TIMEOUT, rebuild_aggregates
+
+# Days either side of today in the bookings trend, and weeks of registrations shown
+DAYS = 7
+WEEKS = 8
+
+
+def dashboard(db, today=None):
+    """Return the totals, per-day bookings, busiest doctors and weekly registrations around today."""
+    today = today or datetime.date.today()
+    first = today - datetime.timedelta(days=DAYS)
+    last = today + datetime.timedelta(days=DAYS)
+    totals = {row["name"]: row["count"] for row in db.execute("SELECT name, count FROM totals")}
+
+    booked = {row["date"]: row["count"] for row in db.execute("""
+        SELECT date, SUM(count) AS count FROM daily_appointments
+        WHERE date BETWEEN ? AND ? GROUP BY date
+    """, first.isoformat(), last.isoformat())}
+    days = [(day, booked.get(day, 0)) for day in
+            ((first + datetime.timedelta(days=n)).isoformat() for n in range(2 * DAYS + 1))]
+
+    busiest = db.execute("""
+        SELECT COALESCE(d.fname || ' ' || d.lname, 'Unlinked') AS doctor, a.count
+        FROM daily_appointments a LEFT JOIN doctors d ON d.id = a.doctor_id
+        WHERE a.date = ? ORDER BY a.count DESC LIMIT 5
+    """, today.isoformat())
+
+    monday = today - datetime.timedelta(days=today.weekday())
+    start = monday - datetime.timedelta(weeks=WEEKS - 1)
+    registered = {(row["week"], row["kind"]): row["count"] for row in db.execute(
+        "SELECT week, kind, count FROM weekly_registrations WHERE week >= ?", start.isoformat())}
+    weeks = []
+    for n in range(WEEKS):
+        week = (start + datetime.timedelta(weeks=n)).isoformat()
+        weeks.append((week, registered.get((week, "patients"), 0), registered.get((week, "doctors"), 0)))
+
+    return {
+        "patients": totals.get("patients", 0),
+        "doctors": totals.get("doctors", 0),
+        "appointments": totals.get("appointments", 0),
+        "days": days,
+        "busiest": busiest,
+        "weeks": weeks,
+        "today": today.isoformat(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recount the dashboard's aggregate tables.")
+    parser.add_argument("database", nargs="?", default="patients.db")
+    args = parser.parse_args()
+    conn = sqlite3.connect(args.database, timeout=BUSY_TIMEOUT)
+    try:
+        rebuild_aggregates(conn)
+    finally:
+        conn.close()
+    print("Rebuilt totals, daily_appointments and weekly_registrations")